@@ -0,0 +1,93 @@
+"""Count apiserver connections opened per reconcile.
+
+Drives create, update and delete for a number of agents against a local fake
+API server, once with a fresh ApiClient per call (how the handlers used to
+build their clients) and once with the shared pooled ApiClient.
+
+    python bench/bench_connections.py --agents 20
+"""
+import argparse
+import asyncio
+import logging
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+import kopf  # noqa: E402
+import kubernetes  # noqa: E402
+
+import main  # noqa: E402
+from fake_apiserver import FakeApiServer  # noqa: E402
+
+
+def agent_body(index, prompt):
+    return {
+        "apiVersion": "kopf.dev.claud-code/v1",
+        "kind": "ClaudCode",
+        "metadata": {"name": f"bench-agent-{index}", "namespace": "default"},
+        "system_prompt": prompt,
+        "mcp_config": {"mcpServers": {}},
+    }
+
+
+async def reconcile_all(agents):
+    logger = logging.getLogger("bench")
+    for index in range(agents):
+        body = agent_body(index, "v1")
+        patch = kopf.Patch()
+        await main.create_claud_code_fn(
+            body=body, name=body["metadata"]["name"], namespace="default",
+            logger=logger, patch=patch,
+        )
+        updated = agent_body(index, "v2")
+        await main.update_claud_code_fn(
+            body=updated, name=body["metadata"]["name"], namespace="default",
+            logger=logger, diff=[("change", ("system_prompt",), "v1", "v2")],
+            status=dict(patch.status), patch=kopf.Patch(),
+        )
+        await main.delete_claud_code_fn(body=updated, logger=logger)
+
+
+def run(server, agents, shared):
+    main._applied_hashes.clear()
+    main._api_client = None
+    if shared:
+        main.api_client = shared_client
+    else:
+        main.api_client = main.build_api_client
+    server.reset()
+    asyncio.run(reconcile_all(agents))
+    return server.connections, server.requests
+
+
+shared_client = main.api_client
+
+
+def main_():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--agents", type=int, default=20)
+    args = parser.parse_args()
+
+    main.PIN_IMAGES = False  # no registry round trips in the numbers
+    main.API_RATE_LIMITS.clear()  # measure the handlers, not the client-side rate limits
+    os.environ.setdefault("ANTHROPIC_API_KEY", "bench")
+    os.environ.setdefault("OPENAI_API_KEY", "bench")
+    logging.basicConfig(level=logging.WARNING)
+
+    server = FakeApiServer().start()
+    configuration = kubernetes.client.Configuration()
+    configuration.host = server.url
+    kubernetes.client.Configuration.set_default(configuration)
+
+    print(f"{'client':>10} {'requests':>8} {'connections':>11} {'conn/reconcile':>14}")
+    for label, shared in (("per-call", False), ("shared", True)):
+        connections, requests = run(server, args.agents, shared)
+        # create, update and delete are three reconciles per agent
+        print(f"{label:>10} {requests:>8} {connections:>11} {connections / (args.agents * 3):>14.2f}")
+    server.shutdown()
+
+
+if __name__ == "__main__":
+    main_()
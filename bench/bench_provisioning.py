@@ -0,0 +1,94 @@
+"""Measure wall-clock provisioning latency of create_claud_code_fn.
+
+Every Kubernetes API call is replaced by a fixed sleep, so the numbers show
+how the handler schedules its calls rather than how fast a cluster is.
+Running with --concurrency 1 reproduces the old one-call-at-a-time chain.
+
+    python bench/bench_provisioning.py --agents 50 --latency 0.02 --workers 64
+"""
+import argparse
+import asyncio
+import concurrent.futures
+import logging
+import os
+import sys
+import threading
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+import kopf  # noqa: E402
+import kubernetes  # noqa: E402
+
+import main  # noqa: E402
+
+
+def install_fake_latency(latency):
+    """Replace every API round trip with a sleep and count the calls"""
+    calls = {"count": 0}
+    lock = threading.Lock()
+
+    def call_api(self, *args, **kwargs):
+        with lock:
+            calls["count"] += 1
+        time.sleep(latency)
+        return None
+
+    kubernetes.client.ApiClient.call_api = call_api
+    return calls
+
+
+def agent_body(index):
+    return {
+        "apiVersion": "kopf.dev.claud-code/v1",
+        "kind": "ClaudCode",
+        "metadata": {"name": f"bench-agent-{index}", "namespace": "default"},
+        "system_prompt": "You are a benchmark agent.",
+        "mcp_config": {"mcpServers": {}},
+    }
+
+
+async def provision(agents, concurrency):
+    logger = logging.getLogger("bench")
+    main.PROVISION_CONCURRENCY = concurrency
+    started = time.monotonic()
+    await asyncio.gather(*(
+        main.create_claud_code_fn(
+            body=body,
+            name=body["metadata"]["name"],
+            namespace=body["metadata"]["namespace"],
+            logger=logger,
+            patch=kopf.Patch(),
+        )
+        for body in map(agent_body, range(agents))
+    ))
+    return time.monotonic() - started
+
+
+def main_():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--agents", type=int, default=50)
+    parser.add_argument("--latency", type=float, default=0.02, help="seconds per API call")
+    parser.add_argument("--concurrency", type=int, nargs="*", default=[1, main.PROVISION_CONCURRENCY])
+    parser.add_argument("--workers", type=int, default=main.API_WORKERS, help="API thread pool size")
+    args = parser.parse_args()
+
+    main._api_executor = concurrent.futures.ThreadPoolExecutor(max_workers=args.workers)
+
+    main.PIN_IMAGES = False  # no registry round trips in the numbers
+    main.API_RATE_LIMITS.clear()  # measure the handlers, not the client-side rate limits
+    os.environ.setdefault("ANTHROPIC_API_KEY", "bench")
+    os.environ.setdefault("OPENAI_API_KEY", "bench")
+    logging.basicConfig(level=logging.WARNING)
+    calls = install_fake_latency(args.latency)
+
+    print(f"{'concurrency':>11} {'agents':>6} {'api calls':>9} {'wall (s)':>9} {'per agent (s)':>13}")
+    for concurrency in args.concurrency:
+        calls["count"] = 0
+        main._applied_hashes.clear()
+        elapsed = asyncio.run(provision(args.agents, concurrency))
+        print(f"{concurrency:>11} {args.agents:>6} {calls['count']:>9} {elapsed:>9.2f} {elapsed / args.agents:>13.3f}")
+
+
+if __name__ == "__main__":
+    main_()
@@ -0,0 +1,142 @@
+"""A local stand-in for the Kubernetes API server used by the benchmarks.
+
+It speaks plain HTTP/1.1 with keep-alive and keeps the objects it is sent in
+memory: server-side applies and merge patches create or update them, GETs and
+LISTs (with label selectors) read them, and deletes and deletecollections
+remove them. It counts the TCP connections clients open, the requests they
+make and the bytes in both directions. Against a real apiserver every one of
+those connections is also a TLS handshake.
+"""
+import http.server
+import json
+import threading
+import urllib.parse
+
+
+class FakeApiServer(http.server.ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, address=("127.0.0.1", 0)):
+        super().__init__(address, FakeApiHandler)
+        self.lock = threading.Lock()
+        self.collections = {}  # collection path -> {object name: object}
+        self.connections = 0
+        self.requests = 0
+        self.bytes_received = 0
+        self.bytes_sent = 0
+
+    @property
+    def url(self):
+        host, port = self.server_address[:2]
+        return f"http://{host}:{port}"
+
+    def reset(self, objects=False):
+        with self.lock:
+            self.connections = 0
+            self.requests = 0
+            self.bytes_received = 0
+            self.bytes_sent = 0
+            if objects:
+                self.collections.clear()
+
+    def start(self):
+        thread = threading.Thread(target=self.serve_forever, daemon=True)
+        thread.start()
+        return self
+
+
+def merge(target, patch):
+    """JSON merge patch (RFC 7386), which is also how applies are folded in here"""
+    if not isinstance(patch, dict):
+        return patch
+    merged = dict(target) if isinstance(target, dict) else {}
+    for key, value in patch.items():
+        if value is None:
+            merged.pop(key, None)
+        else:
+            merged[key] = merge(merged.get(key), value)
+    return merged
+
+
+def is_collection(path):
+    """Whether a path names a collection (`.../deployments`) rather than an object"""
+    segments = path.strip("/").split("/")
+    # /api/v1/... or /apis/{group}/{version}/...
+    segments = segments[2:] if segments[:1] == ["api"] else segments[3:]
+    if len(segments) > 2 and segments[0] == "namespaces":
+        segments = segments[2:]
+    return len(segments) == 1
+
+
+def matches(obj, label_selector):
+    labels = obj.get("metadata", {}).get("labels") or {}
+    for requirement in filter(None, (label_selector or "").split(",")):
+        key, _, value = requirement.partition("=")
+        if labels.get(key) != value:
+            return False
+    return True
+
+
+class FakeApiHandler(http.server.BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def setup(self):
+        super().setup()
+        with self.server.lock:
+            self.server.connections += 1
+
+    def log_message(self, format, *args):
+        pass
+
+    def respond(self, status, payload):
+        data = json.dumps(payload).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+        with self.server.lock:
+            self.server.bytes_sent += len(data)
+
+    def not_found(self, path):
+        self.respond(404, {"kind": "Status", "status": "Failure", "reason": "NotFound", "code": 404, "message": path})
+
+    def handle_any(self):
+        length = int(self.headers.get("Content-Length") or 0)
+        body = json.loads(self.rfile.read(length)) if length else None
+        url = urllib.parse.urlsplit(self.path)
+        path = url.path.rstrip("/")
+        query = dict(urllib.parse.parse_qsl(url.query))
+        collection_path, _, name = path.rpartition("/")
+        if is_collection(path):
+            collection_path, name = path, None
+        with self.server.lock:
+            self.server.requests += 1
+            self.server.bytes_received += length + len(self.requestline) + len(str(self.headers))
+            collection = self.server.collections.setdefault(collection_path, {})
+            if name is None:
+                items = [obj for obj in collection.values() if matches(obj, query.get("labelSelector"))]
+                if self.command == "POST":
+                    collection[body["metadata"]["name"]] = body
+                    result = (201, body)
+                elif self.command == "DELETE":
+                    for obj in items:
+                        collection.pop(obj["metadata"]["name"], None)
+                    result = (200, {"items": items})
+                else:
+                    result = (200, {"items": items})
+            elif self.command in ("PUT", "PATCH"):
+                if isinstance(body, dict):
+                    collection[name] = merge(collection.get(name), body)
+                result = (200, collection.get(name, {}))
+            elif name not in collection:
+                result = None
+            elif self.command == "DELETE":
+                result = (200, collection.pop(name))
+            else:
+                result = (200, collection[name])
+        if result is None:
+            return self.not_found(path)
+        self.respond(*result)
+
+    do_GET = do_POST = do_PUT = do_PATCH = do_DELETE = handle_any
@@ -0,0 +1,153 @@
+"""Scale benchmark of the ClaudCode handlers against a local fake API server.
+
+Creates, updates, resumes (as after an operator restart) and deletes N
+agents concurrently, the way kopf runs the handlers of many objects at once,
+for each N. Needs no cluster and no network, so it runs in CI. For every
+phase it reports wall time, API calls per reconcile and bytes in each
+direction, and the peak memory traced while the handlers ran (measured in a
+second, traced pass, so tracing does not distort the timings).
+
+    python bench/run.py --agents 1 10 100 1000 --json bench-results.json
+"""
+import argparse
+import asyncio
+import json
+import logging
+import os
+import sys
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+import kopf  # noqa: E402
+import kubernetes  # noqa: E402
+
+import main  # noqa: E402
+from fake_apiserver import FakeApiServer  # noqa: E402
+
+
+def agent_body(index, prompt):
+    return {
+        "apiVersion": "kopf.dev.claud-code/v1",
+        "kind": "ClaudCode",
+        "metadata": {"name": f"bench-agent-{index}", "namespace": "default"},
+        "system_prompt": prompt,
+        "mcp_config": {"mcpServers": {}},
+    }
+
+
+async def create(index, logger, statuses):
+    body = agent_body(index, "v1")
+    patch = kopf.Patch()
+    await main.create_claud_code_fn(
+        body=body, name=body["metadata"]["name"], namespace="default", logger=logger, patch=patch,
+    )
+    statuses[index] = dict(patch.status)
+
+
+async def update(index, logger, statuses):
+    body = dict(agent_body(index, "v2"), status=statuses[index])
+    patch = kopf.Patch()
+    await main.update_claud_code_fn(
+        body=body, name=body["metadata"]["name"], namespace="default", logger=logger,
+        diff=[("change", ("system_prompt",), "v1", "v2")],
+        status=statuses[index], patch=patch,
+    )
+    statuses[index] = dict(statuses[index], **patch.status)
+
+
+async def resume(index, logger, statuses):
+    body = dict(agent_body(index, "v2"), status=statuses[index])
+    await main.resume_claud_code_fn(
+        body=body, name=body["metadata"]["name"], logger=logger,
+        status=statuses[index], patch=kopf.Patch(),
+    )
+
+
+async def delete(index, logger, statuses):
+    body = dict(agent_body(index, "v2"), status=statuses[index])
+    await main.delete_claud_code_fn(body=body, logger=logger)
+
+
+PHASES = (("create", create), ("update", update), ("resume", resume), ("delete", delete))
+
+
+async def run_phases(server, agents, trace):
+    """Run every phase for `agents` agents, returning one result per phase"""
+    logger = logging.getLogger("bench")
+    statuses = {}
+    results = []
+    for phase, handler in PHASES:
+        server.reset()
+        if trace:
+            tracemalloc.start()
+        started = time.monotonic()
+        await asyncio.gather(*(handler(index, logger, statuses) for index in range(agents)))
+        elapsed = time.monotonic() - started
+        peak = tracemalloc.get_traced_memory()[1] if trace else None
+        if trace:
+            tracemalloc.stop()
+        results.append({
+            "phase": phase,
+            "agents": agents,
+            "wall_s": round(elapsed, 3),
+            "calls_per_reconcile": round(server.requests / agents, 2),
+            "bytes_sent_per_reconcile": round(server.bytes_received / agents),
+            "bytes_received_per_reconcile": round(server.bytes_sent / agents),
+            "peak_mib": round(peak / 2**20, 2) if trace else None,
+        })
+    return results
+
+
+def bench(server, agents, memory):
+    main._applied_hashes.clear()
+    server.reset(objects=True)
+    results = asyncio.run(run_phases(server, agents, trace=False))
+    if memory:
+        main._applied_hashes.clear()
+        server.reset(objects=True)
+        for result, traced in zip(results, asyncio.run(run_phases(server, agents, trace=True))):
+            result["peak_mib"] = traced["peak_mib"]
+    return results
+
+
+def main_():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--agents", type=int, nargs="+", default=[1, 10, 100, 1000])
+    parser.add_argument("--no-memory", action="store_true", help="skip the traced pass")
+    parser.add_argument("--json", help="also write the results to this file")
+    parser.add_argument("--rate-limited", action="store_true", help="keep the client-side API rate limits")
+    args = parser.parse_args()
+
+    main.PIN_IMAGES = False  # no registry round trips in the numbers
+    if not args.rate_limited:
+        main.API_RATE_LIMITS.clear()
+    os.environ.setdefault("ANTHROPIC_API_KEY", "bench")
+    os.environ.setdefault("OPENAI_API_KEY", "bench")
+    logging.basicConfig(level=logging.WARNING)
+
+    server = FakeApiServer().start()
+    configuration = kubernetes.client.Configuration()
+    configuration.host = server.url
+    main._api_client = main.build_api_client(configuration)
+
+    print(f"{'phase':>6} {'agents':>6} {'wall (s)':>9} {'calls/rec':>9} {'sent/rec':>9} {'recv/rec':>9} {'peak MiB':>9}")
+    results = []
+    for agents in args.agents:
+        for result in bench(server, agents, memory=not args.no_memory):
+            results.append(result)
+            peak = "-" if result["peak_mib"] is None else f"{result['peak_mib']:.2f}"
+            print(
+                f"{result['phase']:>6} {agents:>6} {result['wall_s']:>9.3f} {result['calls_per_reconcile']:>9.2f}"
+                f" {result['bytes_sent_per_reconcile']:>9} {result['bytes_received_per_reconcile']:>9} {peak:>9}"
+            )
+    server.shutdown()
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == "__main__":
+    main_()
@@ -4,105 +4,938 @@ import kubernetes
 import dotenv
 import os
 import base64
+import hashlib
+import copy
 import uuid
+import json
+import time
+import datetime
+import asyncio
+import random
+import re
+import functools
+import concurrent.futures
+import socket
+import threading
+import urllib3
+import aiohttp.web
 from kubernetes.client.models import RbacV1Subject
 
 dotenv.load_dotenv()
 
+# The kubernetes client is blocking, so the async handlers run its calls on a
+# dedicated thread pool instead of holding a kopf worker for a whole chain.
+API_WORKERS = int(os.getenv("KOPF_AGENT_API_WORKERS", "32"))
+# Upper bound on concurrent API calls while provisioning a single agent.
+PROVISION_CONCURRENCY = int(os.getenv("KOPF_AGENT_PROVISION_CONCURRENCY", "8"))
 
-def ensure_api_secrets(namespace, logger):
-    """Create API key secrets if they don't exist"""
-    core_v1_api = kubernetes.client.CoreV1Api()
-    
-    # Get API keys from environment
-    anthropic_key = os.getenv("ANTHROPIC_API_KEY")
-    openai_key = os.getenv("OPENAI_API_KEY")
-    
-    if not anthropic_key or not openai_key:
-        logger.error("ANTHROPIC_API_KEY or OPENAI_API_KEY is not set")
-        print(f"ANTHROPIC_API_KEY: {anthropic_key[:10]}")
-        print(f"OPENAI_API_KEY: {openai_key[:10]}")
-        return
-    
-    if anthropic_key:
-        secret_data = {"ANTHROPIC_API_KEY": base64.b64encode(anthropic_key.encode()).decode()}
-        secret = kubernetes.client.V1Secret(
-            metadata=kubernetes.client.V1ObjectMeta(name="anthropic-api-key"),
-            data=secret_data,
-            type="Opaque"
-        )
+# Connections kept open to the apiserver by the shared ApiClient. Every API
+# worker can hold one, so a full pool never forces a new TLS handshake.
+API_POOL_SIZE = int(os.getenv("KOPF_AGENT_API_POOL_SIZE", str(API_WORKERS)))
+# TCP keep-alive probes on pooled connections, so idle ones are not silently
+# dropped by NAT or load balancers between the operator and the apiserver.
+API_KEEPALIVE_IDLE = int(os.getenv("KOPF_AGENT_API_KEEPALIVE_IDLE", "30"))
+API_KEEPALIVE_INTERVAL = int(os.getenv("KOPF_AGENT_API_KEEPALIVE_INTERVAL", "10"))
+# Idle, fully provisioned agent stacks to keep ready for new ClaudCodes (0 disables).
+WARM_POOL_SIZE = int(os.getenv("KOPF_AGENT_WARM_POOL_SIZE", "0"))
+WARM_POOL_INTERVAL = float(os.getenv("KOPF_AGENT_WARM_POOL_INTERVAL", "30"))
+# Route every agent's playwright-server Service to one shared, autoscaled
+# Playwright pool instead of running a browser server per agent.
+SHARED_PLAYWRIGHT = os.getenv("KOPF_AGENT_SHARED_PLAYWRIGHT", "false").lower() == "true"
+SHARED_NAMESPACE = os.getenv("KOPF_AGENT_SHARED_NAMESPACE", "kopf-agent-shared")
+# Browser sessions reserved per agent, and accepted per pool pod (run-server --max-clients).
+PLAYWRIGHT_SESSIONS_PER_AGENT = int(os.getenv("KOPF_AGENT_PLAYWRIGHT_SESSIONS_PER_AGENT", "2"))
+PLAYWRIGHT_SESSIONS_PER_POD = int(os.getenv("KOPF_AGENT_PLAYWRIGHT_SESSIONS_PER_POD", "16"))
+PLAYWRIGHT_MAX_REPLICAS = int(os.getenv("KOPF_AGENT_PLAYWRIGHT_MAX_REPLICAS", "10"))
+PLAYWRIGHT_POOL_INTERVAL = float(os.getenv("KOPF_AGENT_PLAYWRIGHT_POOL_INTERVAL", "30"))
+# Sizing profile of agents that do not set `size`.
+DEFAULT_SIZE = os.getenv("KOPF_AGENT_DEFAULT_SIZE", "small")
+# Scale agents to zero after this many seconds without network traffic (0 disables).
+IDLE_AFTER = float(os.getenv("KOPF_AGENT_IDLE_AFTER", "0"))
+IDLE_CHECK_INTERVAL = float(os.getenv("KOPF_AGENT_IDLE_CHECK_INTERVAL", "60"))
+# The activator holds requests to idle agents until they are ready again. Idle
+# agent services point at it on this pod IP (set through the downward API).
+ACTIVATOR_PORT = int(os.getenv("KOPF_AGENT_ACTIVATOR_PORT", "8090"))
+ACTIVATOR_IP = os.getenv("POD_IP")
+WAKE_TIMEOUT = float(os.getenv("KOPF_AGENT_WAKE_TIMEOUT", "300"))
+# Pin agent images to the digest their tag resolved to when the agent was
+# created (recorded in status.images) and pull them IfNotPresent. Resolved
+# tags are reused for IMAGE_DIGEST_TTL by new agents and shared objects.
+PIN_IMAGES = os.getenv("KOPF_AGENT_PIN_IMAGES", "true").lower() == "true"
+IMAGE_DIGEST_TTL = float(os.getenv("KOPF_AGENT_IMAGE_DIGEST_TTL", "600"))
+# Keep the agent images pulled on every node with a DaemonSet in SHARED_NAMESPACE.
+PREPULL_IMAGES = os.getenv("KOPF_AGENT_PREPULL_IMAGES", "false").lower() == "true"
+PREPULL_INTERVAL = float(os.getenv("KOPF_AGENT_PREPULL_INTERVAL", "300"))
+# Client-side rate limits as `qps/burst` per verb class, shared by all handlers,
+# and retries of throttled (429) or failed API requests with jittered backoff.
+API_RATES = {
+    "read": os.getenv("KOPF_AGENT_API_RATE_READ", "50/100"),
+    "write": os.getenv("KOPF_AGENT_API_RATE_WRITE", "20/40"),
+    "delete": os.getenv("KOPF_AGENT_API_RATE_DELETE", "10/20"),
+}
+API_RETRIES = int(os.getenv("KOPF_AGENT_API_RETRIES", "5"))
+API_RETRY_BASE = float(os.getenv("KOPF_AGENT_API_RETRY_BASE", "0.2"))
+API_RETRY_CAP = float(os.getenv("KOPF_AGENT_API_RETRY_CAP", "10"))
+# Port of the Prometheus /metrics endpoint (0 disables).
+METRICS_PORT = int(os.getenv("KOPF_AGENT_METRICS_PORT", "9090"))
+# ClaudCodeFleet children provisioned at once unless the fleet sets max_parallel,
+# and seconds between fleet reconciles while it converges.
+FLEET_MAX_PARALLEL = int(os.getenv("KOPF_AGENT_FLEET_MAX_PARALLEL", "5"))
+FLEET_INTERVAL = float(os.getenv("KOPF_AGENT_FLEET_INTERVAL", "10"))
+# Pass the system prompt as `--system-prompt` (args) or mount it from an
+# immutable, content-addressed ConfigMap and pass its path with PROMPT_FILE_ARG
+# (file), which keeps the prompt out of pod specs and ReplicaSet revisions.
+PROMPT_DELIVERY = os.getenv("KOPF_AGENT_PROMPT_DELIVERY", "args")
+PROMPT_FILE_ARG = os.getenv("KOPF_AGENT_PROMPT_FILE_ARG", "--system-prompt-file")
+# How a running agent picks up a changed mcp_config: `restart` rolls the pod;
+# `signal` (SIGHUP to the agent) and `http` (POST to RELOAD_PATH on the agent
+# port) reload it in place once the kubelet has synced the mounted file, and
+# fall back to the rollout when that does not happen within RELOAD_TIMEOUT.
+MCP_RELOAD = os.getenv("KOPF_AGENT_MCP_RELOAD", "restart")
+MCP_RELOAD_PATH = os.getenv("KOPF_AGENT_MCP_RELOAD_PATH", "/reload-mcp")
+MCP_RELOAD_TIMEOUT = float(os.getenv("KOPF_AGENT_MCP_RELOAD_TIMEOUT", "120"))
+# Run a pull-through PyPI proxy and nix binary cache in SHARED_NAMESPACE, each on
+# a PVC of this many GiB, and point every agent's pip, uv and nix at them.
+PACKAGE_CACHE = os.getenv("KOPF_AGENT_PACKAGE_CACHE", "false").lower() == "true"
+PACKAGE_CACHE_SIZE_GB = int(os.getenv("KOPF_AGENT_PACKAGE_CACHE_SIZE_GB", "20"))
+# Data volumes of new agents with a `data_template` are copied from the template
+# server in SHARED_NAMESPACE; with CLONE they are cloned from the template PVC
+# instead, which needs a CSI driver that clones, the CrossNamespaceVolumeDataSource
+# feature gate and the Gateway API ReferenceGrant CRD (one grant is created per
+# agent namespace). Templates are refreshed on SCHEDULE unless they set their own.
+DATA_TEMPLATE_CLONE = os.getenv("KOPF_AGENT_DATA_TEMPLATE_CLONE", "false").lower() == "true"
+DATA_TEMPLATE_SCHEDULE = os.getenv("KOPF_AGENT_DATA_TEMPLATE_SCHEDULE", "0 3 * * *")
+# Seconds between drift checks of each agent against its live objects (0 disables),
+# and how many checks pass between reads of the kinds the informers do not cache.
+DRIFT_INTERVAL = float(os.getenv("KOPF_AGENT_DRIFT_INTERVAL", "300"))
+DRIFT_FULL_EVERY = int(os.getenv("KOPF_AGENT_DRIFT_FULL_EVERY", "6"))
+# Delete the whole agent namespace on teardown unless the ClaudCode says otherwise.
+DELETE_NAMESPACE = os.getenv("KOPF_AGENT_DELETE_NAMESPACE", "false").lower() == "true"
+
+_api_executor = concurrent.futures.ThreadPoolExecutor(
+    max_workers=API_WORKERS, thread_name_prefix="k8s-api"
+)
+_api_client = None
+
+
+# Prometheus metrics, served in the text exposition format on METRICS_PORT.
+class Metric:
+    """One metric family; samples are keyed by their label values"""
+
+    kind = None
+
+    def __init__(self, name, documentation, labelnames):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = labelnames
+        self.samples = {}
+        self.lock = threading.Lock()
+
+    def key(self, labels):
+        return tuple(str(labels[labelname]) for labelname in self.labelnames)
+
+    def label_text(self, key, extra=()):
+        pairs = list(zip(self.labelnames, key)) + list(extra)
+        if not pairs:
+            return ""
+        escaped = (value.replace("\\", "\\\\").replace('"', '\\"') for _, value in pairs)
+        return "{" + ",".join(f'{labelname}="{value}"' for (labelname, _), value in zip(pairs, escaped)) + "}"
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.kind}"]
+        with self.lock:
+            samples = dict(self.samples)
+        for key, value in sorted(samples.items()):
+            lines.extend(self.render_sample(key, value))
+        return lines
+
+    def render_sample(self, key, value):
+        return [f"{self.name}{self.label_text(key)} {value}"]
+
+
+class Counter(Metric):
+    kind = "counter"
+
+    def inc(self, amount=1, **labels):
+        key = self.key(labels)
+        with self.lock:
+            self.samples[key] = self.samples.get(key, 0) + amount
+
+
+class Gauge(Counter):
+    kind = "gauge"
+
+    def dec(self, amount=1, **labels):
+        self.inc(-amount, **labels)
+
+
+class Histogram(Metric):
+    kind = "histogram"
+
+    def __init__(self, name, documentation, labelnames, buckets):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = buckets
+
+    def observe(self, value, **labels):
+        key = self.key(labels)
+        with self.lock:
+            counts, total = self.samples.get(key, ([0] * len(self.buckets), 0.0))
+            counts = [count + (value <= bound) for count, bound in zip(counts, self.buckets)]
+            self.samples[key] = (counts, total + value)
+
+    def render_sample(self, key, value):
+        # Buckets are cumulative and the last one is +Inf, so it holds the count
+        counts, total = value
+        lines = [
+            f"{self.name}_bucket{self.label_text(key, [('le', '+Inf' if bound == float('inf') else format(bound, 'g'))])} {bucket}"
+            for bound, bucket in zip(self.buckets, counts)
+        ]
+        lines.append(f"{self.name}_sum{self.label_text(key)} {total}")
+        lines.append(f"{self.name}_count{self.label_text(key)} {counts[-1]}")
+        return lines
+
+
+API_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, float("inf"))
+HANDLER_BUCKETS = (0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, float("inf"))
+
+HANDLER_DURATION = Histogram(
+    "kopf_agent_handler_duration_seconds", "Duration of ClaudCode handlers.",
+    ("handler", "outcome"), HANDLER_BUCKETS,
+)
+HANDLERS_IN_FLIGHT = Gauge(
+    "kopf_agent_handlers_in_flight", "ClaudCode handlers currently running.", ("handler",),
+)
+HANDLER_RETRIES = Counter(
+    "kopf_agent_handler_retries_total", "Handler invocations that retry a failed attempt.", ("handler",),
+)
+API_REQUESTS = Counter(
+    "kopf_agent_api_requests_total", "Kubernetes API requests by verb, resource and status code.",
+    ("verb", "resource", "code"),
+)
+API_DURATION = Histogram(
+    "kopf_agent_api_request_duration_seconds", "Latency of Kubernetes API requests.",
+    ("verb", "resource"), API_BUCKETS,
+)
+API_RETRIES_TOTAL = Counter(
+    "kopf_agent_api_retries_total", "Kubernetes API requests sent again after a failure.",
+    ("verb", "resource"),
+)
+DRIFT_REPAIRS = Counter(
+    "kopf_agent_drift_repairs_total", "Owned objects patched or recreated after drifting from the ClaudCode.",
+    ("kind",),
+)
+METRICS = (
+    HANDLER_DURATION, HANDLERS_IN_FLIGHT, HANDLER_RETRIES, API_REQUESTS, API_DURATION, API_RETRIES_TOTAL,
+    DRIFT_REPAIRS,
+)
+
+
+def render_metrics():
+    return "\n".join(line for metric in METRICS for line in metric.render()) + "\n"
+
+
+def api_verb_and_resource(resource_path, method, header_params):
+    """Kubernetes verb and resource (`deployments`, `pods/log`) of a request path"""
+    segments = [segment for segment in resource_path.split("?")[0].split("/") if segment]
+    # /api/v1/... or /apis/{group}/{version}/...
+    segments = segments[2:] if segments[:1] == ["api"] else segments[3:]
+    if len(segments) > 2 and segments[0] == "namespaces":
+        segments = segments[2:]
+    named = len(segments) > 1
+    resource = "/".join(segments[:1] + segments[2:3])
+    content_type = (header_params or {}).get("Content-Type", "")
+    verb = {
+        "GET": "get" if named else "list",
+        "POST": "create",
+        "PUT": "update",
+        "PATCH": "apply" if content_type.startswith("application/apply-patch") else "patch",
+        "DELETE": "delete" if named else "deletecollection",
+    }.get(method, method.lower())
+    return verb, resource
+
+
+def request_verb_and_resource(resource_path, method, path_params, query_params, header_params):
+    """api_verb_and_resource of a call_api request, with its path parameters filled in"""
+    templated = resource_path
+    for param in ("group", "version", "plural"):
+        if path_params and param in path_params:
+            templated = templated.replace(f"{{{param}}}", str(path_params[param]))
+    verb, resource = api_verb_and_resource(templated, method, header_params)
+    if query_params and ("watch", True) in list(query_params):
+        verb = "watch"
+    return verb, resource
+
+
+class InstrumentedApiClient(kubernetes.client.ApiClient):
+    """ApiClient recording count, status code and latency of every request"""
+
+    def call_api(self, resource_path, method, path_params=None, query_params=None, header_params=None, *args, **kwargs):
+        from kubernetes.client.exceptions import ApiException
+
+        verb, resource = request_verb_and_resource(resource_path, method, path_params, query_params, header_params)
+        started = time.monotonic()
+        code = "200"
         try:
-            core_v1_api.create_namespaced_secret(namespace=namespace, body=secret)
-            logger.info(f"Created anthropic-api-key secret in namespace {namespace}")
-        except kubernetes.client.exceptions.ApiException as e:
-            if e.status == 409:
-                logger.info(f"anthropic-api-key secret already exists in namespace {namespace}")
-            else:
-                raise
-    
-    if openai_key:
-        secret_data = {"OPENAI_API_KEY": base64.b64encode(openai_key.encode()).decode()}
-        secret = kubernetes.client.V1Secret(
-            metadata=kubernetes.client.V1ObjectMeta(name="openai-api-key"),
-            data=secret_data,
-            type="Opaque"
-        )
+            return super().call_api(resource_path, method, path_params, query_params, header_params, *args, **kwargs)
+        except ApiException as e:
+            code = str(e.status)
+            raise
+        except Exception:
+            code = "error"
+            raise
+        finally:
+            API_DURATION.observe(time.monotonic() - started, verb=verb, resource=resource)
+            API_REQUESTS.inc(verb=verb, resource=resource, code=code)
+
+
+class TokenBucket:
+    """Thread-safe token bucket: `rate` tokens per second, at most `burst` saved up"""
+
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        """Take a token, sleeping until one is available"""
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait = (1 - self.tokens) / self.rate
+            time.sleep(wait)
+
+
+def parse_rate(value):
+    """`qps/burst` of the KOPF_AGENT_API_RATE_* settings"""
+    rate, _, burst = value.partition("/")
+    return float(rate), float(burst or rate)
+
+
+VERB_CLASSES = {
+    "get": "read", "list": "read",
+    "create": "write", "update": "write", "patch": "write", "apply": "write",
+    "delete": "delete", "deletecollection": "delete",
+}
+API_RATE_LIMITS = {
+    verb_class: TokenBucket(*parse_rate(API_RATES[verb_class]))
+    for verb_class in ("read", "write", "delete")
+}
+RETRYABLE_STATUSES = (429, 500, 502, 503, 504)
+
+
+def retry_delay(attempt, error=None):
+    """Seconds to wait before another attempt: Retry-After when the apiserver
+    sends one (429 from API Priority and Fairness), else full-jitter
+    exponential backoff."""
+    retry_after = getattr(error, "headers", None) and error.headers.get("Retry-After")
+    if retry_after:
         try:
-            core_v1_api.create_namespaced_secret(namespace=namespace, body=secret)
-            logger.info(f"Created openai-api-key secret in namespace {namespace}")
-        except kubernetes.client.exceptions.ApiException as e:
-            if e.status == 409:
-                logger.info(f"openai-api-key secret already exists in namespace {namespace}")
-            else:
+            return float(retry_after) + random.uniform(0, API_RETRY_BASE)
+        except ValueError:
+            pass
+    return random.uniform(0, min(API_RETRY_CAP, API_RETRY_BASE * 2 ** attempt))
+
+
+class RateLimitedApiClient(InstrumentedApiClient):
+    """ApiClient sending every request through the shared per-verb-class token
+    buckets, and retrying throttled and failed requests
+
+    429s are always retried, since the apiserver rejected them before doing
+    anything. 5xx and connection errors are only retried for verbs that are
+    safe to repeat, so a create is never sent twice. Watches are not limited.
+    """
+
+    def call_api(self, resource_path, method, path_params=None, query_params=None, header_params=None, *args, **kwargs):
+        from kubernetes.client.exceptions import ApiException
+
+        verb, resource = request_verb_and_resource(resource_path, method, path_params, query_params, header_params)
+        bucket = API_RATE_LIMITS.get(VERB_CLASSES.get(verb))
+        attempt = 0
+        while True:
+            if bucket is not None:
+                bucket.acquire()
+            try:
+                return super().call_api(resource_path, method, path_params, query_params, header_params, *args, **kwargs)
+            except ApiException as e:
+                retryable = e.status == 429 or (e.status in RETRYABLE_STATUSES and verb != "create")
+                if not retryable or attempt >= API_RETRIES:
+                    raise
+                delay = retry_delay(attempt, e)
+            except urllib3.exceptions.HTTPError:
+                if verb == "create" or attempt >= API_RETRIES:
+                    raise
+                delay = retry_delay(attempt)
+            attempt += 1
+            API_RETRIES_TOTAL.inc(verb=verb, resource=resource)
+            time.sleep(delay)
+
+
+def instrumented(handler_name):
+    """Record duration, outcome, retries and concurrency of an async handler"""
+    def decorator(fn):
+        @functools.wraps(fn)
+        async def wrapper(*args, **kwargs):
+            if kwargs.get("retry"):
+                HANDLER_RETRIES.inc(handler=handler_name)
+            HANDLERS_IN_FLIGHT.inc(handler=handler_name)
+            started = time.monotonic()
+            outcome = "success"
+            try:
+                return await fn(*args, **kwargs)
+            except BaseException:
+                outcome = "error"
                 raise
+            finally:
+                HANDLERS_IN_FLIGHT.dec(handler=handler_name)
+                HANDLER_DURATION.observe(time.monotonic() - started, handler=handler_name, outcome=outcome)
+        return wrapper
+    return decorator
 
 
-@kopf.on.create("kopf.dev.claud-code", "v1", "claud-code")
-def create_claud_code_fn(body, name, namespace, logger, **kwargs):
-    logging.info(f"A handler is called with body: {body}")
-    metadata_name = body["metadata"]["name"]
-    agent_namespace = metadata_name  # Use agent name as namespace
-    logger.info(f"creating claud-code agent in namespace: {agent_namespace}")
-    metadata_system_prompt = body["system_prompt"]
-    mcp_config = body.get("mcp_config", {})
-    # Create namespace if it doesn't exist
-    core_v1_api = kubernetes.client.CoreV1Api()
-    rbac_v1_api = kubernetes.client.RbacAuthorizationV1Api()
+async def serve_metrics(request):
+    return aiohttp.web.Response(text=render_metrics(), content_type="text/plain", charset="utf-8")
 
+
+@kopf.on.startup()
+async def start_metrics_server(logger, memo, **kwargs):
+    if METRICS_PORT <= 0:
+        return
+    app = aiohttp.web.Application()
+    app.router.add_get("/metrics", serve_metrics)
+    memo.metrics_server = aiohttp.web.AppRunner(app, access_log=None)
+    await memo.metrics_server.setup()
+    await aiohttp.web.TCPSite(memo.metrics_server, port=METRICS_PORT).start()
+    logger.info(f"serving metrics on :{METRICS_PORT}/metrics")
+
+
+@kopf.on.cleanup()
+async def stop_metrics_server(memo, **kwargs):
+    runner = memo.get("metrics_server")
+    if runner is not None:
+        await runner.cleanup()
+
+
+def load_kube_config():
+    """Configure the kubernetes client in cluster, falling back to kubeconfig"""
     try:
-        agent_ns = kubernetes.client.V1Namespace(
-            metadata=kubernetes.client.V1ObjectMeta(name=agent_namespace)
-        )
-        core_v1_api.create_namespace(body=agent_ns)
-        logger.info(f"created namespace: {agent_namespace}")
-    except kubernetes.client.exceptions.ApiException as e:
-        if e.status != 409:  # AlreadyExists
-            raise
-        logger.info(f"namespace {agent_namespace} already exists")
-    
-    # Ensure API secrets exist in the agent namespace
-    ensure_api_secrets(agent_namespace, logger)
+        kubernetes.config.load_incluster_config()
+    except kubernetes.config.ConfigException:
+        kubernetes.config.load_kube_config()
 
-    # Create ServiceAccount for the agent
-    service_account = kubernetes.client.V1ServiceAccount(
-        metadata=kubernetes.client.V1ObjectMeta(
-            name=f"{metadata_name}-agent-sa", namespace=agent_namespace
-        )
+
+def build_api_client(configuration=None):
+    """Rate-limited, instrumented ApiClient with a connection pool sized for the API workers and TCP keep-alive"""
+    configuration = configuration or kubernetes.client.Configuration.get_default_copy()
+    configuration.connection_pool_maxsize = API_POOL_SIZE
+    # RateLimitedApiClient does the retrying, with backoff and metrics
+    configuration.retries = False
+    client = RateLimitedApiClient(configuration)
+    socket_options = list(urllib3.connection.HTTPConnection.default_socket_options)
+    socket_options.append((socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1))
+    if hasattr(socket, "TCP_KEEPIDLE"):
+        socket_options.append((socket.IPPROTO_TCP, socket.TCP_KEEPIDLE, API_KEEPALIVE_IDLE))
+        socket_options.append((socket.IPPROTO_TCP, socket.TCP_KEEPINTVL, API_KEEPALIVE_INTERVAL))
+    client.rest_client.pool_manager.connection_pool_kw["socket_options"] = socket_options
+    return client
+
+
+def api_client():
+    """The process-wide ApiClient shared by all handlers"""
+    global _api_client
+    if _api_client is None:
+        _api_client = build_api_client()
+    return _api_client
+
+
+def core_v1():
+    return kubernetes.client.CoreV1Api(api_client())
+
+
+def apps_v1():
+    return kubernetes.client.AppsV1Api(api_client())
+
+
+def rbac_v1():
+    return kubernetes.client.RbacAuthorizationV1Api(api_client())
+
+
+def networking_v1():
+    return kubernetes.client.NetworkingV1Api(api_client())
+
+
+def custom_objects():
+    return kubernetes.client.CustomObjectsApi(api_client())
+
+
+def discovery_v1():
+    return kubernetes.client.DiscoveryV1Api(api_client())
+
+
+def storage_v1():
+    return kubernetes.client.StorageV1Api(api_client())
+
+
+@kopf.on.startup()
+def configure_api_client(logger, **kwargs):
+    global _api_client
+    load_kube_config()
+    _api_client = build_api_client()
+    logger.info(f"shared ApiClient ready with {API_POOL_SIZE} pooled connections")
+
+
+@kopf.on.cleanup()
+def close_api_client(logger, **kwargs):
+    global _api_client
+    if _api_client is not None:
+        _api_client.rest_client.pool_manager.clear()
+        _api_client.close()
+        _api_client = None
+    _api_executor.shutdown(wait=False)
+
+
+# Every owned object is applied with server-side apply under this field manager.
+FIELD_MANAGER = "kopf-agent"
+APPLIED_HASH_ANNOTATION = "kopf-agent.dev/applied-hash"
+# Pod template annotation: hash of the configuration the agent reads at start.
+CONFIG_HASH_ANNOTATION = "kopf-agent.dev/config-hash"
+# Carried by the objects the operator creates for an agent, with the agent name as value.
+AGENT_LABEL = "kopf-agent.dev/agent"
+# Marks the agent ConfigMaps holding a system prompt (PROMPT_DELIVERY=file).
+PROMPT_LABEL = "kopf-agent.dev/prompt"
+
+# kind -> (API path prefix, plural, namespaced) for the objects the operator applies
+APPLY_PATHS = {
+    "Namespace": ("/api/v1", "namespaces", False),
+    "Secret": ("/api/v1", "secrets", True),
+    "ServiceAccount": ("/api/v1", "serviceaccounts", True),
+    "PersistentVolumeClaim": ("/api/v1", "persistentvolumeclaims", True),
+    "ConfigMap": ("/api/v1", "configmaps", True),
+    "Service": ("/api/v1", "services", True),
+    "Role": ("/apis/rbac.authorization.k8s.io/v1", "roles", True),
+    "RoleBinding": ("/apis/rbac.authorization.k8s.io/v1", "rolebindings", True),
+    "Deployment": ("/apis/apps/v1", "deployments", True),
+    "Ingress": ("/apis/networking.k8s.io/v1", "ingresses", True),
+    "HorizontalPodAutoscaler": ("/apis/autoscaling/v2", "horizontalpodautoscalers", True),
+    "EndpointSlice": ("/apis/discovery.k8s.io/v1", "endpointslices", True),
+    "DaemonSet": ("/apis/apps/v1", "daemonsets", True),
+    "ClaudCode": ("/apis/kopf.dev.claud-code/v1", "claud-code", True),
+    "Job": ("/apis/batch/v1", "jobs", True),
+    "CronJob": ("/apis/batch/v1", "cronjobs", True),
+    "ReferenceGrant": ("/apis/gateway.networking.k8s.io/v1beta1", "referencegrants", True),
+}
+
+# (secret name, key) of the API keys mounted into the agent
+API_KEY_SECRETS = (
+    ("anthropic-api-key", "ANTHROPIC_API_KEY"),
+    ("openai-api-key", "OPENAI_API_KEY"),
+)
+
+# (kind, namespace, name) -> hash of the manifest this process last applied
+_applied_hashes = {}
+
+
+def object_path(kind, obj_namespace, name):
+    prefix, plural, namespaced = APPLY_PATHS[kind]
+    return f"{prefix}/namespaces/{obj_namespace}/{plural}/{name}" if namespaced else f"{prefix}/{plural}/{name}"
+
+
+def manifest_hash(manifest):
+    """Stable hash of a serialized manifest, ignoring the applied-hash annotation"""
+    manifest = dict(manifest, metadata=dict(manifest["metadata"]))
+    annotations = dict(manifest["metadata"].get("annotations") or {})
+    annotations.pop(APPLIED_HASH_ANNOTATION, None)
+    manifest["metadata"]["annotations"] = annotations
+    encoded = json.dumps(manifest, sort_keys=True, separators=(",", ":"))
+    return hashlib.sha256(encoded.encode()).hexdigest()
+
+
+def apply_manifest(manifest, logger, cache=None):
+    """Server-side apply an object unless the same manifest was already applied
+
+    Kinds held by the informer indices are compared with the live object in
+    `cache` (see cached_objects); other kinds with what this process applied
+    last. Returns True when a request was sent, False when it was skipped.
+    """
+    obj = api_client().sanitize_for_serialization(manifest)
+    metadata = obj["metadata"]
+    kind, name, obj_namespace = obj["kind"], metadata["name"], metadata.get("namespace")
+    digest = manifest_hash(obj)
+    key = (kind, obj_namespace, name)
+    if cache is not None and kind in OWNED_INDICES:
+        live = cache.get((kind, name))
+        applied = live and (live["metadata"].get("annotations") or {}).get(APPLIED_HASH_ANNOTATION)
+    else:
+        applied = _applied_hashes.get(key)
+    if applied == digest:
+        _applied_hashes[key] = digest
+        logger.debug(f"{kind} {name} is up to date, skipping apply")
+        return False
+
+    metadata.setdefault("annotations", {})[APPLIED_HASH_ANNOTATION] = digest
+    api_client().call_api(
+        object_path(kind, obj_namespace, name),
+        "PATCH",
+        query_params=[("fieldManager", FIELD_MANAGER), ("force", "true")],
+        header_params={
+            "Accept": "application/json",
+            "Content-Type": "application/apply-patch+yaml",
+        },
+        body=obj,
+        auth_settings=["BearerToken"],
+        response_type="object",
+        _return_http_data_only=True,
+    )
+    _applied_hashes[key] = digest
+    logger.info(f"applied {kind} {name}")
+    return True
+
+
+def apply_manifests(manifests, logger, cache=None):
+    for manifest in manifests:
+        apply_manifest(manifest, logger, cache)
+
+
+def agent_labels(metadata_name):
+    return {"app.kubernetes.io/managed-by": FIELD_MANAGER, AGENT_LABEL: metadata_name}
+
+
+# In-memory informer cache: kopf watches the labelled objects of every agent
+# and keeps them in one index per kind, keyed by agent name, so handlers read
+# them from memory instead of the apiserver.
+OWNED_INDICES = {
+    "Deployment": "owned_deployments",
+    "Service": "owned_services",
+    "ConfigMap": "owned_configmaps",
+    "PersistentVolumeClaim": "owned_pvcs",
+    "Ingress": "owned_ingresses",
+}
+
+
+def cached_object(body):
+    """Copy of a watched object as kept in the informer indices"""
+    metadata = body["metadata"]
+    return copy.deepcopy({
+        "kind": body.get("kind"),
+        "metadata": {
+            "name": metadata.get("name"),
+            "namespace": metadata.get("namespace"),
+            "labels": dict(metadata.get("labels") or {}),
+            "annotations": dict(metadata.get("annotations") or {}),
+            "generation": metadata.get("generation"),
+        },
+        "spec": dict(body.get("spec") or {}),
+        "status": dict(body.get("status") or {}),
+    })
+
+
+@kopf.index("apps", "v1", "deployments", labels={AGENT_LABEL: kopf.PRESENT})
+def owned_deployments(body, labels, **kwargs):
+    return {labels[AGENT_LABEL]: cached_object(body)}
+
+
+@kopf.index("v1", "services", labels={AGENT_LABEL: kopf.PRESENT})
+def owned_services(body, labels, **kwargs):
+    return {labels[AGENT_LABEL]: cached_object(body)}
+
+
+@kopf.index("v1", "configmaps", labels={AGENT_LABEL: kopf.PRESENT})
+def owned_configmaps(body, labels, **kwargs):
+    # data and immutable are compared by the drift check (see drift_desired)
+    return {labels[AGENT_LABEL]: dict(
+        cached_object(body), data=dict(body.get("data") or {}), immutable=body.get("immutable"),
+    )}
+
+
+@kopf.index("v1", "persistentvolumeclaims", labels={AGENT_LABEL: kopf.PRESENT})
+def owned_pvcs(body, labels, **kwargs):
+    return {labels[AGENT_LABEL]: cached_object(body)}
+
+
+@kopf.index("networking.k8s.io", "v1", "ingresses", labels={AGENT_LABEL: kopf.PRESENT})
+def owned_ingresses(body, labels, **kwargs):
+    return {labels[AGENT_LABEL]: cached_object(body)}
+
+
+def cached_objects(metadata_name, indices):
+    """Owned objects of an agent from the informer indices, keyed by (kind, name)
+
+    `indices` are the handler kwargs. Returns None when the indices are not
+    available, e.g. when a handler is called outside of the operator.
+    """
+    if not all(index_name in indices for index_name in OWNED_INDICES.values()):
+        return None
+    objects = {}
+    for kind, index_name in OWNED_INDICES.items():
+        for obj in indices[index_name].get(metadata_name, ()):
+            objects[(kind, obj["metadata"]["name"])] = obj
+    return objects
+
+
+async def run_blocking(fn, *args, **kwargs):
+    """Run a blocking kubernetes client call on the API thread pool"""
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(
+        _api_executor, functools.partial(fn, *args, **kwargs)
     )
+
+
+async def run_provisioning_graph(steps, logger, concurrency=None, finished=None):
+    """Run provisioning steps as soon as their dependencies have finished
+
+    `steps` maps a step name to a `(dependencies, fn)` tuple, where `fn` is a
+    blocking callable and every dependency is declared before the steps that
+    need it. Independent steps run concurrently, at most `concurrency` at a
+    time (PROVISION_CONCURRENCY by default). Returns when each step finished,
+    in seconds since the graph started.
+
+    Steps already in `finished`, e.g. from an earlier attempt, are not run
+    again. The dict is filled in as steps finish, so after a failure it
+    holds every step that completed.
+    """
+    semaphore = asyncio.Semaphore(concurrency or PROVISION_CONCURRENCY)
+    tasks = {}
+    graph_started = time.monotonic()
+    finished = {} if finished is None else finished
+
+    async def run_step(step_name, deps, fn):
+        if step_name in finished:
+            return
+        if deps:
+            await asyncio.gather(*(tasks[dep] for dep in deps))
+        async with semaphore:
+            started = time.monotonic()
+            await run_blocking(fn)
+        finished[step_name] = time.monotonic() - graph_started
+        logger.debug(f"step {step_name} took {time.monotonic() - started:.3f}s")
+
+    for step_name, (deps, fn) in steps.items():
+        missing = [dep for dep in deps if dep not in tasks]
+        if missing:
+            raise ValueError(f"step {step_name} depends on undeclared steps: {missing}")
+        tasks[step_name] = asyncio.ensure_future(run_step(step_name, deps, fn))
+
     try:
-        core_v1_api.create_namespaced_service_account(
-            namespace=agent_namespace, body=service_account
+        await asyncio.gather(*tasks.values())
+    except BaseException:
+        for task in tasks.values():
+            task.cancel()
+        await asyncio.gather(*tasks.values(), return_exceptions=True)
+        raise
+    return finished
+
+
+AGENT_IMAGE = "wholelottahoopla/webagent"
+CODE_SERVER_IMAGE = "bencdr/code-server-deploy-container:latest"
+PLAYWRIGHT_IMAGE = "mcr.microsoft.com/playwright:v1.52.0-noble"
+PYPI_CACHE_IMAGE = "epicwink/proxpi:latest"
+NIX_CACHE_IMAGE = "nginx:1.27-alpine"
+# TCP proxy in each agent pod capping its sessions on the shared Playwright pool
+SESSION_LIMIT_IMAGE = "haproxy:3.0-alpine"
+# Static binary copied into the pre-pull pods, so images without a shell can idle,
+# and the shell of the containers seeding data volumes from a template
+BUSYBOX_IMAGE = "busybox:1.36"
+
+MANIFEST_MEDIA_TYPES = ", ".join((
+    "application/vnd.oci.image.index.v1+json",
+    "application/vnd.docker.distribution.manifest.list.v2+json",
+    "application/vnd.oci.image.manifest.v1+json",
+    "application/vnd.docker.distribution.manifest.v2+json",
+))
+
+# image reference -> (digest or None, monotonic time it was resolved)
+_image_digests = {}
+_registry_http = urllib3.PoolManager(timeout=urllib3.Timeout(total=5.0), retries=False)
+
+
+def parse_image(image):
+    """(registry host, repository, tag) of an image reference"""
+    name, _, tag = image.rpartition(":")
+    if not name or "/" in tag:
+        name, tag = image, "latest"
+    first, _, rest = name.partition("/")
+    if rest and ("." in first or ":" in first or first == "localhost"):
+        registry, repository = first, rest
+    else:
+        registry, repository = "registry-1.docker.io", name
+        if "/" not in repository:
+            repository = f"library/{repository}"
+    return registry, repository, tag
+
+
+def registry_token(challenge):
+    """Anonymous pull token for a `Bearer realm=...` challenge"""
+    params = dict(re.findall(r'(\w+)="([^"]*)"', challenge))
+    realm = params.pop("realm")
+    response = _registry_http.request("GET", realm, fields=params)
+    if response.status != 200:
+        raise RuntimeError(f"token request to {realm} returned {response.status}")
+    token = json.loads(response.data)
+    return token.get("token") or token.get("access_token")
+
+
+def fetch_image_digest(image):
+    """Digest the registry currently serves for an image tag"""
+    registry, repository, tag = parse_image(image)
+    url = f"https://{registry}/v2/{repository}/manifests/{tag}"
+    headers = {"Accept": MANIFEST_MEDIA_TYPES}
+    response = _registry_http.request("HEAD", url, headers=headers)
+    if response.status == 401:
+        headers["Authorization"] = f"Bearer {registry_token(response.headers['WWW-Authenticate'])}"
+        response = _registry_http.request("HEAD", url, headers=headers)
+    if response.status != 200:
+        raise RuntimeError(f"HEAD {url} returned {response.status}")
+    return response.headers["Docker-Content-Digest"]
+
+
+def resolve_images(images, logger, ttl=None):
+    """Resolve tags to digests, at most once per `ttl` (IMAGE_DIGEST_TTL) per image
+
+    Failures are cached too, so an unreachable registry costs one timeout
+    per TTL; those images stay on their tag and are pulled as before.
+    """
+    ttl = IMAGE_DIGEST_TTL if ttl is None else ttl
+    now = time.monotonic()
+    for image in images:
+        if "@" in image:
+            continue
+        cached = _image_digests.get(image)
+        if cached is not None and now - cached[1] < ttl:
+            continue
+        try:
+            digest = fetch_image_digest(image)
+            logger.info(f"resolved {image} to {digest}")
+        except Exception as e:
+            digest = cached[0] if cached else None
+            logger.warning(f"Failed to resolve {image}, keeping {digest or 'the tag'}: {e}")
+        _image_digests[image] = (digest, now)
+
+
+def pinned_image(image, digests=None):
+    """(image, pull policy): the digest of the tag with IfNotPresent when known
+
+    Agent objects pass the digests recorded in the agent's status (see
+    with_image_digests); shared objects use the ones this process resolved.
+    """
+    if "@" in image:
+        return image, "IfNotPresent"
+    if digests is None:
+        digest = (_image_digests.get(image) or (None,))[0]
+    else:
+        digest = digests.get(image)
+    if digest is None or not PIN_IMAGES:
+        return image, "Always"
+    return f"{image}@{digest}", "IfNotPresent"
+
+
+def agent_images(body):
+    """Images the rendered objects of a ClaudCode run (see render_agent)"""
+    images = [f"{AGENT_IMAGE}:{body.get('version', 'latest')}", CODE_SERVER_IMAGE]
+    if SHARED_PLAYWRIGHT:
+        images.append(SESSION_LIMIT_IMAGE)
+    elif not agent_stack(body).get("warm"):
+        images.append(PLAYWRIGHT_IMAGE)
+    if body.get("data_template"):
+        images.append(BUSYBOX_IMAGE)
+    return images
+
+
+# Changing this annotation on a ClaudCode resolves its image tags again.
+IMAGE_REFRESH_ANNOTATION = "kopf-agent.dev/refresh-images"
+
+
+def image_refresh_requested(body):
+    refresh = ((body.get("metadata") or {}).get("annotations") or {}).get(IMAGE_REFRESH_ANNOTATION)
+    return refresh != (body.get("status") or {}).get("imagesRefresh")
+
+
+def with_image_digests(body, patch, logger):
+    """Copy of a ClaudCode with the digests it runs its images by in status.images
+
+    Each tag is resolved once per agent and recorded, so pushing a new image
+    to a tag never rolls running agents. Only tags the agent has not run
+    before, such as those of a new version, are resolved, and every tag is
+    when the IMAGE_REFRESH_ANNOTATION changes.
+    """
+    status = body.get("status") or {}
+    if not PIN_IMAGES:
+        return body
+    images = agent_images(body)
+    refresh = image_refresh_requested(body)
+    recorded = {} if refresh else status.get("images") or {}
+    digests = {image: recorded[image] for image in images if image in recorded}
+    missing = [image for image in images if image not in digests]
+    if missing:
+        resolve_images(missing, logger, ttl=0 if refresh else None)
+        for image in missing:
+            digest = (_image_digests.get(image) or (None,))[0]
+            if digest is not None:
+                digests[image] = digest
+    if digests != status.get("images"):
+        patch.status["images"] = digests
+    if refresh:
+        patch.status["imagesRefresh"] = (body["metadata"].get("annotations") or {}).get(IMAGE_REFRESH_ANNOTATION)
+        logger.info(f"resolved the images of {body['metadata']['name']} again: {digests}")
+    return {**body, "status": {**status, "images": digests}}
+
+
+def build_namespace(agent_namespace, labels):
+    return kubernetes.client.V1Namespace(
+        api_version="v1",
+        kind="Namespace",
+        metadata=kubernetes.client.V1ObjectMeta(name=agent_namespace, labels=labels)
+    )
+
+
+def build_api_secrets(body, agent_namespace, logger):
+    """API key secrets, preferring keys from the ClaudCode `data` field over the operator env"""
+    metadata_name = body["metadata"]["name"]
+    data_field = body.get("data") or {}
+    secrets = []
+    for secret_name, key in API_KEY_SECRETS:
+        value = data_field.get(key) or os.getenv(key)
+        if not value:
+            logger.error(f"{key} is not set in data or the operator environment")
+            continue
+        secrets.append(kubernetes.client.V1Secret(
+            api_version="v1",
+            kind="Secret",
+            metadata=kubernetes.client.V1ObjectMeta(
+                name=secret_name, namespace=agent_namespace, labels=agent_labels(metadata_name)
+            ),
+            data={key: base64.b64encode(value.encode()).decode()},
+            type="Opaque"
+        ))
+    return secrets
+
+
+def build_service_account(stack_name, agent_namespace):
+    return kubernetes.client.V1ServiceAccount(
+        api_version="v1",
+        kind="ServiceAccount",
+        metadata=kubernetes.client.V1ObjectMeta(
+            name=f"{stack_name}-agent-sa",
+            namespace=agent_namespace,
+            labels=agent_labels(stack_name),
         )
-        logger.info(f"created service account: {metadata_name}-agent-sa")
-    except kubernetes.client.exceptions.ApiException as e:
-        if e.status != 409:
-            raise
-        logger.info(f"service account {metadata_name}-agent-sa already exists")
+    )
 
-    # Create Role with permissions to create services, deployments, and access data PV
-    role = kubernetes.client.V1Role(
+
+def build_role(stack_name, agent_namespace):
+    """Role with permissions to create services, deployments, and access data PV"""
+    return kubernetes.client.V1Role(
+        api_version="rbac.authorization.k8s.io/v1",
+        kind="Role",
         metadata=kubernetes.client.V1ObjectMeta(
-            name=f"{metadata_name}-agent-role", namespace=agent_namespace
+            name=f"{stack_name}-agent-role",
+            namespace=agent_namespace,
+            labels=agent_labels(stack_name),
         ),
         rules=[
             kubernetes.client.V1PolicyRule(
@@ -151,147 +984,212 @@ def create_claud_code_fn(body, name, namespace, logger, **kwargs):
             ),
         ],
     )
-    try:
-        rbac_v1_api.create_namespaced_role(namespace=agent_namespace, body=role)
-        logger.info(f"created role: {metadata_name}-agent-role")
-    except kubernetes.client.exceptions.ApiException as e:
-        if e.status != 409:
-            raise
-        logger.info(f"role {metadata_name}-agent-role already exists")
 
-    # Create RoleBinding
-    role_binding = kubernetes.client.V1RoleBinding(
+
+def build_role_binding(stack_name, agent_namespace):
+    return kubernetes.client.V1RoleBinding(
+        api_version="rbac.authorization.k8s.io/v1",
+        kind="RoleBinding",
         metadata=kubernetes.client.V1ObjectMeta(
-            name=f"{metadata_name}-agent-binding", namespace=agent_namespace
+            name=f"{stack_name}-agent-binding",
+            namespace=agent_namespace,
+            labels=agent_labels(stack_name),
         ),
         role_ref=kubernetes.client.V1RoleRef(
             api_group="rbac.authorization.k8s.io",
             kind="Role",
-            name=f"{metadata_name}-agent-role",
+            name=f"{stack_name}-agent-role",
         ),
         subjects=[
             RbacV1Subject(
                 kind="ServiceAccount",
-                name=f"{metadata_name}-agent-sa",
+                name=f"{stack_name}-agent-sa",
                 namespace=agent_namespace,
             )
         ],
     )
-    try:
-        rbac_v1_api.create_namespaced_role_binding(
-            namespace=agent_namespace, body=role_binding
-        )
-        logger.info(f"created role binding: {metadata_name}-agent-binding")
-    except kubernetes.client.exceptions.ApiException as e:
-        if e.status != 409:
-            raise
-        logger.info(f"role binding {metadata_name}-agent-binding already exists")
-    # create a deployment for wholelottahoopla/webagent:latest
-    # with metadata dir pvc
-    # and a data dir pvc
-    # and create a nginx deployment to serve the data dir
-    # also create a service for webagent
-    # Generate unique IDs for PVCs to avoid conflicts
-    unique_id = str(uuid.uuid4())[:8]  # Use first 8 chars of UUID
-    
-    # create PVCs first
-    metadata_pvc_name = f"{metadata_name}-metadata-{unique_id}"
-    data_pvc_name = f"{metadata_name}-data-{unique_id}"
-    
-    metadata_pvc = kubernetes.client.V1PersistentVolumeClaim(
-        metadata=kubernetes.client.V1ObjectMeta(name=metadata_pvc_name),
-        spec=kubernetes.client.V1PersistentVolumeClaimSpec(
-            access_modes=["ReadWriteOnce"],
-            resources=kubernetes.client.V1ResourceRequirements(
-                requests={"storage": "1Gi"}
-            ),
+
+
+def build_pvc(stack_name, pvc_name, agent_namespace, data_template=None, size="1Gi", storage_class=None):
+    """Agent volume, cloned from the PVC of `data_template` when one is given"""
+    return kubernetes.client.V1PersistentVolumeClaim(
+        api_version="v1",
+        kind="PersistentVolumeClaim",
+        metadata=kubernetes.client.V1ObjectMeta(
+            name=pvc_name, namespace=agent_namespace, labels=agent_labels(stack_name)
         ),
-    )
-    data_pvc = kubernetes.client.V1PersistentVolumeClaim(
-        metadata=kubernetes.client.V1ObjectMeta(name=data_pvc_name),
         spec=kubernetes.client.V1PersistentVolumeClaimSpec(
             access_modes=["ReadWriteOnce"],
+            storage_class_name=storage_class,
             resources=kubernetes.client.V1ResourceRequirements(
-                requests={"storage": "1Gi"}
+                requests={"storage": size}
             ),
+            data_source_ref=kubernetes.client.V1TypedObjectReference(
+                kind="PersistentVolumeClaim",
+                name=data_template_name(data_template),
+                namespace=SHARED_NAMESPACE,
+            ) if data_template else None,
         ),
     )
+
+
+def build_data_template_grant(metadata_name, data_template, agent_namespace):
+    """ReferenceGrant letting the PVCs of an agent namespace clone the template PVC"""
+    return {
+        "apiVersion": "gateway.networking.k8s.io/v1beta1",
+        "kind": "ReferenceGrant",
+        "metadata": {
+            "name": data_template_grant_name(data_template, agent_namespace),
+            "namespace": SHARED_NAMESPACE,
+            "labels": agent_labels(metadata_name),
+        },
+        "spec": {
+            "from": [{"group": "", "kind": "PersistentVolumeClaim", "namespace": agent_namespace}],
+            "to": [{"group": "", "kind": "PersistentVolumeClaim", "name": data_template_name(data_template)}],
+        },
+    }
+
+
+def data_template_grant_name(data_template, agent_namespace):
+    return f"{agent_namespace}-{data_template_name(data_template)}"
+
+
+def delete_data_template_grant(data_template, agent_namespace, logger):
+    from kubernetes.client.exceptions import ApiException
+
+    grant_name = data_template_grant_name(data_template, agent_namespace)
     try:
-        core_v1_api.create_namespaced_persistent_volume_claim(
-            body=metadata_pvc, namespace=agent_namespace
-        )
-    except kubernetes.client.exceptions.ApiException as e:
-        if e.status != 409:
-            raise
-    try:
-        core_v1_api.create_namespaced_persistent_volume_claim(
-            body=data_pvc, namespace=agent_namespace
+        custom_objects().delete_namespaced_custom_object(
+            "gateway.networking.k8s.io", "v1beta1", SHARED_NAMESPACE, "referencegrants", grant_name,
         )
-    except kubernetes.client.exceptions.ApiException as e:
-        if e.status != 409:
+    except ApiException as e:
+        if e.status != 404:
             raise
-    logger.info("created PVCs")
-    
-    # Create MCP config ConfigMap
-    logger.info("creating mcp config configmap")
-    import json
-    mcp_config_name = f"{metadata_name}-mcp-config"
-    mcp_config_json = json.dumps(mcp_config, indent=2)
-    mcp_configmap = kubernetes.client.V1ConfigMap(
-        metadata=kubernetes.client.V1ObjectMeta(name=mcp_config_name),
-        data={"mcp.json": mcp_config_json},
+    logger.info(f"deleted reference grant {grant_name}")
+
+
+def data_template_name(data_template):
+    """Name of the PVC, server and refresh jobs of a data template"""
+    return f"{data_template}-template"
+
+
+# Fills an empty data volume from the template server, retrying while the
+# template is being built. Volumes already in use are never touched.
+SEED_SCRIPT = """set -o pipefail
+if [ -e /data/output/.template ] || [ -n "$(ls -A /data/output | grep -v '^lost+found$')" ]; then
+  exit 0
+fi
+for attempt in 1 2 3 4 5 6; do
+  wget -qO- "$TEMPLATE_URL" | tar -xzf - -C /data/output && exit 0
+  sleep 10
+done
+echo "data template at $TEMPLATE_URL is unavailable, starting with an empty volume"
+"""
+
+
+def build_seed_container(data_template, images=None):
+    """Init container copying a data template into a new agent's data volume"""
+    image, image_pull_policy = pinned_image(BUSYBOX_IMAGE, images)
+    return kubernetes.client.V1Container(
+        name="seed-data",
+        image=image,
+        image_pull_policy=image_pull_policy,
+        command=["sh", "-c", SEED_SCRIPT],
+        env=[kubernetes.client.V1EnvVar(
+            name="TEMPLATE_URL",
+            value=f"http://{data_template_name(data_template)}.{SHARED_NAMESPACE}.svc:8080/cgi-bin/seed",
+        )],
+        volume_mounts=[kubernetes.client.V1VolumeMount(name="data-volume", mount_path="/data/output")],
     )
-    try:
-        core_v1_api.create_namespaced_config_map(
-            namespace=agent_namespace, body=mcp_configmap
-        )
-    except kubernetes.client.exceptions.ApiException as e:
-        if e.status == 409:  # AlreadyExists
-            core_v1_api.replace_namespaced_config_map(
-                name=mcp_config_name, namespace=agent_namespace, body=mcp_configmap
+
+
+def mcp_config_json(mcp_config):
+    return json.dumps(mcp_config, indent=2)
+
+
+def build_mcp_configmap(metadata_name, agent_namespace, mcp_config):
+    return kubernetes.client.V1ConfigMap(
+        api_version="v1",
+        kind="ConfigMap",
+        metadata=kubernetes.client.V1ObjectMeta(
+            name=f"{metadata_name}-mcp-config",
+            namespace=agent_namespace,
+            labels=agent_labels(metadata_name),
+        ),
+        data={"mcp.json": mcp_config_json(mcp_config)},
+    )
+
+
+def prompt_configmap_name(metadata_name, system_prompt):
+    digest = hashlib.sha256(system_prompt.encode()).hexdigest()
+    return f"{metadata_name}-prompt-{digest[:10]}"
+
+
+def build_prompt_configmap(metadata_name, agent_namespace, system_prompt):
+    """Immutable ConfigMap holding one system prompt, named after its content"""
+    return kubernetes.client.V1ConfigMap(
+        api_version="v1",
+        kind="ConfigMap",
+        metadata=kubernetes.client.V1ObjectMeta(
+            name=prompt_configmap_name(metadata_name, system_prompt),
+            namespace=agent_namespace,
+            labels={**agent_labels(metadata_name), PROMPT_LABEL: "true"},
+        ),
+        data={"system-prompt.txt": system_prompt},
+        immutable=True,
+    )
+
+
+def build_playwright_container(max_clients=None, resources=None, images=None):
+    command = "npx -y playwright@1.52.0 run-server --port 3000 --host 0.0.0.0"
+    if max_clients:
+        command += f" --max-clients {max_clients}"
+    image, image_pull_policy = pinned_image(PLAYWRIGHT_IMAGE, images)
+    return kubernetes.client.V1Container(
+        name="playwright-server",
+        image=image,
+        image_pull_policy=image_pull_policy,
+        command=["/bin/sh"],
+        args=["-c", command],
+        ports=[
+            kubernetes.client.V1ContainerPort(
+                name="playwright", container_port=3000
             )
-        else:
-            raise
-    logger.info("created mcp config configmap")
-    
-    # Create Playwright server deployment
-    logger.info("creating playwright server deployment")
-    playwright_deployment = kubernetes.client.V1Deployment(
-        metadata=kubernetes.client.V1ObjectMeta(name=f"{metadata_name}-playwright-server"),
-        spec=kubernetes.client.V1DeploymentSpec(
-            replicas=1,
-            selector=kubernetes.client.V1LabelSelector(
-                match_labels={"app": f"{metadata_name}-playwright-server"}
+        ],
+        env=[
+            kubernetes.client.V1EnvVar(
+                name="PWUSER_UID", value="1000"
             ),
-            template=kubernetes.client.V1PodTemplateSpec(
-                metadata=kubernetes.client.V1ObjectMeta(labels={"app": f"{metadata_name}-playwright-server"}),
-                spec=kubernetes.client.V1PodSpec(
-                    containers=[
-                        kubernetes.client.V1Container(
-                            name="playwright-server",
-                            image="mcr.microsoft.com/playwright:v1.52.0-noble",
-                            image_pull_policy="Always",
-                            command=["/bin/sh"],
-                            args=["-c", "npx -y playwright@1.52.0 run-server --port 3000 --host 0.0.0.0"],
-                            ports=[
-                                kubernetes.client.V1ContainerPort(
-                                    name="playwright", container_port=3000
-                                )
-                            ],
-                            env=[
-                                kubernetes.client.V1EnvVar(
-                                    name="PWUSER_UID", value="1000"
-                                ),
-                                kubernetes.client.V1EnvVar(
-                                    name="PWUSER_GID", value="1000"
-                                ),
-                            ],
-                            security_context=kubernetes.client.V1SecurityContext(
-                                run_as_user=1000,
-                                run_as_group=1000,
-                            )
-                        )
-                    ],
+            kubernetes.client.V1EnvVar(
+                name="PWUSER_GID", value="1000"
+            ),
+        ],
+        security_context=kubernetes.client.V1SecurityContext(
+            run_as_user=1000,
+            run_as_group=1000,
+        ),
+        resources=resources,
+    )
+
+
+def build_playwright_deployment(stack_name, agent_namespace, resources=None, replicas=1, images=None):
+    return kubernetes.client.V1Deployment(
+        api_version="apps/v1",
+        kind="Deployment",
+        metadata=kubernetes.client.V1ObjectMeta(
+            name=f"{stack_name}-playwright-server",
+            namespace=agent_namespace,
+            labels=agent_labels(stack_name),
+        ),
+        spec=kubernetes.client.V1DeploymentSpec(
+            replicas=replicas,
+            selector=kubernetes.client.V1LabelSelector(
+                match_labels={"app": f"{stack_name}-playwright-server"}
+            ),
+            template=kubernetes.client.V1PodTemplateSpec(
+                metadata=kubernetes.client.V1ObjectMeta(labels={"app": f"{stack_name}-playwright-server"}),
+                spec=kubernetes.client.V1PodSpec(
+                    containers=[build_playwright_container(resources=resources, images=images)],
                     security_context=kubernetes.client.V1PodSecurityContext(
                         run_as_user=1000,
                         run_as_group=1000,
@@ -300,24 +1198,150 @@ def create_claud_code_fn(body, name, namespace, logger, **kwargs):
             ),
         ),
     )
-    try:
-        kubernetes.client.AppsV1Api().create_namespaced_deployment(
-            body=playwright_deployment, namespace=agent_namespace
+
+
+def build_playwright_service(stack_name, agent_namespace):
+    return kubernetes.client.V1Service(
+        api_version="v1",
+        kind="Service",
+        metadata=kubernetes.client.V1ObjectMeta(
+            name="playwright-server",
+            namespace=agent_namespace,
+            labels=agent_labels(stack_name),
+        ),
+        spec=kubernetes.client.V1ServiceSpec(
+            selector={"app": f"{stack_name}-playwright-server"},
+            ports=[
+                kubernetes.client.V1ServicePort(
+                    name="playwright",
+                    port=3000,
+                    target_port=3000,
+                    protocol="TCP"
+                )
+            ]
         )
-        logger.info("created playwright server deployment")
-    except kubernetes.client.exceptions.ApiException as e:
-        if e.status != 409:
-            raise
-        logger.info(f"playwright server deployment already exists")
+    )
+
+
+SESSION_LIMIT_PORT = 3001
+SESSION_LIMIT_CONFIG = """resolvers cluster
+  parse-resolv-conf
+defaults
+  mode tcp
+  timeout connect 5s
+  timeout client 1h
+  timeout server 1h
+  timeout queue 1h
+frontend playwright
+  bind :{port}
+  maxconn {sessions}
+  default_backend pool
+backend pool
+  server pool {pool}:3000 resolvers cluster init-addr last,libc,none
+"""
+
 
-    # Create Playwright server service
-    playwright_service = kubernetes.client.V1Service(
+def build_session_limit_container(images=None):
+    """Proxy to the shared Playwright pool admitting PLAYWRIGHT_SESSIONS_PER_AGENT connections
+
+    Further connections wait in the listen queue until a session ends, so one
+    agent cannot take a whole pool pod's --max-clients.
+    """
+    image, pull_policy = pinned_image(SESSION_LIMIT_IMAGE, images)
+    config = SESSION_LIMIT_CONFIG.format(
+        sessions=PLAYWRIGHT_SESSIONS_PER_AGENT,
+        port=SESSION_LIMIT_PORT,
+        pool=f"playwright-pool.{SHARED_NAMESPACE}.svc.cluster.local",
+    )
+    return kubernetes.client.V1Container(
+        name="playwright-session-limit",
+        image=image,
+        image_pull_policy=pull_policy,
+        command=["sh", "-c", 'printf "%s" "$HAPROXY_CONFIG" > /tmp/haproxy.cfg && exec haproxy -f /tmp/haproxy.cfg'],
+        env=[kubernetes.client.V1EnvVar(name="HAPROXY_CONFIG", value=config)],
+        ports=[
+            kubernetes.client.V1ContainerPort(
+                name="playwright", container_port=SESSION_LIMIT_PORT
+            )
+        ],
+        resources=kubernetes.client.V1ResourceRequirements(
+            requests={"cpu": "10m", "memory": "16Mi"}, limits={"memory": "64Mi"},
+        ),
+    )
+
+
+def build_session_limit_service(metadata_name, agent_namespace):
+    """playwright-server Service of an agent, pointing at its session-limiting proxy"""
+    return kubernetes.client.V1Service(
+        api_version="v1",
+        kind="Service",
         metadata=kubernetes.client.V1ObjectMeta(
             name="playwright-server",
-            namespace=agent_namespace
+            namespace=agent_namespace,
+            labels=agent_labels(metadata_name),
+        ),
+        spec=kubernetes.client.V1ServiceSpec(
+            type="ClusterIP",
+            selector={"app": metadata_name},
+            ports=[
+                kubernetes.client.V1ServicePort(
+                    name="playwright",
+                    port=3000,
+                    target_port=SESSION_LIMIT_PORT,
+                    protocol="TCP"
+                )
+            ]
+        )
+    )
+
+
+def shared_labels():
+    return {"app.kubernetes.io/managed-by": FIELD_MANAGER}
+
+
+def build_playwright_pool_deployment(shared_namespace):
+    container = build_playwright_container(PLAYWRIGHT_SESSIONS_PER_POD)
+    # The HPA measures CPU utilization against the request
+    container.resources = kubernetes.client.V1ResourceRequirements(
+        requests={"cpu": "1", "memory": "2Gi"},
+    )
+    return kubernetes.client.V1Deployment(
+        api_version="apps/v1",
+        kind="Deployment",
+        metadata=kubernetes.client.V1ObjectMeta(
+            name="playwright-pool",
+            namespace=shared_namespace,
+            labels=shared_labels(),
+        ),
+        spec=kubernetes.client.V1DeploymentSpec(
+            selector=kubernetes.client.V1LabelSelector(
+                match_labels={"app": "playwright-pool"}
+            ),
+            template=kubernetes.client.V1PodTemplateSpec(
+                metadata=kubernetes.client.V1ObjectMeta(labels={"app": "playwright-pool"}),
+                spec=kubernetes.client.V1PodSpec(
+                    containers=[container],
+                    security_context=kubernetes.client.V1PodSecurityContext(
+                        run_as_user=1000,
+                        run_as_group=1000,
+                    )
+                ),
+            ),
+        ),
+    )
+
+
+def build_playwright_pool_service(shared_namespace):
+    return kubernetes.client.V1Service(
+        api_version="v1",
+        kind="Service",
+        metadata=kubernetes.client.V1ObjectMeta(
+            name="playwright-pool",
+            namespace=shared_namespace,
+            labels=shared_labels(),
         ),
         spec=kubernetes.client.V1ServiceSpec(
-            selector={"app": f"{metadata_name}-playwright-server"},
+            selector={"app": "playwright-pool"},
             ports=[
                 kubernetes.client.V1ServicePort(
                     name="playwright",
@@ -328,36 +1352,464 @@ def create_claud_code_fn(body, name, namespace, logger, **kwargs):
             ]
         )
     )
-    
-    try:
-        core_v1_api.create_namespaced_service(
-            namespace=agent_namespace, body=playwright_service
+
+
+def build_playwright_pool_hpa(shared_namespace, min_replicas):
+    """Scale the pool on CPU, never below what the current agents have reserved"""
+    return kubernetes.client.V2HorizontalPodAutoscaler(
+        api_version="autoscaling/v2",
+        kind="HorizontalPodAutoscaler",
+        metadata=kubernetes.client.V1ObjectMeta(
+            name="playwright-pool",
+            namespace=shared_namespace,
+            labels=shared_labels(),
+        ),
+        spec=kubernetes.client.V2HorizontalPodAutoscalerSpec(
+            scale_target_ref=kubernetes.client.V2CrossVersionObjectReference(
+                api_version="apps/v1", kind="Deployment", name="playwright-pool",
+            ),
+            min_replicas=min_replicas,
+            max_replicas=max(min_replicas, PLAYWRIGHT_MAX_REPLICAS),
+            metrics=[
+                kubernetes.client.V2MetricSpec(
+                    type="Resource",
+                    resource=kubernetes.client.V2ResourceMetricSource(
+                        name="cpu",
+                        target=kubernetes.client.V2MetricTarget(
+                            type="Utilization", average_utilization=70,
+                        ),
+                    ),
+                ),
+            ],
+        ),
+    )
+
+
+def build_prepull_daemonset(shared_namespace, images):
+    """DaemonSet keeping `images` pulled on every node
+
+    Each image runs a copy of busybox's sleep from an emptyDir, so it needs
+    neither a shell nor its own entrypoint to stay up at a few MiB.
+    """
+    sleep_image, sleep_pull_policy = pinned_image(BUSYBOX_IMAGE)
+    tiny = kubernetes.client.V1ResourceRequirements(
+        requests={"cpu": "1m", "memory": "8Mi"}, limits={"memory": "16Mi"},
+    )
+    containers = []
+    for index, image in enumerate(images):
+        image, image_pull_policy = pinned_image(image)
+        containers.append(kubernetes.client.V1Container(
+            name=f"image-{index}",
+            image=image,
+            image_pull_policy=image_pull_policy,
+            command=["/prepull/sleep", "2147483647"],
+            volume_mounts=[kubernetes.client.V1VolumeMount(name="prepull", mount_path="/prepull")],
+            resources=tiny,
+        ))
+    return kubernetes.client.V1DaemonSet(
+        api_version="apps/v1",
+        kind="DaemonSet",
+        metadata=kubernetes.client.V1ObjectMeta(
+            name="image-prepull",
+            namespace=shared_namespace,
+            labels=shared_labels(),
+        ),
+        spec=kubernetes.client.V1DaemonSetSpec(
+            selector=kubernetes.client.V1LabelSelector(
+                match_labels={"app": "image-prepull"}
+            ),
+            template=kubernetes.client.V1PodTemplateSpec(
+                metadata=kubernetes.client.V1ObjectMeta(labels={"app": "image-prepull"}),
+                spec=kubernetes.client.V1PodSpec(
+                    init_containers=[
+                        kubernetes.client.V1Container(
+                            name="copy-sleep",
+                            image=sleep_image,
+                            image_pull_policy=sleep_pull_policy,
+                            command=["cp", "/bin/busybox", "/prepull/sleep"],
+                            volume_mounts=[kubernetes.client.V1VolumeMount(name="prepull", mount_path="/prepull")],
+                            resources=tiny,
+                        ),
+                    ],
+                    containers=containers,
+                    volumes=[
+                        kubernetes.client.V1Volume(
+                            name="prepull",
+                            empty_dir=kubernetes.client.V1EmptyDirVolumeSource(),
+                        ),
+                    ],
+                    termination_grace_period_seconds=0,
+                ),
+            ),
+        ),
+    )
+
+
+NIX_UPSTREAM = "https://cache.nixos.org"
+NIX_UPSTREAM_KEY = "cache.nixos.org-1:6NCHdD59X431o0gWypbMrAURkbJ16ZPMQFGspcDShjY="
+
+
+def package_cache_env():
+    """Environment pointing pip, uv and nix at the shared package caches"""
+    if not PACKAGE_CACHE:
+        return []
+    pypi_host = f"pypi-cache.{SHARED_NAMESPACE}.svc"
+    return [
+        kubernetes.client.V1EnvVar(name="PIP_INDEX_URL", value=f"http://{pypi_host}:5000/index/"),
+        kubernetes.client.V1EnvVar(name="PIP_TRUSTED_HOST", value=pypi_host),
+        kubernetes.client.V1EnvVar(name="UV_DEFAULT_INDEX", value=f"http://{pypi_host}:5000/index/"),
+        kubernetes.client.V1EnvVar(
+            name="NIX_CONFIG",
+            value=f"substituters = http://nix-cache.{SHARED_NAMESPACE}.svc:8080 {NIX_UPSTREAM}\n"
+            f"trusted-public-keys = {NIX_UPSTREAM_KEY}",
+        ),
+    ]
+
+
+def build_package_cache(shared_namespace, cache_name, image, port, env=None, config=None):
+    """PVC, Deployment and Service of one package cache, plus its config files when given
+
+    `config` maps file names to contents mounted at /etc/nginx/conf.d.
+    """
+    labels = dict(shared_labels(), app=cache_name)
+    image, image_pull_policy = pinned_image(image)
+    volume_mounts = [kubernetes.client.V1VolumeMount(name="cache", mount_path="/var/cache/packages")]
+    volumes = [
+        kubernetes.client.V1Volume(
+            name="cache",
+            persistent_volume_claim=kubernetes.client.V1PersistentVolumeClaimVolumeSource(claim_name=cache_name),
+        ),
+    ]
+    manifests = []
+    if config:
+        volume_mounts.append(kubernetes.client.V1VolumeMount(name="config", mount_path="/etc/nginx/conf.d"))
+        volumes.append(kubernetes.client.V1Volume(
+            name="config",
+            config_map=kubernetes.client.V1ConfigMapVolumeSource(name=cache_name),
+        ))
+        manifests.append(kubernetes.client.V1ConfigMap(
+            api_version="v1",
+            kind="ConfigMap",
+            metadata=kubernetes.client.V1ObjectMeta(name=cache_name, namespace=shared_namespace, labels=shared_labels()),
+            data=config,
+        ))
+    manifests += [
+        kubernetes.client.V1PersistentVolumeClaim(
+            api_version="v1",
+            kind="PersistentVolumeClaim",
+            metadata=kubernetes.client.V1ObjectMeta(name=cache_name, namespace=shared_namespace, labels=shared_labels()),
+            spec=kubernetes.client.V1PersistentVolumeClaimSpec(
+                access_modes=["ReadWriteOnce"],
+                resources=kubernetes.client.V1ResourceRequirements(
+                    requests={"storage": f"{PACKAGE_CACHE_SIZE_GB}Gi"}
+                ),
+            ),
+        ),
+        kubernetes.client.V1Deployment(
+            api_version="apps/v1",
+            kind="Deployment",
+            metadata=kubernetes.client.V1ObjectMeta(name=cache_name, namespace=shared_namespace, labels=shared_labels()),
+            spec=kubernetes.client.V1DeploymentSpec(
+                replicas=1,
+                # The cache PVC is ReadWriteOnce
+                strategy=kubernetes.client.V1DeploymentStrategy(type="Recreate"),
+                selector=kubernetes.client.V1LabelSelector(match_labels=labels),
+                template=kubernetes.client.V1PodTemplateSpec(
+                    metadata=kubernetes.client.V1ObjectMeta(labels=labels),
+                    spec=kubernetes.client.V1PodSpec(
+                        containers=[
+                            kubernetes.client.V1Container(
+                                name=cache_name,
+                                image=image,
+                                image_pull_policy=image_pull_policy,
+                                env=env,
+                                ports=[kubernetes.client.V1ContainerPort(name="http", container_port=port)],
+                                volume_mounts=volume_mounts,
+                                resources=kubernetes.client.V1ResourceRequirements(
+                                    requests={"cpu": "50m", "memory": "128Mi"},
+                                    limits={"memory": "512Mi"},
+                                ),
+                            ),
+                        ],
+                        volumes=volumes,
+                    ),
+                ),
+            ),
+        ),
+        kubernetes.client.V1Service(
+            api_version="v1",
+            kind="Service",
+            metadata=kubernetes.client.V1ObjectMeta(name=cache_name, namespace=shared_namespace, labels=shared_labels()),
+            spec=kubernetes.client.V1ServiceSpec(
+                selector=labels,
+                ports=[kubernetes.client.V1ServicePort(name="http", port=port, target_port=port)],
+            ),
+        ),
+    ]
+    return manifests
+
+
+def build_package_caches(shared_namespace):
+    """proxpi for PyPI and an nginx proxy_cache in front of the nix binary cache"""
+    # Leave a tenth of each PVC for the caches' own bookkeeping
+    cache_bytes = PACKAGE_CACHE_SIZE_GB * 2**30 * 9 // 10
+    nix_conf = f"""proxy_cache_path /var/cache/packages levels=1:2 keys_zone=nix:32m max_size={cache_bytes // 2**20}m inactive=90d use_temp_path=off;
+
+server {{
+    listen 8080;
+    location / {{
+        proxy_pass {NIX_UPSTREAM};
+        proxy_set_header Host {NIX_UPSTREAM.removeprefix("https://")};
+        proxy_ssl_server_name on;
+        proxy_cache nix;
+        proxy_cache_valid 200 90d;
+        proxy_cache_valid 404 1m;
+        proxy_cache_lock on;
+        proxy_cache_use_stale error timeout updating;
+    }}
+}}
+"""
+    return build_package_cache(
+        shared_namespace, "pypi-cache", PYPI_CACHE_IMAGE, 5000,
+        env=[
+            kubernetes.client.V1EnvVar(name="PROXPI_CACHE_DIR", value="/var/cache/packages"),
+            kubernetes.client.V1EnvVar(name="PROXPI_CACHE_SIZE", value=str(cache_bytes)),
+        ],
+    ) + build_package_cache(
+        shared_namespace, "nix-cache", NIX_CACHE_IMAGE, 8080, config={"default.conf": nix_conf},
+    )
+
+
+def playwright_pool_replicas(agents):
+    """Pool pods needed to give every agent its reserved browser sessions"""
+    sessions = agents * PLAYWRIGHT_SESSIONS_PER_AGENT
+    replicas = -(-sessions // PLAYWRIGHT_SESSIONS_PER_POD)
+    return min(max(replicas, 1), PLAYWRIGHT_MAX_REPLICAS)
+
+
+# Requests and limits per container of each `size` a ClaudCode can ask for.
+# The `resources` field overrides them per container.
+SIZE_PROFILES = {
+    "small": {
+        "agent": {"requests": {"cpu": "250m", "memory": "512Mi"}, "limits": {"cpu": "1", "memory": "2Gi"}},
+        "code_server": {"requests": {"cpu": "100m", "memory": "256Mi"}, "limits": {"cpu": "500m", "memory": "1Gi"}},
+        "playwright": {"requests": {"cpu": "250m", "memory": "512Mi"}, "limits": {"cpu": "1", "memory": "2Gi"}},
+    },
+    "medium": {
+        "agent": {"requests": {"cpu": "500m", "memory": "1Gi"}, "limits": {"cpu": "2", "memory": "4Gi"}},
+        "code_server": {"requests": {"cpu": "250m", "memory": "512Mi"}, "limits": {"cpu": "1", "memory": "2Gi"}},
+        "playwright": {"requests": {"cpu": "500m", "memory": "1Gi"}, "limits": {"cpu": "2", "memory": "4Gi"}},
+    },
+    "large": {
+        "agent": {"requests": {"cpu": "1", "memory": "2Gi"}, "limits": {"cpu": "4", "memory": "8Gi"}},
+        "code_server": {"requests": {"cpu": "500m", "memory": "1Gi"}, "limits": {"cpu": "2", "memory": "4Gi"}},
+        "playwright": {"requests": {"cpu": "1", "memory": "2Gi"}, "limits": {"cpu": "4", "memory": "8Gi"}},
+    },
+}
+
+
+def container_resources(body):
+    """Resource requirements of the agent, code_server and playwright containers
+
+    Starts from the `size` profile and merges the `resources` overrides of a
+    container into its requests and limits.
+    """
+    size = body.get("size") or DEFAULT_SIZE
+    if size not in SIZE_PROFILES:
+        raise kopf.PermanentError(f"unknown size {size!r}, expected one of {sorted(SIZE_PROFILES)}")
+    overrides = body.get("resources") or {}
+    resources = {}
+    for container, profile in SIZE_PROFILES[size].items():
+        override = overrides.get(container) or {}
+        resources[container] = kubernetes.client.V1ResourceRequirements(
+            requests={**profile["requests"], **(override.get("requests") or {})},
+            limits={**profile["limits"], **(override.get("limits") or {})},
         )
-        logger.info(f"created playwright server service")
-    except kubernetes.client.exceptions.ApiException as e:
-        if e.status != 409:
-            raise
-        logger.info(f"playwright server service already exists")
-        
-        
-    version = body.get("version", "latest")
+    return resources
+
+
+TMP_MEDIA = ("pvc", "memory", "disk")
+
+
+def volume_settings(body):
+    """Size and storage class of the data and metadata PVCs, and how /tmp is backed
+
+    The storage class of a PVC cannot change, so once an agent has PVCs the
+    classes recorded in status.storage_classes at creation are used; agents
+    created before that record keep the default class. PVCs cannot shrink
+    either, so sizes are at least those last applied (status.volume_sizes);
+    check_volume_sizes refuses the edit that asks for less.
+    """
+    spec = body.get("volumes") or {}
+    status = body.get("status") or {}
+    recorded = status.get("storage_classes") or {}
+    sizes = status.get("volume_sizes") or {}
+    settings = {}
+    for volume in ("data", "metadata"):
+        requested = spec.get(volume) or {}
+        settings[volume] = {
+            "size": max_quantity(requested.get("size", "1Gi"), sizes.get(volume) or "0"),
+            "storage_class": recorded.get(volume) if status.get("pvcs") else requested.get("storage_class"),
+        }
+    tmp = spec.get("tmp") or {}
+    settings["tmp"] = {
+        "medium": tmp.get("medium", "pvc"),
+        "size": tmp.get("size", "1Gi"),
+        "storage_class": tmp.get("storage_class"),
+    }
+    if settings["tmp"]["medium"] not in TMP_MEDIA:
+        raise kopf.PermanentError(f"unknown tmp medium {settings['tmp']['medium']!r}, expected one of {list(TMP_MEDIA)}")
+    return settings
+
+
+def build_tmp_volume(tmp):
+    """/tmp as an ephemeral PVC, or an emptyDir in memory or on the node's disk capped at `size`"""
+    if tmp["medium"] == "pvc":
+        return kubernetes.client.V1Volume(
+            name="tmp-volume",
+            ephemeral=kubernetes.client.V1EphemeralVolumeSource(
+                volume_claim_template=kubernetes.client.V1PersistentVolumeClaimTemplate(
+                    spec=kubernetes.client.V1PersistentVolumeClaimSpec(
+                        access_modes=["ReadWriteOnce"],
+                        storage_class_name=tmp["storage_class"],
+                        resources=kubernetes.client.V1ResourceRequirements(
+                            requests={"storage": tmp["size"]}
+                        ),
+                    )
+                )
+            ),
+        )
+    return kubernetes.client.V1Volume(
+        name="tmp-volume",
+        empty_dir=kubernetes.client.V1EmptyDirVolumeSource(
+            medium="Memory" if tmp["medium"] == "memory" else None,
+            size_limit=tmp["size"],
+        ),
+    )
+
+
+def max_quantity(*quantities):
+    return max(quantities, key=kubernetes.utils.parse_quantity)
+
+
+def default_class_expands():
+    """Whether PVCs of the default storage class can grow in place"""
+    for storage_class in storage_v1().list_storage_class().items:
+        annotations = storage_class.metadata.annotations or {}
+        if annotations.get("storageclass.kubernetes.io/is-default-class") == "true":
+            return bool(storage_class.allow_volume_expansion)
+    return False
+
+
+def fits_warm_stack(volumes):
+    """Whether the default-class PVCs of a warm stack can serve these volumes
+
+    They are created at the default sizes, and can only grow to larger ones
+    when the default class allows expansion.
+    """
+    if any(volumes[volume]["storage_class"] for volume in ("data", "metadata")):
+        return False
+    warm = volume_settings({})
+    if all(
+        kubernetes.utils.parse_quantity(volumes[volume]["size"])
+        <= kubernetes.utils.parse_quantity(warm[volume]["size"])
+        for volume in ("data", "metadata")
+    ):
+        return True
+    return default_class_expands()
+
+
+def check_volume_sizes(body, pvc_names, cache, logger):
+    """Refuse PVC sizes below the current ones; larger ones are expanded online by the apply"""
+    spec = body.get("volumes") or {}
+    recorded = (body.get("status") or {}).get("volume_sizes") or {}
+    for volume in ("data", "metadata"):
+        live = (cache or {}).get(("PersistentVolumeClaim", pvc_names[volume]))
+        live_size = live and ((live["spec"].get("resources") or {}).get("requests") or {}).get("storage")
+        known = [size for size in (live_size, recorded.get(volume)) if size]
+        if not known:
+            continue
+        current = max_quantity(*known)
+        size = (spec.get(volume) or {}).get("size", "1Gi")
+        if kubernetes.utils.parse_quantity(size) < kubernetes.utils.parse_quantity(current):
+            raise kopf.PermanentError(f"the {volume} volume cannot shrink from {current} to {size}")
+        if kubernetes.utils.parse_quantity(size) > kubernetes.utils.parse_quantity(current):
+            logger.info(f"expanding the {volume} volume {pvc_names[volume]} from {current} to {size}")
+
+
+def config_hash(system_prompt, mcp_config, secrets):
+    """Hash of the prompt, MCP config and secret contents the agent reads at start"""
+    secret_data = {secret.metadata.name: secret.data for secret in secrets}
+    encoded = json.dumps([system_prompt, mcp_config, secret_data], sort_keys=True)
+    return hashlib.sha256(encoded.encode()).hexdigest()
+
+
+def agent_home_env():
+    """Environment keeping the agent's home, caches and browser profile on the data volume"""
+    return [
+        kubernetes.client.V1EnvVar(
+            name="MPLCONFIGDIR",
+            value="/tmp/matplotlib"
+        ),
+        kubernetes.client.V1EnvVar(
+            name="TMPDIR",
+            value="/tmp"
+        ),
+        kubernetes.client.V1EnvVar(
+            name="HOME",
+            value="/data/output"
+        ),
+        kubernetes.client.V1EnvVar(
+            name="XDG_CONFIG_HOME",
+            value="/data/output/.config"
+        ),
+        kubernetes.client.V1EnvVar(
+            name="XDG_DATA_HOME",
+            value="/data/output/.local/share"
+        ),
+        kubernetes.client.V1EnvVar(
+            name="XDG_CACHE_HOME",
+            value="/data/output/.cache"
+        ),
+        kubernetes.client.V1EnvVar(
+            name="CHROME_USER_DATA_DIR",
+            value="/data/output/.config/google-chrome"
+        ),
+        kubernetes.client.V1EnvVar(
+            name="CHROME_CRASH_PIPE",
+            value="/data/output/.config/google-chrome/crash-pipe"
+        ),
+    ]
 
-    deployment = kubernetes.client.V1Deployment(
-        metadata=kubernetes.client.V1ObjectMeta(name=metadata_name),
+
+def build_agent_deployment(metadata_name, agent_namespace, stack_name, system_prompt, version, pvc_names, configuration_hash, resources, replicas=1, data_template=None, tmp=None, images=None):
+    mcp_config_name = f"{metadata_name}-mcp-config"
+    agent_image, agent_pull_policy = pinned_image(f"{AGENT_IMAGE}:{version}", images)
+    code_server_image, code_server_pull_policy = pinned_image(CODE_SERVER_IMAGE, images)
+    return kubernetes.client.V1Deployment(
+        api_version="apps/v1",
+        kind="Deployment",
+        metadata=kubernetes.client.V1ObjectMeta(
+            name=metadata_name, namespace=agent_namespace, labels=agent_labels(metadata_name)
+        ),
         spec=kubernetes.client.V1DeploymentSpec(
-            replicas=1,
+            replicas=replicas,
             selector=kubernetes.client.V1LabelSelector(
                 match_labels={"app": metadata_name}
             ),
             template=kubernetes.client.V1PodTemplateSpec(
-                metadata=kubernetes.client.V1ObjectMeta(labels={"app": metadata_name}),
+                metadata=kubernetes.client.V1ObjectMeta(
+                    labels={"app": metadata_name, AGENT_LABEL: metadata_name},
+                    annotations={CONFIG_HASH_ANNOTATION: configuration_hash},
+                ),
                 spec=kubernetes.client.V1PodSpec(
-                    service_account_name=f"{metadata_name}-agent-sa",
+                    service_account_name=f"{stack_name}-agent-sa",
+                    init_containers=[build_seed_container(data_template, images)] if data_template else None,
                     containers=[
                         kubernetes.client.V1Container(
                             name=metadata_name,
-                            image=f"wholelottahoopla/webagent:{version}",
-                            image_pull_policy="Always",
+                            image=agent_image,
+                            image_pull_policy=agent_pull_policy,
                             args=[
                                 "--port",
                                 "8081",
@@ -365,8 +1817,10 @@ def create_claud_code_fn(body, name, namespace, logger, **kwargs):
                                 "/data/output",
                                 "--metadata-dir",
                                 "/data/metadata",
-                                "--system-prompt",
-                                metadata_system_prompt,
+                            ] + (
+                                [PROMPT_FILE_ARG, "/prompt/system-prompt.txt"] if PROMPT_DELIVERY == "file"
+                                else ["--system-prompt", system_prompt]
+                            ) + [
                                 "--mcp",
                                 "/config/mcp.json",
                             ],
@@ -388,39 +1842,7 @@ def create_claud_code_fn(body, name, namespace, logger, **kwargs):
                                         )
                                     ),
                                 ),
-                                kubernetes.client.V1EnvVar(
-                                    name="MPLCONFIGDIR",
-                                    value="/tmp/matplotlib"
-                                ),
-                                kubernetes.client.V1EnvVar(
-                                    name="TMPDIR",
-                                    value="/tmp"
-                                ),
-                                kubernetes.client.V1EnvVar(
-                                    name="HOME",
-                                    value="/data/output"
-                                ),
-                                kubernetes.client.V1EnvVar(
-                                    name="XDG_CONFIG_HOME",
-                                    value="/data/output/.config"
-                                ),
-                                kubernetes.client.V1EnvVar(
-                                    name="XDG_DATA_HOME",
-                                    value="/data/output/.local/share"
-                                ),
-                                kubernetes.client.V1EnvVar(
-                                    name="XDG_CACHE_HOME",
-                                    value="/data/output/.cache"
-                                ),
-                                kubernetes.client.V1EnvVar(
-                                    name="CHROME_USER_DATA_DIR",
-                                    value="/data/output/.config/google-chrome"
-                                ),
-                                kubernetes.client.V1EnvVar(
-                                    name="CHROME_CRASH_PIPE",
-                                    value="/data/output/.config/google-chrome/crash-pipe"
-                                ),
-                            ],
+                            ] + agent_home_env() + package_cache_env(),
                             volume_mounts=[
                                 kubernetes.client.V1VolumeMount(
                                     name="data-volume",
@@ -430,7 +1852,12 @@ def create_claud_code_fn(body, name, namespace, logger, **kwargs):
                                     name="metadata-volume",
                                     mount_path="/data/metadata",
                                 ),
+                                # The kubelet never updates subPath mounts, so
+                                # reload modes mount the whole ConfigMap
                                 kubernetes.client.V1VolumeMount(
+                                    name=f"{mcp_config_name}",
+                                    mount_path="/config",
+                                ) if MCP_RELOAD != "restart" else kubernetes.client.V1VolumeMount(
                                     name=f"{mcp_config_name}",
                                     mount_path="/config/mcp.json",
                                     sub_path="mcp.json",
@@ -439,17 +1866,23 @@ def create_claud_code_fn(body, name, namespace, logger, **kwargs):
                                     name="tmp-volume",
                                     mount_path="/tmp",
                                 ),
-                            ],
+                            ] + ([
+                                kubernetes.client.V1VolumeMount(
+                                    name="system-prompt",
+                                    mount_path="/prompt",
+                                ),
+                            ] if PROMPT_DELIVERY == "file" else []),
                             ports=[
                                 kubernetes.client.V1ContainerPort(
                                     name="http", container_port=8081
                                 )
                             ],
+                            resources=resources["agent"],
                         ),
                         kubernetes.client.V1Container(
                             name=f"{metadata_name}-code-server",
-                            image="bencdr/code-server-deploy-container:latest",
-                            image_pull_policy="Always",
+                            image=code_server_image,
+                            image_pull_policy=code_server_pull_policy,
                             env=[
                                 kubernetes.client.V1EnvVar(
                                     name="PASSWORD", value="12345"
@@ -469,19 +1902,20 @@ def create_claud_code_fn(body, name, namespace, logger, **kwargs):
                                     name="code-server", container_port=8080
                                 )
                             ],
+                            resources=resources["code_server"],
                         ),
-                    ],
+                    ] + ([build_session_limit_container(images)] if SHARED_PLAYWRIGHT else []),
                     volumes=[
                         kubernetes.client.V1Volume(
                             name="data-volume",
                             persistent_volume_claim=kubernetes.client.V1PersistentVolumeClaimVolumeSource(
-                                claim_name=data_pvc_name
+                                claim_name=pvc_names["data"]
                             ),
                         ),
                         kubernetes.client.V1Volume(
                             name="metadata-volume",
                             persistent_volume_claim=kubernetes.client.V1PersistentVolumeClaimVolumeSource(
-                                claim_name=metadata_pvc_name
+                                claim_name=pvc_names["metadata"]
                             ),
                         ),
                         kubernetes.client.V1Volume(
@@ -490,45 +1924,37 @@ def create_claud_code_fn(body, name, namespace, logger, **kwargs):
                                 name=mcp_config_name
                             ),
                         ),
+                        build_tmp_volume(tmp or {"medium": "pvc", "size": "1Gi", "storage_class": None}),
+                    ] + ([
                         kubernetes.client.V1Volume(
-                            name="tmp-volume",
-                            ephemeral=kubernetes.client.V1EphemeralVolumeSource(
-                                volume_claim_template=kubernetes.client.V1PersistentVolumeClaimTemplate(
-                                    spec=kubernetes.client.V1PersistentVolumeClaimSpec(
-                                        access_modes=["ReadWriteOnce"],
-                                        resources=kubernetes.client.V1ResourceRequirements(
-                                            requests={"storage": "1Gi"}
-                                        ),
-                                    )
-                                )
+                            name="system-prompt",
+                            config_map=kubernetes.client.V1ConfigMapVolumeSource(
+                                name=prompt_configmap_name(metadata_name, system_prompt)
                             ),
                         ),
-                    ],
+                    ] if PROMPT_DELIVERY == "file" else []),
                 ),
             ),
         ),
     )
-    try:
-        kubernetes.client.AppsV1Api().create_namespaced_deployment(
-            body=deployment, namespace=agent_namespace
-        )
-        logger.info("created deployment")
-    except kubernetes.client.exceptions.ApiException as e:
-        if e.status != 409:
-            raise
-        logger.info(f"deployment {metadata_name} already exists")
 
-    # Create services for the deployments
-    logger.info("creating services")
-    
-    # Service for the main deployment (port 8080 and 8081)
-    main_service = kubernetes.client.V1Service(
+
+def build_agent_service(metadata_name, agent_namespace, idle=False):
+    """Service for the main deployment (port 8080 and 8081)
+
+    An idle agent's service has no selector; its endpoints are the activator
+    (see build_activator_endpoint_slice).
+    """
+    return kubernetes.client.V1Service(
+        api_version="v1",
+        kind="Service",
         metadata=kubernetes.client.V1ObjectMeta(
             name=f"{metadata_name}-service",
-            namespace=agent_namespace
+            namespace=agent_namespace,
+            labels=agent_labels(metadata_name),
         ),
         spec=kubernetes.client.V1ServiceSpec(
-            selector={"app": metadata_name},
+            selector=None if idle else {"app": metadata_name},
             ports=[
                 kubernetes.client.V1ServicePort(
                     name="code-server",
@@ -545,50 +1971,45 @@ def create_claud_code_fn(body, name, namespace, logger, **kwargs):
             ]
         )
     )
-    
-    try:
-        core_v1_api.create_namespaced_service(
-            namespace=agent_namespace, body=main_service
-        )
-        logger.info(f"created main service: {metadata_name}-service")
-    except kubernetes.client.exceptions.ApiException as e:
-        if e.status != 409:
-            raise
-        logger.info(f"main service {metadata_name}-service already exists")
 
-    # Create Tailscale ingresses
-    logger.info("creating Tailscale ingresses")
-    
-    # Ingress for code-server (port 8080)
-    code_server_ingress = kubernetes.client.V1Ingress(
+
+def build_activator_endpoint_slice(metadata_name, agent_namespace):
+    """Endpoints of an idle agent's service: both ports go to the activator"""
+    return kubernetes.client.V1EndpointSlice(
+        api_version="discovery.k8s.io/v1",
+        kind="EndpointSlice",
         metadata=kubernetes.client.V1ObjectMeta(
-            name=f"{metadata_name}-code-server-ingress",
+            name=f"{metadata_name}-service-activator",
             namespace=agent_namespace,
+            labels={
+                **agent_labels(metadata_name),
+                "kubernetes.io/service-name": f"{metadata_name}-service",
+                "endpointslice.kubernetes.io/managed-by": FIELD_MANAGER,
+            },
         ),
-        spec=kubernetes.client.V1IngressSpec(
-            ingress_class_name="tailscale",
-            default_backend=kubernetes.client.V1IngressBackend(
-                service=kubernetes.client.V1IngressServiceBackend(
-                    name=f"{metadata_name}-service",
-                    port=kubernetes.client.V1ServiceBackendPort(
-                        number=8080
-                    )
-                )
+        address_type="IPv4",
+        endpoints=[
+            kubernetes.client.V1Endpoint(
+                addresses=[ACTIVATOR_IP],
+                conditions=kubernetes.client.V1EndpointConditions(ready=True),
             ),
-            tls=[
-                kubernetes.client.V1IngressTLS(
-                    hosts=[f"{metadata_name}-code-server"]
-                )
-            ]
-        )
+        ],
+        ports=[
+            kubernetes.client.DiscoveryV1EndpointPort(name=port_name, port=ACTIVATOR_PORT, protocol="TCP")
+            for port_name in ("code-server", "http")
+        ],
     )
-    
-    # Ingress for http service (port 8081)
-    http_ingress = kubernetes.client.V1Ingress(
+
+
+def build_tailscale_ingress(metadata_name, agent_namespace, suffix, port):
+    """Tailscale ingress exposing one port of the agent service as `{name}-{suffix}`"""
+    return kubernetes.client.V1Ingress(
+        api_version="networking.k8s.io/v1",
+        kind="Ingress",
         metadata=kubernetes.client.V1ObjectMeta(
-            name=f"{metadata_name}-http-ingress",
+            name=f"{metadata_name}-{suffix}-ingress",
             namespace=agent_namespace,
-
+            labels=agent_labels(metadata_name),
         ),
         spec=kubernetes.client.V1IngressSpec(
             ingress_class_name="tailscale",
@@ -596,185 +2017,1291 @@ def create_claud_code_fn(body, name, namespace, logger, **kwargs):
                 service=kubernetes.client.V1IngressServiceBackend(
                     name=f"{metadata_name}-service",
                     port=kubernetes.client.V1ServiceBackendPort(
-                        number=8081
+                        number=port
                     )
                 )
             ),
             tls=[
                 kubernetes.client.V1IngressTLS(
-                    hosts=[f"{metadata_name}-http"]
+                    hosts=[f"{metadata_name}-{suffix}"]
                 )
             ]
         )
     )
-    
-    networking_v1_api = kubernetes.client.NetworkingV1Api()
-    
-    try:
-        networking_v1_api.create_namespaced_ingress(
-            namespace=agent_namespace, body=code_server_ingress
-        )
-        logger.info(f"created code-server ingress: {metadata_name}-code-server-ingress")
-    except kubernetes.client.exceptions.ApiException as e:
-        if e.status != 409:
-            raise
-        logger.info(f"code-server ingress {metadata_name}-code-server-ingress already exists")
-    
-    try:
-        networking_v1_api.create_namespaced_ingress(
-            namespace=agent_namespace, body=http_ingress
-        )
-        logger.info(f"created http ingress: {metadata_name}-http-ingress")
-    except kubernetes.client.exceptions.ApiException as e:
-        if e.status != 409:
-            raise
-        logger.info(f"http ingress {metadata_name}-http-ingress already exists")
 
 
-# delete the deployment and service for the claud-code and nginx and remove the pvc
-@kopf.on.delete("kopf.dev.claud-code", "v1", "claud-code")
-def delete_claud_code_fn(body, **kwargs):
-    from kubernetes.client.exceptions import ApiException
+def render_stack(stack_name, agent_namespace, pvc_names, namespace_labels=None, resources=None, replicas=1, volumes=None, images=None):
+    """Namespace-level objects an agent runs on: namespace, RBAC, PVCs and Playwright
 
-    logging.info(f"A handler is called with body: {body}")
+    They are named after the stack, which is the agent itself or a warm pool
+    slot the agent claimed (see claim_warm_stack). `resources` and `volumes`
+    default to the DEFAULT_SIZE profile and 1Gi PVCs of the default class.
+    """
+    resources = resources or container_resources({})
+    volumes = volumes or volume_settings({})
+    steps = {
+        "namespace": ((), [build_namespace(agent_namespace, namespace_labels or agent_labels(stack_name))]),
+        "service-account": (("namespace",), [build_service_account(stack_name, agent_namespace)]),
+        "role": (("namespace",), [build_role(stack_name, agent_namespace)]),
+        "role-binding": (("role", "service-account"), [build_role_binding(stack_name, agent_namespace)]),
+        "pvcs": (("namespace",), [
+            build_pvc(stack_name, pvc_names["metadata"], agent_namespace, None, **volumes["metadata"]),
+            build_pvc(stack_name, pvc_names["data"], agent_namespace, pvc_names.get("template"), **volumes["data"]),
+        ]),
+        "playwright-deployment": (("namespace",), [
+            build_playwright_deployment(stack_name, agent_namespace, resources["playwright"], replicas, images),
+        ]),
+        "playwright-service": (("namespace",), [build_playwright_service(stack_name, agent_namespace)]),
+    }
+    if SHARED_PLAYWRIGHT:
+        steps["playwright-deployment"] = (("namespace",), [])
+        steps["playwright-service"] = (("namespace",), [])
+    return steps
+
+
+def render_agent(body, stack, pvc_names, logger):
+    """Desired objects of a ClaudCode as a provisioning graph
+
+    Maps a step name to `(dependencies, manifests)`. Everything lives in the
+    agent namespace, so it goes first. The agent deployment waits for the
+    objects its pod mounts or runs as, and the ingresses wait for the service
+    they point at; the rest is independent. A claimed warm stack is already
+    provisioned, so its steps are kept in the graph with nothing to apply,
+    except the PVCs, which grow to the sizes the agent asks for and are
+    relabelled to the agent.
+    An idle agent (status.idle) renders at zero replicas behind the activator.
+    Images are pinned to the digests in status.images (see with_image_digests).
+    With SHARED_PLAYWRIGHT the playwright-server Service points at the agent's
+    own session-limiting proxy, so it is rendered per agent, warm or not.
+
+    The secrets and the subPath-mounted MCP config are only read at pod start,
+    so the pod template carries a hash of them: the agent rolls out exactly
+    when that configuration changes, and never for no-op edits. With an
+    MCP_RELOAD mode the MCP config is left out of the hash and reloaded in
+    place instead (see reload_mcp_config).
+    """
     metadata_name = body["metadata"]["name"]
-    agent_namespace = metadata_name  # Use agent name as namespace
-    logger = logging.getLogger(__name__)
-    logger.info(f"deleting claud-code agent from namespace: {agent_namespace}")
+    stack_name, agent_namespace = stack["name"], stack["namespace"]
+    version = body.get("version", "latest")
+    system_prompt = body["system_prompt"]
+    mcp_config = body.get("mcp_config", {})
+    secrets = build_api_secrets(body, agent_namespace, logger)
+    resources = container_resources(body)
+    volumes = volume_settings(body)
+    if pvc_names.get("template_size"):
+        # A clone is at least as large as its source
+        volumes["data"]["size"] = max_quantity(volumes["data"]["size"], pvc_names["template_size"])
+    idle = agent_idle(body)
+    replicas = 0 if idle else 1
+    images = (body.get("status") or {}).get("images") or {}
+    steps = render_stack(
+        stack_name, agent_namespace, pvc_names, resources=resources, replicas=replicas, volumes=volumes, images=images,
+    )
+    if stack.get("warm"):
+        steps = {
+            step_name: (deps, manifests if step_name == "pvcs" else [])
+            for step_name, (deps, manifests) in steps.items()
+        }
+        # Relabelled from the slot to the agent, so its informer cache holds them
+        for pvc in steps["pvcs"][1]:
+            pvc.metadata.labels = agent_labels(metadata_name)
+    if SHARED_PLAYWRIGHT:
+        steps["playwright-service"] = (("namespace",), [build_session_limit_service(metadata_name, agent_namespace)])
+    if pvc_names.get("template"):
+        # Declared first, as steps only depend on earlier ones
+        steps = {"data-template-grant": ((), [
+            build_data_template_grant(metadata_name, pvc_names["template"], agent_namespace),
+        ]), **steps}
+        pvc_deps, pvc_manifests = steps["pvcs"]
+        steps["pvcs"] = (pvc_deps + ("data-template-grant",), pvc_manifests)
+    steps.update({
+        "api-secrets": (("namespace",), secrets),
+        "mcp-config": (("namespace",), [
+            build_mcp_configmap(metadata_name, agent_namespace, mcp_config),
+        ]),
+        "prompt": (("namespace",), [
+            build_prompt_configmap(metadata_name, agent_namespace, system_prompt),
+        ] if PROMPT_DELIVERY == "file" else []),
+        "deployment": (("api-secrets", "service-account", "pvcs", "mcp-config", "prompt"), [
+            build_agent_deployment(
+                metadata_name, agent_namespace, stack_name, system_prompt, version, pvc_names,
+                config_hash(system_prompt, mcp_config if MCP_RELOAD == "restart" else None, secrets),
+                resources, replicas,
+                body.get("data_template"), volumes["tmp"], images,
+            ),
+        ]),
+        "service": (("namespace",), [build_agent_service(metadata_name, agent_namespace, idle)] + (
+            [build_activator_endpoint_slice(metadata_name, agent_namespace)] if idle else []
+        )),
+        "code-server-ingress": (("service",), [
+            build_tailscale_ingress(metadata_name, agent_namespace, "code-server", 8080),
+        ]),
+        "http-ingress": (("service",), [
+            build_tailscale_ingress(metadata_name, agent_namespace, "http", 8081),
+        ]),
+    })
+    return steps
+
+
+async def reconcile_agent(body, stack, pvc_names, logger, cache=None, finished=None):
+    """Server-side apply every object owned by a ClaudCode, skipping unchanged ones
+
+    Returns when each provisioning step finished; steps in `finished` are
+    skipped (see run_provisioning_graph).
+    """
+    steps = {
+        step_name: (deps, functools.partial(apply_manifests, manifests, logger, cache))
+        for step_name, (deps, manifests) in render_agent(body, stack, pvc_names, logger).items()
+    }
+    finished = await run_provisioning_graph(steps, logger, finished=finished)
+    if SHARED_PLAYWRIGHT:
+        await run_blocking(delete_own_playwright, body, stack, logger, cache)
+    if PROMPT_DELIVERY == "file":
+        await run_blocking(delete_stale_prompts, body, stack, logger, cache)
+    return finished
+
+
+def delete_own_playwright(body, stack, logger, cache=None):
+    """Remove a per-agent Playwright server left over from before the shared pool"""
+    from kubernetes.client.exceptions import ApiException
+
+    deployment_name = f"{stack['name']}-playwright-server"
+    if cache is not None and ("Deployment", deployment_name) not in cache:
+        return
     try:
-        kubernetes.client.AppsV1Api().delete_namespaced_deployment(
-            name=metadata_name, namespace=agent_namespace
-        )
+        apps_v1().delete_namespaced_deployment(name=deployment_name, namespace=stack["namespace"])
     except ApiException as e:
         if e.status != 404:
             raise
-    logger.info("deleted deployment")
-    
-    # Delete Playwright server deployment
-    try:
-        kubernetes.client.AppsV1Api().delete_namespaced_deployment(
-            name=f"{metadata_name}-playwright-server", namespace=agent_namespace
+        return
+    logger.info(f"deleted {deployment_name}, {body['metadata']['name']} uses the shared Playwright pool")
+
+
+def delete_stale_prompts(body, stack, logger, cache=None):
+    """Remove the prompt ConfigMaps of earlier prompts once the current one is applied
+
+    Pods already running keep the files they mounted, so only a rollback to
+    an old ReplicaSet would miss them.
+    """
+    from kubernetes.client.exceptions import ApiException
+
+    metadata_name = body["metadata"]["name"]
+    current = prompt_configmap_name(metadata_name, body["system_prompt"])
+    if cache is not None:
+        names = [
+            name for (kind, name), obj in cache.items()
+            if kind == "ConfigMap" and PROMPT_LABEL in obj["metadata"]["labels"]
+        ]
+    else:
+        configmaps = core_v1().list_namespaced_config_map(
+            stack["namespace"], label_selector=f"{AGENT_LABEL}={metadata_name},{PROMPT_LABEL}=true",
         )
-    except ApiException as e:
-        if e.status != 404:
-            raise
-    logger.info("deleted playwright server deployment")
-    
-    # Delete services
-    logger.info("deleting services")
-    try:
-        kubernetes.client.CoreV1Api().delete_namespaced_service(
-            name=f"{metadata_name}-service", namespace=agent_namespace
+        names = [configmap.metadata.name for configmap in configmaps.items]
+    for name in names:
+        if name == current:
+            continue
+        try:
+            core_v1().delete_namespaced_config_map(name=name, namespace=stack["namespace"])
+        except ApiException as e:
+            if e.status != 404:
+                raise
+        logger.info(f"deleted stale prompt {name}")
+
+
+def agent_idle(body):
+    return bool((body.get("status") or {}).get("idle"))
+
+
+def with_idle(body, idle):
+    """Copy of a ClaudCode with status.idle set, to render it in that state"""
+    return {**body, "status": {**(body.get("status") or {}), "idle": idle}}
+
+
+# Bump when the operator renders agents differently, so that the first start
+# of the new version re-applies every agent (see spec_hash).
+RENDER_VERSION = 1
+
+
+def render_settings():
+    """Operator settings, besides the ClaudCode itself, that agents are rendered from"""
+    return {
+        "render_version": RENDER_VERSION,
+        "shared_playwright": SHARED_PLAYWRIGHT,
+        "shared_namespace": SHARED_NAMESPACE,
+        "playwright_sessions_per_agent": PLAYWRIGHT_SESSIONS_PER_AGENT,
+        "default_size": DEFAULT_SIZE,
+        "pin_images": PIN_IMAGES,
+        "prompt_delivery": PROMPT_DELIVERY,
+        "prompt_file_arg": PROMPT_FILE_ARG,
+        "mcp_reload": MCP_RELOAD,
+        "package_cache": PACKAGE_CACHE,
+        "activator_port": ACTIVATOR_PORT,
+        # Only ever stored hashed, in status.specHash
+        "api_keys": {key: os.getenv(key) for _, key in API_KEY_SECRETS},
+    }
+
+
+def spec_hash(body):
+    """Hash of what a ClaudCode is rendered from, kept in status.specHash
+
+    That is its fields and the operator's render_settings, so upgrading or
+    reconfiguring the operator re-applies every agent on the next start.
+    """
+    spec = {key: value for key, value in body.items() if key not in ("apiVersion", "kind", "metadata", "status")}
+    encoded = json.dumps({"spec": spec, "operator": render_settings()}, sort_keys=True, separators=(",", ":"))
+    return hashlib.sha256(encoded.encode()).hexdigest()
+
+
+def record_observed(body, patch):
+    """Record the spec, generation and PVC sizes the agent's objects were last applied from"""
+    patch.status["specHash"] = spec_hash(body)
+    patch.status["observedGeneration"] = body["metadata"].get("generation")
+    volumes = volume_settings(body)
+    sizes = {volume: volumes[volume]["size"] for volume in ("data", "metadata")}
+    if sizes != (body.get("status") or {}).get("volume_sizes"):
+        patch.status["volume_sizes"] = sizes
+
+
+def agent_stack(body):
+    """The stack an agent runs on, as recorded in status.stack
+
+    Agents provisioned cold, including those created before the record
+    existed, run on a stack named after themselves in their own namespace.
+    """
+    stack = (body.get("status") or {}).get("stack")
+    if stack:
+        return dict(stack)
+    metadata_name = body["metadata"]["name"]
+    return {"name": metadata_name, "namespace": metadata_name}
+
+
+def agent_pvc_names(body, stack, status, patch, logger, cache=None):
+    """Names of the agent's data and metadata PVCs
+
+    They carry a random suffix, so they are recorded in the ClaudCode status.
+    Agents created before that are looked up once from their deployment.
+    """
+    pvc_names = (status or {}).get("pvcs")
+    if pvc_names:
+        return dict(pvc_names)
+
+    metadata_name = body["metadata"]["name"]
+    deployment = (cache or {}).get(("Deployment", metadata_name))
+    if deployment is None:
+        deployment = api_client().sanitize_for_serialization(
+            apps_v1().read_namespaced_deployment(name=metadata_name, namespace=stack["namespace"])
         )
-    except ApiException as e:
-        if e.status != 404:
-            raise
-    logger.info("deleted main service")
-    
-    # Delete Playwright server service
+    claims = {
+        volume["name"]: volume["persistentVolumeClaim"]["claimName"]
+        for volume in deployment["spec"]["template"]["spec"].get("volumes") or []
+        if volume.get("persistentVolumeClaim")
+    }
+    pvc_names = {"metadata": claims["metadata-volume"], "data": claims["data-volume"]}
+    patch.status["pvcs"] = pvc_names
+    logger.info(f"recorded pvc names from deployment {metadata_name}: {pvc_names}")
+    return pvc_names
+
+
+# Warm pool: idle, fully provisioned stacks in namespaces labelled
+# WARM_POOL_LABEL=idle. A new ClaudCode claims one by flipping the label to
+# claimed, and only applies its own secrets, MCP config, deployment, service
+# and ingresses into it.
+WARM_POOL_LABEL = "kopf-agent.dev/warm-pool"
+
+
+def warm_pvc_names(slot):
+    return {"metadata": f"{slot}-metadata", "data": f"{slot}-data"}
+
+
+_provisioning_slots = set()  # warm stacks this process is provisioning
+
+
+@kopf.index("v1", "namespaces", labels={WARM_POOL_LABEL: "idle"})
+def idle_warm_namespaces(name, **kwargs):
+    return {"idle": name}
+
+
+def claim_warm_stack(metadata_name, idle_namespaces, logger):
+    """Claim an idle warm stack for an agent, returning its stack or None
+
+    The claim is a JSON patch that first tests the pool label is still
+    `idle`, so concurrent claims of the same namespace cannot both succeed.
+    """
+    from kubernetes.client.exceptions import ApiException
+
+    escaped_pool_label = WARM_POOL_LABEL.replace("/", "~1")
+    escaped_agent_label = AGENT_LABEL.replace("/", "~1")
+    for slot in sorted(idle_namespaces):
+        try:
+            core_v1().patch_namespace(name=slot, body=[
+                {"op": "test", "path": f"/metadata/labels/{escaped_pool_label}", "value": "idle"},
+                {"op": "replace", "path": f"/metadata/labels/{escaped_pool_label}", "value": "claimed"},
+                {"op": "add", "path": f"/metadata/labels/{escaped_agent_label}", "value": metadata_name},
+            ])
+        except ApiException as e:
+            if e.status not in (404, 409, 422):  # gone, or claimed by someone else
+                raise
+            continue
+        logger.info(f"claimed warm stack {slot} for {metadata_name}")
+        return {"name": slot, "namespace": slot, "warm": True}
+    return None
+
+
+async def provision_warm_stack(slot, logger):
+    """Provision one idle stack and only then mark its namespace claimable"""
+    provisioning_labels = {"app.kubernetes.io/managed-by": FIELD_MANAGER, WARM_POOL_LABEL: "provisioning"}
+    steps = {
+        step_name: (deps, functools.partial(apply_manifests, manifests, logger))
+        for step_name, (deps, manifests) in render_stack(
+            slot, slot, warm_pvc_names(slot), provisioning_labels
+        ).items()
+    }
+    _provisioning_slots.add(slot)
     try:
-        kubernetes.client.CoreV1Api().delete_namespaced_service(
-            name="playwright-server", namespace=agent_namespace
+        await run_provisioning_graph(steps, logger)
+        await run_blocking(
+            core_v1().patch_namespace,
+            name=slot, body={"metadata": {"labels": {WARM_POOL_LABEL: "idle"}}},
         )
-    except ApiException as e:
-        if e.status != 404:
-            raise
-    logger.info("deleted playwright server service")
-    
-    # Delete ingresses
-    logger.info("deleting ingresses")
-    networking_v1_api = kubernetes.client.NetworkingV1Api()
-    
+    finally:
+        _provisioning_slots.discard(slot)
+    logger.info(f"warm stack {slot} is ready")
+
+
+def delete_stale_warm_stacks(namespaces, logger):
+    """Delete `provisioning` stacks this process is not provisioning
+
+    They are left over from a failed provisioning or an operator restart, and
+    would otherwise count toward WARM_POOL_SIZE forever. Returns the rest.
+    """
+    from kubernetes.client.exceptions import ApiException
+
+    kept = []
+    for ns in namespaces:
+        if ns.metadata.labels.get(WARM_POOL_LABEL) != "provisioning" or ns.metadata.name in _provisioning_slots:
+            kept.append(ns)
+            continue
+        try:
+            core_v1().delete_namespace(name=ns.metadata.name)
+        except ApiException as e:
+            if e.status != 404:
+                raise
+        logger.info(f"deleted stale warm stack {ns.metadata.name}")
+    return kept
+
+
+async def maintain_warm_pool(logger):
+    """Keep WARM_POOL_SIZE idle or provisioning stacks around"""
+    while True:
+        try:
+            namespaces = await run_blocking(
+                core_v1().list_namespace,
+                label_selector=f"{WARM_POOL_LABEL} in (idle,provisioning)",
+            )
+            available = await run_blocking(delete_stale_warm_stacks, [
+                ns for ns in namespaces.items
+                if ns.status is None or ns.status.phase != "Terminating"
+            ], logger)
+            missing = WARM_POOL_SIZE - len(available)
+            if missing > 0:
+                logger.info(f"provisioning {missing} warm stacks")
+                await asyncio.gather(*(
+                    provision_warm_stack(f"warm-{uuid.uuid4().hex[:8]}", logger)
+                    for _ in range(missing)
+                ))
+        except Exception as e:
+            logger.error(f"Failed to maintain the warm pool: {e}")
+        await asyncio.sleep(WARM_POOL_INTERVAL)
+
+
+async def maintain_playwright_pool(logger):
+    """Keep the shared Playwright pool sized for the current number of agents
+
+    The HPA scales the pool on CPU between the sessions reserved by all agents
+    and PLAYWRIGHT_MAX_REPLICAS; every pod serves at most
+    PLAYWRIGHT_SESSIONS_PER_POD browser sessions.
+    """
+    while True:
+        try:
+            agents = await run_blocking(
+                custom_objects().list_cluster_custom_object,
+                "kopf.dev.claud-code", "v1", "claud-code",
+            )
+            min_replicas = playwright_pool_replicas(len(agents["items"]))
+            await run_provisioning_graph({
+                "namespace": ((), functools.partial(apply_manifests, [
+                    build_namespace(SHARED_NAMESPACE, shared_labels()),
+                ], logger)),
+                "pool": (("namespace",), functools.partial(apply_manifests, [
+                    build_playwright_pool_deployment(SHARED_NAMESPACE),
+                    build_playwright_pool_service(SHARED_NAMESPACE),
+                    build_playwright_pool_hpa(SHARED_NAMESPACE, min_replicas),
+                ], logger)),
+            }, logger)
+        except Exception as e:
+            logger.error(f"Failed to maintain the shared Playwright pool: {e}")
+        await asyncio.sleep(PLAYWRIGHT_POOL_INTERVAL)
+
+
+async def maintain_image_prepull(logger):
+    """Keep every image the current agents use pulled on every node
+
+    That is the digests recorded by each agent, plus the ones their tags
+    resolve to now, which new agents get. Resolving the tags here also keeps
+    the digest cache warm, so handlers rarely wait on a registry.
+    """
+    while True:
+        try:
+            agents = await run_blocking(
+                custom_objects().list_cluster_custom_object,
+                "kopf.dev.claud-code", "v1", "claud-code",
+            )
+            versions = sorted({agent.get("version", "latest") for agent in agents["items"]} or {"latest"})
+            images = [f"{AGENT_IMAGE}:{version}" for version in versions] + [CODE_SERVER_IMAGE, PLAYWRIGHT_IMAGE]
+            if SHARED_PLAYWRIGHT:
+                images.append(SESSION_LIMIT_IMAGE)
+            await run_blocking(resolve_images, images + [BUSYBOX_IMAGE], logger)
+            current = {pinned_image(image)[0] for image in images}
+            images += sorted({
+                f"{image}@{digest}"
+                for agent in agents["items"]
+                for image, digest in ((agent.get("status") or {}).get("images") or {}).items()
+                if image != BUSYBOX_IMAGE
+            } - current)
+            await run_provisioning_graph({
+                "namespace": ((), functools.partial(apply_manifests, [
+                    build_namespace(SHARED_NAMESPACE, shared_labels()),
+                ], logger)),
+                "daemonset": (("namespace",), functools.partial(apply_manifests, [
+                    build_prepull_daemonset(SHARED_NAMESPACE, images),
+                ], logger)),
+            }, logger)
+        except Exception as e:
+            logger.error(f"Failed to maintain the image pre-pull DaemonSet: {e}")
+        await asyncio.sleep(PREPULL_INTERVAL)
+
+
+async def provision_package_caches(logger):
+    """Apply the shared package caches, retrying until the apiserver takes them"""
+    while True:
+        try:
+            if PIN_IMAGES:
+                await run_blocking(resolve_images, [PYPI_CACHE_IMAGE, NIX_CACHE_IMAGE], logger)
+            await run_provisioning_graph({
+                "namespace": ((), functools.partial(apply_manifests, [
+                    build_namespace(SHARED_NAMESPACE, shared_labels()),
+                ], logger)),
+                "caches": (("namespace",), functools.partial(apply_manifests, build_package_caches(SHARED_NAMESPACE), logger)),
+            }, logger)
+            return
+        except Exception as e:
+            logger.error(f"Failed to provision the shared package caches: {e}")
+        await asyncio.sleep(30)
+
+
+@kopf.on.startup()
+async def start_package_caches(logger, memo, **kwargs):
+    if PACKAGE_CACHE:
+        memo.package_cache_task = asyncio.create_task(provision_package_caches(logger))
+        logger.info(f"serving PyPI and nix caches to agents from {SHARED_NAMESPACE}")
+
+
+@kopf.on.cleanup()
+async def stop_package_caches(memo, **kwargs):
+    task = memo.get("package_cache_task")
+    if task is not None:
+        task.cancel()
+        await asyncio.gather(task, return_exceptions=True)
+
+
+@kopf.on.startup()
+async def start_image_prepull(logger, memo, **kwargs):
+    if PREPULL_IMAGES:
+        memo.prepull_task = asyncio.create_task(maintain_image_prepull(logger))
+        logger.info(f"pre-pulling agent images on every node from {SHARED_NAMESPACE}")
+
+
+@kopf.on.cleanup()
+async def stop_image_prepull(memo, **kwargs):
+    task = memo.get("prepull_task")
+    if task is not None:
+        task.cancel()
+        await asyncio.gather(task, return_exceptions=True)
+
+
+@kopf.on.startup()
+async def start_playwright_pool(logger, memo, **kwargs):
+    if SHARED_PLAYWRIGHT:
+        memo.playwright_pool_task = asyncio.create_task(maintain_playwright_pool(logger))
+        logger.info(f"routing agents to the shared Playwright pool in {SHARED_NAMESPACE}")
+
+
+@kopf.on.cleanup()
+async def stop_playwright_pool(memo, **kwargs):
+    task = memo.get("playwright_pool_task")
+    if task is not None:
+        task.cancel()
+        await asyncio.gather(task, return_exceptions=True)
+
+
+@kopf.on.startup()
+async def start_warm_pool(logger, memo, **kwargs):
+    if WARM_POOL_SIZE > 0:
+        memo.warm_pool_task = asyncio.create_task(maintain_warm_pool(logger))
+        logger.info(f"keeping {WARM_POOL_SIZE} warm agent stacks")
+
+
+@kopf.on.cleanup()
+async def stop_warm_pool(memo, **kwargs):
+    task = memo.get("warm_pool_task")
+    if task is not None:
+        task.cancel()
+        await asyncio.gather(task, return_exceptions=True)
+
+
+# Idle mode: agents without network traffic for IDLE_AFTER seconds are scaled
+# to zero, and their service is pointed at the activator in this process,
+# which scales them back up on the first request.
+_node_stats = {"fetched": 0.0, "bytes": {}}  # (namespace, pod) -> rx + tx bytes
+_node_stats_lock = threading.Lock()
+_activity = {}  # (namespace, name) -> (network bytes, time they last changed)
+_idle_agents = {}  # agent name -> ClaudCode namespace
+_wakes = {}  # agent name -> task waking it
+
+
+def pod_network_bytes():
+    """Received plus sent bytes of every pod, from the kubelet summaries
+
+    One summary per node covers all agents on it; they are refreshed at most
+    once per IDLE_CHECK_INTERVAL, by whichever agent timer gets there first
+    while the others wait for its result.
+    """
+    with _node_stats_lock:
+        if time.monotonic() - _node_stats["fetched"] < IDLE_CHECK_INTERVAL / 2:
+            return _node_stats["bytes"]
+        counters = {}
+        for node in core_v1().list_node().items:
+            response = core_v1().connect_get_node_proxy_with_path(
+                name=node.metadata.name, path="stats/summary", _preload_content=False,
+            )
+            for pod in json.loads(response.data).get("pods", []):
+                network = pod.get("network") or {}
+                pod_ref = pod["podRef"]
+                counters[(pod_ref["namespace"], pod_ref["name"])] = (
+                    network.get("rxBytes", 0) + network.get("txBytes", 0)
+                )
+        _node_stats.update(fetched=time.monotonic(), bytes=counters)
+        return counters
+
+
+def agent_network_bytes(metadata_name, agent_namespace):
+    """Network bytes of the agent pod, None while it has no stats"""
+    # Deployment pods are named {deployment}-{replicaset hash}-{suffix}
+    pod_name = re.compile(rf"{re.escape(metadata_name)}-[a-z0-9]+-[a-z0-9]+")
+    total = None
+    for (pod_namespace, name), count in pod_network_bytes().items():
+        if pod_namespace == agent_namespace and pod_name.fullmatch(name):
+            total = (total or 0) + count
+    return total
+
+
+@kopf.timer(
+    "kopf.dev.claud-code", "v1", "claud-code",
+    interval=IDLE_CHECK_INTERVAL, when=lambda **_: IDLE_AFTER > 0 and bool(ACTIVATOR_IP),
+)
+async def idle_claud_code_fn(body, namespace, status, patch, logger, **kwargs):
+    metadata_name = body["metadata"]["name"]
+    stack = agent_stack(body)
+    if agent_idle(body):
+        # The activator is this process, whose IP changes with every restart;
+        # the applied-hash cache makes this one apply per agent per process.
+        await run_blocking(
+            apply_manifest, build_activator_endpoint_slice(metadata_name, stack["namespace"]), logger,
+        )
+        _idle_agents[metadata_name] = namespace
+        return
+
+    now = time.time()
+    key = (namespace, metadata_name)
+    count = await run_blocking(agent_network_bytes, metadata_name, stack["namespace"])
+    last_count, last_active = _activity.get(key, (None, now))
+    if count is None or count != last_count:
+        _activity[key] = (count, now)
+        return
+    if now - last_active < IDLE_AFTER:
+        return
+
+    logger.info(f"{metadata_name} had no traffic for {now - last_active:.0f}s, scaling it to zero")
+    cache = cached_objects(metadata_name, kwargs)
+    pvc_names = await run_blocking(agent_pvc_names, body, stack, status, patch, logger, cache)
+    body = await run_blocking(with_image_digests, body, patch, logger)
+    await reconcile_agent(with_idle(body, True), stack, pvc_names, logger, cache)
+    await run_blocking(scale_warm_playwright, stack, 0, logger)
+    patch.status["idle"] = True
+    _idle_agents[metadata_name] = namespace
+    _activity.pop(key, None)
+
+
+def scale_warm_playwright(stack, replicas, logger):
+    """Scale the Playwright server of a claimed warm stack along with its agent
+
+    It is not rendered for the agent (see render_agent), so idling and waking
+    scale it directly.
+    """
+    from kubernetes.client.exceptions import ApiException
+
+    if not stack.get("warm") or SHARED_PLAYWRIGHT:
+        return
+    deployment_name = f"{stack['name']}-playwright-server"
     try:
-        networking_v1_api.delete_namespaced_ingress(
-            name=f"{metadata_name}-code-server-ingress", namespace=agent_namespace
+        apps_v1().patch_namespaced_deployment(
+            name=deployment_name, namespace=stack["namespace"], body={"spec": {"replicas": replicas}},
         )
     except ApiException as e:
         if e.status != 404:
             raise
-    logger.info("deleted code-server ingress")
-    
+        return
+    logger.info(f"scaled {deployment_name} to {replicas}")
+
+
+async def wait_ready(name, namespace):
+    deadline = time.monotonic() + WAKE_TIMEOUT
+    while time.monotonic() < deadline:
+        deployment = await run_blocking(apps_v1().read_namespaced_deployment, name=name, namespace=namespace)
+        if (deployment.status.ready_replicas or 0) >= 1:
+            return
+        await asyncio.sleep(1)
+    raise TimeoutError(f"{name} was not ready after {WAKE_TIMEOUT:.0f}s")
+
+
+async def wake_agent(metadata_name, logger):
+    """Scale an idle agent back up and return once its pod is ready
+
+    The restored selector only adds the pod to the service once it is ready,
+    so until then requests keep arriving at the activator; the activator
+    endpoints are removed last.
+    """
+    from kubernetes.client.exceptions import ApiException
+
+    namespace = _idle_agents[metadata_name]
+    body = await run_blocking(
+        custom_objects().get_namespaced_custom_object,
+        "kopf.dev.claud-code", "v1", namespace, "claud-code", metadata_name,
+    )
+    stack = agent_stack(body)
+    pvc_names = await run_blocking(agent_pvc_names, body, stack, body.get("status"), kopf.Patch(), logger)
+    images_patch = kopf.Patch()
+    body = await run_blocking(with_image_digests, body, images_patch, logger)
+    await run_blocking(
+        custom_objects().patch_namespaced_custom_object_status,
+        "kopf.dev.claud-code", "v1", namespace, "claud-code", metadata_name,
+        {"status": {**images_patch.status, "idle": False}},
+    )
+    await reconcile_agent(with_idle(body, False), stack, pvc_names, logger)
+    await run_blocking(scale_warm_playwright, stack, 1, logger)
+    await wait_ready(metadata_name, stack["namespace"])
     try:
-        networking_v1_api.delete_namespaced_ingress(
-            name=f"{metadata_name}-http-ingress", namespace=agent_namespace
+        await run_blocking(
+            discovery_v1().delete_namespaced_endpoint_slice,
+            name=f"{metadata_name}-service-activator", namespace=stack["namespace"],
         )
     except ApiException as e:
         if e.status != 404:
             raise
-    logger.info("deleted http ingress")
-    
-    logger.info("deleting pvcs")
-    # Delete all PVCs with the metadata_name prefix
+    _idle_agents.pop(metadata_name, None)
+    logger.info(f"woke up {metadata_name}")
+
+
+def agent_for_host(host):
+    """Idle agent addressed by a Host header
+
+    Agents are reached through `{name}-service` in the cluster and through the
+    `{name}-code-server` and `{name}-http` ingresses.
+    """
+    label = host.split(":")[0].split(".")[0]
+    for suffix in ("-service", "-code-server", "-http"):
+        if label.endswith(suffix) and label[:-len(suffix)] in _idle_agents:
+            return label[:-len(suffix)]
+    return None
+
+
+async def activate(request):
+    """Hold a request to an idle agent until it is up, then send it back
+
+    The redirect is relative, so the client repeats the same request through
+    the same ingress and now reaches the agent.
+    """
+    metadata_name = agent_for_host(request.host)
+    if metadata_name is None:
+        return aiohttp.web.Response(status=503, text="unknown or awake agent, retry\n")
+    logger = logging.getLogger("activator")
+    wake = _wakes.get(metadata_name)
+    if wake is None:
+        wake = _wakes[metadata_name] = asyncio.create_task(wake_agent(metadata_name, logger))
+        wake.add_done_callback(lambda _: _wakes.pop(metadata_name, None))
     try:
-        core_v1_api = kubernetes.client.CoreV1Api()
-        pvcs = core_v1_api.list_namespaced_persistent_volume_claim(
-            namespace=agent_namespace
+        await asyncio.shield(wake)
+    except Exception as e:
+        logger.error(f"Failed to wake {metadata_name}: {e}")
+        return aiohttp.web.Response(status=503, text=f"could not wake {metadata_name}\n")
+    return aiohttp.web.Response(status=307, headers={"Location": request.path_qs, "Retry-After": "0"})
+
+
+@kopf.on.startup()
+async def start_activator(logger, memo, **kwargs):
+    if IDLE_AFTER <= 0:
+        return
+    if not ACTIVATOR_IP:
+        logger.warning("POD_IP is not set, idle agents are never scaled to zero")
+        return
+    app = aiohttp.web.Application()
+    app.router.add_route("*", "/{path:.*}", activate)
+    memo.activator = aiohttp.web.AppRunner(app, access_log=None)
+    await memo.activator.setup()
+    await aiohttp.web.TCPSite(memo.activator, port=ACTIVATOR_PORT).start()
+    logger.info(f"activator listening on {ACTIVATOR_IP}:{ACTIVATOR_PORT}")
+
+
+@kopf.on.cleanup()
+async def stop_activator(memo, **kwargs):
+    runner = memo.get("activator")
+    if runner is not None:
+        await runner.cleanup()
+
+
+# Agent status: kopf follows the labelled objects of every agent through watch
+# events and folds them into status.phase, status.conditions and the timings
+# of status.provisioning, measured from the start of the create handler.
+CONDITION_STAGES = {
+    # condition type -> (timing recorded when it first turns True, True when
+    # every object has to agree rather than any one of them)
+    "PVCsBound": ("pvc_bound", True),
+    "ImagesPulled": ("image_pulled", False),
+    "PodReady": ("pod_ready", False),
+    "Available": (None, False),
+    "PlaywrightReady": (None, False),
+    "RolledOut": (None, True),
+    "IngressReady": ("ingress_ready", True),
+}
+_agent_facts = {}  # agent name -> condition type -> {object name: bool}
+_agent_status = {}  # agent name -> status fields last written by update_agent_status
+_status_locks = {}  # agent name -> asyncio.Lock serializing its status writes
+_provision_started = {}  # agent name -> when its create handler started (ISO 8601)
+_stack_agents = {}  # warm slot -> agent that claimed it, until its status.stack is indexed
+
+
+@kopf.index("kopf.dev.claud-code", "v1", "claud-code")
+def claud_codes(name, namespace, status, **kwargs):
+    return {name: {"namespace": namespace, "status": copy.deepcopy(dict(status or {}))}}
+
+
+def agent_conditions(metadata_name, previous, now):
+    """Conditions of an agent from the last event of each of its objects
+
+    Conditions without any observed object keep their previous value, so a
+    restarted operator does not flap them before its watches catch up.
+    """
+    facts = _agent_facts.get(metadata_name, {})
+    previous = {condition["type"]: condition for condition in previous or []}
+    conditions = []
+    for condition_type, (_, require_all) in CONDITION_STAGES.items():
+        values = list(facts.get(condition_type, {}).values())
+        if not values:
+            if condition_type in previous:
+                conditions.append(previous[condition_type])
+            continue
+        ok = "True" if (all(values) if require_all else any(values)) else "False"
+        last = previous.get(condition_type)
+        conditions.append({
+            "type": condition_type,
+            "status": ok,
+            "lastTransitionTime": last["lastTransitionTime"] if last and last["status"] == ok else now,
+        })
+    return conditions
+
+
+def agent_phase(status, conditions, timings):
+    state = {condition["type"]: condition["status"] for condition in conditions}
+    if (status or {}).get("idle"):
+        return "Idle"
+    if state.get("Available") == "True" and state.get("PlaywrightReady") != "False":
+        return "Running"
+    if "pod_ready" in timings:
+        return "Degraded"
+    return "Provisioning"
+
+
+async def update_agent_status(metadata_name, entry, logger):
+    """Write phase, conditions and new timings of an agent when they changed"""
+    from kubernetes.client.exceptions import ApiException
+
+    async with _status_locks.setdefault(metadata_name, asyncio.Lock()):
+        indexed = entry["status"]
+        current = _agent_status.get(metadata_name) or {
+            "phase": indexed.get("phase"),
+            "conditions": indexed.get("conditions") or [],
+            "provisioning": indexed.get("provisioning") or {},
+        }
+        now = datetime.datetime.now(datetime.timezone.utc)
+        conditions = agent_conditions(metadata_name, current["conditions"], now.isoformat())
+        provisioning = copy.deepcopy(current["provisioning"])
+        timings = provisioning.setdefault("timings", {})
+        started = _provision_started.get(metadata_name) or provisioning.get("started")
+        for condition in conditions:
+            stage = CONDITION_STAGES[condition["type"]][0]
+            if started and stage and stage not in timings and condition["status"] == "True":
+                elapsed = now - datetime.datetime.fromisoformat(started)
+                timings[stage] = round(elapsed.total_seconds(), 2)
+        status = {
+            "phase": agent_phase(indexed, conditions, timings),
+            "conditions": conditions,
+            "provisioning": provisioning,
+        }
+        if status == current:
+            return
+        try:
+            await run_blocking(
+                custom_objects().patch_namespaced_custom_object_status,
+                "kopf.dev.claud-code", "v1", entry["namespace"], "claud-code", metadata_name,
+                {"status": status},
+            )
+        except ApiException as e:
+            if e.status != 404:
+                raise
+            return
+        _agent_status[metadata_name] = status
+        if status["phase"] != current["phase"]:
+            logger.info(f"{metadata_name} is {status['phase']}")
+
+
+async def agent_object_changed(metadata_name, object_name, facts, logger, claud_codes):
+    """Record what an event says about one object and refresh the agent status
+
+    `facts` maps condition types to the object's value, None once it is gone.
+    """
+    for condition_type, value in facts.items():
+        observed = _agent_facts.setdefault(metadata_name, {}).setdefault(condition_type, {})
+        if value is None:
+            observed.pop(object_name, None)
+        else:
+            observed[object_name] = value
+    for entry in claud_codes.get(metadata_name, []):
+        await update_agent_status(metadata_name, entry, logger)
+
+
+def forget_agent_status(metadata_name):
+    for state in (_agent_facts, _agent_status, _status_locks, _provision_started):
+        state.pop(metadata_name, None)
+    for slot in [slot for slot, claimed_by in _stack_agents.items() if claimed_by == metadata_name]:
+        del _stack_agents[slot]
+
+
+def stack_agent(stack_name, claud_codes):
+    """The agent running on a stack, which is itself unless it claimed a warm one
+
+    The Playwright server of a claimed warm stack keeps the slot as its label.
+    """
+    if stack_name in claud_codes:
+        return stack_name
+    if stack_name in _stack_agents:
+        return _stack_agents[stack_name]
+    for metadata_name, entries in claud_codes.items():
+        for entry in entries:
+            if (entry["status"].get("stack") or {}).get("name") == stack_name:
+                return metadata_name
+    return stack_name
+
+
+@kopf.on.event("apps", "v1", "deployments", labels={AGENT_LABEL: kopf.PRESENT})
+async def agent_deployment_event(event, body, name, labels, logger, claud_codes, **kwargs):
+    metadata_name = labels[AGENT_LABEL]
+    condition_type = "Available"
+    if name.endswith("-playwright-server"):
+        condition_type = "PlaywrightReady"
+        metadata_name = stack_agent(metadata_name, claud_codes)
+    deployment_status = body.get("status") or {}
+    available = deployment_status.get("availableReplicas") or 0
+    # Every pod runs the latest template, so an ongoing rollout is not counted as done
+    rolled_out = (
+        (deployment_status.get("observedGeneration") or 0) >= (body["metadata"].get("generation") or 0)
+        and (deployment_status.get("updatedReplicas") or 0) >= ((body.get("spec") or {}).get("replicas") or 0)
+    )
+    facts = {condition_type: available >= 1, "RolledOut": rolled_out}
+    if event["type"] == "DELETED":
+        facts = dict.fromkeys(facts)
+    await agent_object_changed(metadata_name, name, facts, logger, claud_codes)
+
+
+@kopf.on.event("v1", "pods", labels={AGENT_LABEL: kopf.PRESENT})
+async def agent_pod_event(event, body, name, labels, spec, status, logger, claud_codes, **kwargs):
+    if event["type"] == "DELETED":
+        facts = {"ImagesPulled": None, "PodReady": None}
+    else:
+        container_statuses = (status or {}).get("containerStatuses") or []
+        facts = {
+            "ImagesPulled": len(container_statuses) == len(spec.get("containers") or [])
+            and all(container.get("imageID") for container in container_statuses),
+            "PodReady": any(
+                condition["type"] == "Ready" and condition["status"] == "True"
+                for condition in (status or {}).get("conditions") or []
+            ),
+        }
+    await agent_object_changed(labels[AGENT_LABEL], name, facts, logger, claud_codes)
+
+
+@kopf.on.event("v1", "persistentvolumeclaims", labels={AGENT_LABEL: kopf.PRESENT})
+async def agent_pvc_event(event, name, labels, status, logger, claud_codes, **kwargs):
+    value = None if event["type"] == "DELETED" else (status or {}).get("phase") == "Bound"
+    await agent_object_changed(labels[AGENT_LABEL], name, {"PVCsBound": value}, logger, claud_codes)
+
+
+@kopf.on.event("networking.k8s.io", "v1", "ingresses", labels={AGENT_LABEL: kopf.PRESENT})
+async def agent_ingress_event(event, name, labels, status, logger, claud_codes, **kwargs):
+    load_balancer = (status or {}).get("loadBalancer") or {}
+    value = None if event["type"] == "DELETED" else bool(load_balancer.get("ingress"))
+    await agent_object_changed(labels[AGENT_LABEL], name, {"IngressReady": value}, logger, claud_codes)
+
+
+# MCP config hot reload: with MCP_RELOAD set to signal or http, a changed
+# mcp_config is applied to the mounted ConfigMap only; once every agent pod
+# sees the new file, the agent is told to reload it.
+_exec_client = None
+MOUNTED_MCP_HASH_COMMAND = [
+    "sh", "-c",
+    "sha256sum /config/mcp.json 2>/dev/null"
+    " || python3 -c 'import hashlib; print(hashlib.sha256(open(\"/config/mcp.json\", \"rb\").read()).hexdigest())'",
+]
+
+
+def exec_core_v1():
+    """CoreV1Api for pod exec, on an ApiClient of its own
+
+    kubernetes.stream swaps the request method of the client it runs on for a
+    websocket, so exec never goes through the process-wide client.
+    """
+    global _exec_client
+    if _exec_client is None:
+        _exec_client = kubernetes.client.ApiClient(api_client().configuration)
+    return kubernetes.client.CoreV1Api(_exec_client)
+
+
+def exec_in_pod(pod_name, namespace, container, command):
+    """Output of a command run in a pod container"""
+    import kubernetes.stream
+
+    return kubernetes.stream.stream(
+        exec_core_v1().connect_get_namespaced_pod_exec, pod_name, namespace,
+        container=container, command=command, stderr=True, stdin=False, stdout=True, tty=False,
+    )
+
+
+def ready_agent_pods(metadata_name, agent_namespace):
+    pods = core_v1().list_namespaced_pod(agent_namespace, label_selector=f"app={metadata_name}")
+    return [
+        pod for pod in pods.items
+        if pod.metadata.deletion_timestamp is None and any(
+            condition.type == "Ready" and condition.status == "True"
+            for condition in (pod.status.conditions or [])
         )
-        for pvc in pvcs.items:
-            if pvc.metadata.name.startswith(f"{metadata_name}-"):
-                try:
-                    core_v1_api.delete_namespaced_persistent_volume_claim(
-                        name=pvc.metadata.name, namespace=agent_namespace
-                    )
-                    logger.info(f"deleted pvc: {pvc.metadata.name}")
-                except ApiException as e:
-                    if e.status != 404:
-                        raise
-    except ApiException as e:
-        logger.error(f"Error listing/deleting PVCs: {e}")
+    ]
 
-    # Clean up RBAC resources
+
+def restart_agent(metadata_name, agent_namespace):
+    """Roll the agent deployment, as `kubectl rollout restart` does"""
+    now = datetime.datetime.now(datetime.timezone.utc).isoformat()
+    apps_v1().patch_namespaced_deployment(
+        name=metadata_name, namespace=agent_namespace,
+        body={"spec": {"template": {"metadata": {"annotations": {"kubectl.kubernetes.io/restartedAt": now}}}}},
+    )
+
+
+async def wait_mounted_mcp_config(pod, agent_namespace, container, digest):
+    deadline = time.monotonic() + MCP_RELOAD_TIMEOUT
+    while time.monotonic() < deadline:
+        output = await run_blocking(exec_in_pod, pod.metadata.name, agent_namespace, container, MOUNTED_MCP_HASH_COMMAND)
+        if digest in output:
+            return
+        await asyncio.sleep(5)
+    raise TimeoutError(f"{pod.metadata.name} did not see the new mcp.json within {MCP_RELOAD_TIMEOUT:.0f}s")
+
+
+async def reload_mcp_config(body, stack, logger):
+    """Have every running agent pod reload its MCP config, restarting them if that fails"""
+    metadata_name = body["metadata"]["name"]
+    agent_namespace = stack["namespace"]
+    digest = hashlib.sha256(mcp_config_json(body.get("mcp_config", {})).encode()).hexdigest()
     try:
-        kubernetes.client.RbacAuthorizationV1Api().delete_namespaced_role_binding(
-            name=f"{metadata_name}-agent-binding", namespace=agent_namespace
-        )
-    except ApiException as e:
-        if e.status != 404:
-            raise
-    logger.info("deleted role binding")
+        for pod in await run_blocking(ready_agent_pods, metadata_name, agent_namespace):
+            await wait_mounted_mcp_config(pod, agent_namespace, metadata_name, digest)
+            if MCP_RELOAD == "signal":
+                await run_blocking(exec_in_pod, pod.metadata.name, agent_namespace, metadata_name, ["sh", "-c", "kill -HUP 1"])
+            else:
+                async with aiohttp.ClientSession(timeout=aiohttp.ClientTimeout(total=30)) as session:
+                    async with session.post(f"http://{pod.status.pod_ip}:8081{MCP_RELOAD_PATH}") as response:
+                        response.raise_for_status()
+            logger.info(f"{pod.metadata.name} reloaded its MCP config")
+    except Exception as e:
+        logger.warning(f"could not reload the MCP config of {metadata_name} in place ({e}), restarting it")
+        await run_blocking(restart_agent, metadata_name, agent_namespace)
+
+
+@kopf.on.create("kopf.dev.claud-code", "v1", "claud-code")
+@instrumented("create")
+async def create_claud_code_fn(body, name, namespace, logger, patch, **kwargs):
+    """Provision an agent, resuming where a failed attempt stopped
+
+    The stack and PVC names are chosen once and recorded in status before
+    anything is applied, along with the provisioning steps that finished when
+    an attempt fails; kopf stores both with its retry state. A retry reuses
+    the names, so no PVCs are orphaned and no second warm stack is claimed,
+    and runs only the steps that did not finish.
+    """
+    logging.info(f"A handler is called with body: {body}")
+    metadata_name = body["metadata"]["name"]
+    started = time.monotonic()
+    status = body.get("status") or {}
+    provisioning = dict(status.get("provisioning") or {})
+    provisioning.setdefault("started", datetime.datetime.now(datetime.timezone.utc).isoformat())
+    _provision_started[metadata_name] = provisioning["started"]
 
+    stack, pvc_names = status.get("stack"), status.get("pvcs")
+    if stack and pvc_names:
+        stack, pvc_names = dict(stack), dict(pvc_names)
+        logger.info(f"resuming provisioning of {metadata_name} after {sorted(provisioning.get('steps') or {})}")
+    else:
+        stack = None
+        volumes = volume_settings(body)
+        storage_classes = {volume: volumes[volume]["storage_class"] for volume in ("data", "metadata")}
+        idle_namespaces = kwargs.get("idle_warm_namespaces", {}).get("idle", [])
+        if WARM_POOL_SIZE > 0 and idle_namespaces and await run_blocking(fits_warm_stack, volumes):
+            stack = await run_blocking(claim_warm_stack, metadata_name, list(idle_namespaces), logger)
+        if stack is not None:
+            pvc_names = warm_pvc_names(stack["name"])
+            # The slot's Playwright server was ready before the claim
+            _stack_agents[stack["name"]] = metadata_name
+            slot_facts = _agent_facts.pop(stack["name"], {})
+            if "PlaywrightReady" in slot_facts:
+                _agent_facts.setdefault(metadata_name, {})["PlaywrightReady"] = slot_facts["PlaywrightReady"]
+        else:
+            stack = agent_stack(body)
+            # Generate unique IDs for PVCs to avoid conflicts
+            unique_id = str(uuid.uuid4())[:8]  # Use first 8 chars of UUID
+            pvc_names = {
+                "metadata": f"{metadata_name}-metadata-{unique_id}",
+                "data": f"{metadata_name}-data-{unique_id}",
+            }
+            if DATA_TEMPLATE_CLONE and body.get("data_template"):
+                # Kept with the names, as the data source of a PVC cannot change
+                pvc_names["template"] = body["data_template"]
+                template_pvc = await run_blocking(
+                    read_object, "PersistentVolumeClaim", SHARED_NAMESPACE, data_template_name(body["data_template"]),
+                )
+                if template_pvc is None:
+                    raise kopf.TemporaryError(f"data template {body['data_template']} has no volume yet", delay=30)
+                pvc_names["template_size"] = template_pvc["spec"]["resources"]["requests"]["storage"]
+        patch.status["pvcs"] = pvc_names
+        patch.status["stack"] = stack
+        patch.status["storage_classes"] = storage_classes
+        logger.info(f"creating claud-code agent in namespace: {stack['namespace']}")
+
+    applying = time.monotonic() - started
+    body = await run_blocking(with_image_digests, body, patch, logger)
+    steps = dict(provisioning.get("steps") or {})
     try:
-        kubernetes.client.RbacAuthorizationV1Api().delete_namespaced_role(
-            name=f"{metadata_name}-agent-role", namespace=agent_namespace
+        finished = await reconcile_agent(body, stack, pvc_names, logger, cached_objects(metadata_name, kwargs), steps)
+    except Exception:
+        patch.status["provisioning"] = dict(provisioning, steps=steps)
+        raise
+    record_observed(body, patch)
+    stack_steps = [finished[step] for step in ("namespace", "service-account", "role", "role-binding")]
+    patch.status["provisioning"] = {
+        "started": provisioning["started"],
+        "timings": {
+            "namespace_rbac": round(applying + max(stack_steps), 2),
+            "applied": round(time.monotonic() - started, 2),
+        },
+        "steps": None,
+    }
+    logger.info(f"provisioned claud-code agent {metadata_name} in {time.monotonic() - started:.2f}s")
+
+
+def provisioning_finished(status):
+    """Whether the create handler got through, or the agent predates status.provisioning"""
+    provisioning = (status or {}).get("provisioning")
+    return provisioning is None or "applied" in (provisioning.get("timings") or {})
+
+
+def teardown_collections():
+    """Collection deletes for every namespaced kind the operator creates"""
+    core_v1_api, apps_v1_api = core_v1(), apps_v1()
+    rbac_v1_api, networking_v1_api = rbac_v1(), networking_v1()
+    return {
+        "deployments": apps_v1_api.delete_collection_namespaced_deployment,
+        "services": core_v1_api.delete_collection_namespaced_service,
+        "ingresses": networking_v1_api.delete_collection_namespaced_ingress,
+        "configmaps": core_v1_api.delete_collection_namespaced_config_map,
+        "secrets": core_v1_api.delete_collection_namespaced_secret,
+        "pvcs": core_v1_api.delete_collection_namespaced_persistent_volume_claim,
+        "endpoint slices": discovery_v1().delete_collection_namespaced_endpoint_slice,
+        "role bindings": rbac_v1_api.delete_collection_namespaced_role_binding,
+        "roles": rbac_v1_api.delete_collection_namespaced_role,
+        "service accounts": core_v1_api.delete_collection_namespaced_service_account,
+    }
+
+
+def delete_labelled(delete_collection_fn, description, agent_namespace, label_selector, logger):
+    from kubernetes.client.exceptions import ApiException
+
+    try:
+        delete_collection_fn(
+            namespace=agent_namespace,
+            label_selector=label_selector,
+            propagation_policy="Background",
         )
     except ApiException as e:
         if e.status != 404:
             raise
-    logger.info("deleted role")
+    logger.info(f"deleted {description}")
+
+
+def legacy_teardown(metadata_name, agent_namespace):
+    """Deletes by name of what operators before the agent label created for an agent
+
+    Such agents have no status.pvcs, and their objects are found by the names
+    they were given then; the PVCs by their `{name}-` prefix.
+    """
+    core_v1_api, apps_v1_api = core_v1(), apps_v1()
+    rbac_v1_api, networking_v1_api = rbac_v1(), networking_v1()
+    return {
+        f"deployment {metadata_name}": (apps_v1_api.delete_namespaced_deployment, metadata_name),
+        f"deployment {metadata_name}-playwright-server": (
+            apps_v1_api.delete_namespaced_deployment, f"{metadata_name}-playwright-server",
+        ),
+        f"service {metadata_name}-service": (core_v1_api.delete_namespaced_service, f"{metadata_name}-service"),
+        "service playwright-server": (core_v1_api.delete_namespaced_service, "playwright-server"),
+        f"ingress {metadata_name}-code-server-ingress": (
+            networking_v1_api.delete_namespaced_ingress, f"{metadata_name}-code-server-ingress",
+        ),
+        f"ingress {metadata_name}-http-ingress": (
+            networking_v1_api.delete_namespaced_ingress, f"{metadata_name}-http-ingress",
+        ),
+        f"configmap {metadata_name}-mcp-config": (
+            core_v1_api.delete_namespaced_config_map, f"{metadata_name}-mcp-config",
+        ),
+        f"role binding {metadata_name}-agent-binding": (
+            rbac_v1_api.delete_namespaced_role_binding, f"{metadata_name}-agent-binding",
+        ),
+        f"role {metadata_name}-agent-role": (rbac_v1_api.delete_namespaced_role, f"{metadata_name}-agent-role"),
+        f"service account {metadata_name}-agent-sa": (
+            core_v1_api.delete_namespaced_service_account, f"{metadata_name}-agent-sa",
+        ),
+    }
+
+
+def delete_named(delete_fn, description, name, agent_namespace, logger):
+    from kubernetes.client.exceptions import ApiException
 
     try:
-        kubernetes.client.CoreV1Api().delete_namespaced_service_account(
-            name=f"{metadata_name}-agent-sa", namespace=agent_namespace
-        )
+        delete_fn(name=name, namespace=agent_namespace, propagation_policy="Background")
     except ApiException as e:
         if e.status != 404:
             raise
-    logger.info("deleted service account")
+    logger.info(f"deleted {description}")
+
+
+def delete_legacy_pvcs(metadata_name, agent_namespace, logger):
+    """Delete the PVCs named `{name}-...` of an agent from before the agent label"""
+    from kubernetes.client.exceptions import ApiException
+
+    for pvc in core_v1().list_namespaced_persistent_volume_claim(namespace=agent_namespace).items:
+        if not pvc.metadata.name.startswith(f"{metadata_name}-"):
+            continue
+        try:
+            core_v1().delete_namespaced_persistent_volume_claim(name=pvc.metadata.name, namespace=agent_namespace)
+        except ApiException as e:
+            if e.status != 404:
+                raise
+        logger.info(f"deleted pvc: {pvc.metadata.name}")
+
 
-    # Optionally delete the namespace (uncomment if you want to clean up completely)
-    # try:
-    #     kubernetes.client.CoreV1Api().delete_namespace(name=agent_namespace)
-    # except ApiException as e:
-    #     if e.status != 404:
-    #         raise
-    # logger.info(f"deleted namespace: {agent_namespace}")
+def delete_namespace_requested(body):
+    """Whether teardown removes the whole agent namespace instead of its objects"""
+    value = body.get("delete_namespace")
+    if value is None:
+        return DELETE_NAMESPACE
+    return bool(value)
 
-    logger.info("deleted claud-code")
+
+@kopf.on.delete("kopf.dev.claud-code", "v1", "claud-code")
+@instrumented("delete")
+async def delete_claud_code_fn(body, logger, **kwargs):
+    from kubernetes.client.exceptions import ApiException
+
+    logging.info(f"A handler is called with body: {body}")
+    metadata_name = body["metadata"]["name"]
+    stack = agent_stack(body)
+    agent_namespace = stack["namespace"]
+    logger.info(f"deleting claud-code agent from namespace: {agent_namespace}")
+    started = time.monotonic()
+    forget_agent_status(metadata_name)
+
+    data_template = ((body.get("status") or {}).get("pvcs") or {}).get("template")
+    if data_template:
+        await run_blocking(delete_data_template_grant, data_template, agent_namespace, logger)
+
+    # A claimed warm stack belongs to this agent alone and is never reused.
+    if stack.get("warm") or delete_namespace_requested(body):
+        try:
+            await run_blocking(
+                core_v1().delete_namespace,
+                name=agent_namespace, propagation_policy="Background",
+            )
+        except ApiException as e:
+            if e.status != 404:
+                raise
+        logger.info(f"deleted namespace: {agent_namespace}")
+        return
+
+    # Everything the operator creates carries the agent label, so each kind is
+    # one label-selected deletecollection, and all kinds go out at once.
+    label_selector = f"{AGENT_LABEL}={metadata_name}"
+    steps = {
+        description: ((), functools.partial(
+            delete_labelled, delete_collection_fn, description,
+            agent_namespace, label_selector, logger,
+        ))
+        for description, delete_collection_fn in teardown_collections().items()
+    }
+    # Agents from before the label (no status.pvcs) are also deleted by name
+    if not (body.get("status") or {}).get("pvcs"):
+        logger.info(f"{metadata_name} predates the agent label, also deleting its objects by name")
+        for description, (delete_fn, name) in legacy_teardown(metadata_name, agent_namespace).items():
+            steps[description] = ((), functools.partial(
+                delete_named, delete_fn, description, name, agent_namespace, logger,
+            ))
+        steps["legacy pvcs"] = ((), functools.partial(delete_legacy_pvcs, metadata_name, agent_namespace, logger))
+    await run_provisioning_graph(steps, logger, concurrency=len(steps))
+    logger.info(f"deleted claud-code in {time.monotonic() - started:.2f}s")
 
 
 @kopf.on.update("kopf.dev.claud-code", "v1", "claud-code")
-def update_claud_code_fn(body, name, namespace, logger, diff, **kwargs):
-    import kubernetes
+@instrumented("update")
+async def update_claud_code_fn(body, name, namespace, logger, diff, status, patch, **kwargs):
     from kubernetes.client.exceptions import ApiException
 
     metadata_name = body["metadata"]["name"]
-    agent_namespace = metadata_name  # Use agent name as namespace
+    stack = agent_stack(body)
+    agent_namespace = stack["namespace"]
     
     # Track what changes were made
     system_prompt_changed = False
     data_changed = False
     mcp_config_changed = False
     version_changed = False
+    resources_changed = False
+    data_template_changed = False
+    volumes_changed = False
+    images_refreshed = image_refresh_requested(body)
     
     # Check what fields changed
     for d in diff:
@@ -790,240 +3317,629 @@ def update_claud_code_fn(body, name, namespace, logger, diff, **kwargs):
         elif d[1] == ("version",):
             version_changed = True
             logger.info(f"version changed: {d}")
-    if not system_prompt_changed and not data_changed and not mcp_config_changed and not version_changed:
+        elif d[1] == ("size",) or (len(d[1]) > 0 and d[1][0] == "resources"):
+            resources_changed = True
+            logger.info(f"resources changed: {d}")
+        elif d[1] == ("data_template",):
+            data_template_changed = True
+            logger.info(f"data_template changed: {d}")
+        elif len(d[1]) > 0 and d[1][0] == "volumes":
+            volumes_changed = True
+            logger.info(f"volumes changed: {d}")
+    if images_refreshed:
+        logger.info(f"{IMAGE_REFRESH_ANNOTATION} changed, resolving images again")
+    if not system_prompt_changed and not data_changed and not mcp_config_changed and not version_changed and not resources_changed and not data_template_changed and not volumes_changed and not images_refreshed:
         logger.info("No relevant fields changed, skipping update.")
+        record_observed(body, patch)
         return
 
     logger.info(f"Updating claud-code resource {metadata_name} in namespace {agent_namespace}")
 
-    # Handle system_prompt updates
-    if system_prompt_changed:
-        new_system_prompt = body.get("system_prompt")
-        logger.info(f"Updating system prompt for deployment {metadata_name}")
+    cache = cached_objects(metadata_name, kwargs)
+    try:
+        pvc_names = await run_blocking(agent_pvc_names, body, stack, status, patch, logger, cache)
+    except ApiException as e:
+        if e.status == 404:
+            logger.error(f"Deployment {metadata_name} not found in namespace {agent_namespace}")
+            return
+        raise
 
-        # Get the current deployment
-        apps_v1_api = kubernetes.client.AppsV1Api()
-        try:
-            deployment = apps_v1_api.read_namespaced_deployment(
-                name=metadata_name, namespace=agent_namespace
-            )
-        except ApiException as e:
-            if e.status == 404:
-                logger.error(f"Deployment {metadata_name} not found in namespace {agent_namespace}")
-                return
-            else:
-                raise
+    if volumes_changed:
+        check_volume_sizes(body, pvc_names, cache, logger)
 
-        # Update the system prompt in the container args
-        updated = False
-        for container in deployment.spec.template.spec.containers:
-            if container.name == metadata_name:
-                if container.args is None:
-                    container.args = []
-                if "--system-prompt" in container.args:
-                    idx = container.args.index("--system-prompt")
-                    if idx + 1 < len(container.args):
-                        container.args[idx + 1] = new_system_prompt
-                        updated = True
-                else:
-                    container.args.extend(["--system-prompt", new_system_prompt])
-                    updated = True
-
-        if updated:
-            # Patch the deployment with the new args
-            try:
-                patch_body = {
-                    "spec": {
-                        "template": {
-                            "spec": {
-                                "containers": [
-                                    {"name": metadata_name, "args": container.args}
-                                ]
-                            }
-                        }
-                    }
-                }
-                apps_v1_api.patch_namespaced_deployment(
-                    name=metadata_name, namespace=agent_namespace, body=patch_body
-                )
-                logger.info(f"Successfully updated system prompt for deployment {metadata_name}")
-            except ApiException as e:
-                logger.error(f"Failed to patch deployment: {e}")
-                raise
+    # Re-apply the desired state as one apply per object; the deployment gets a
+    # single request covering every change in the diff, so one ReplicaSet, and
+    # none at all when the rendered configuration hash did not change.
+    body = await run_blocking(with_image_digests, body, patch, logger)
+    deployment_key = ("Deployment", agent_namespace, metadata_name)
+    if cache is not None:
+        live = cache.get(("Deployment", metadata_name)) or {}
+        applied = (live.get("metadata", {}).get("annotations") or {}).get(APPLIED_HASH_ANNOTATION)
+    else:
+        applied = _applied_hashes.get(deployment_key)
+    await reconcile_agent(body, stack, pvc_names, logger, cache)
+    # A new deployment manifest rolls the pod anyway, and the new one reads the
+    # new file; its replicas only change on idling, which skips the reload too
+    rolled = _applied_hashes.get(deployment_key, applied) != applied
+    if mcp_config_changed and MCP_RELOAD != "restart" and not rolled and not agent_idle(body):
+        await reload_mcp_config(body, stack, logger)
+    record_observed(body, patch)
+
+    logger.info(f"Update handler completed for {metadata_name}")
+
+
+@kopf.on.resume("kopf.dev.claud-code", "v1", "claud-code")
+@instrumented("resume")
+async def resume_claud_code_fn(body, name, status, patch, logger, **kwargs):
+    """Re-apply agents on operator start only when their spec or the operator changed since the last apply
+
+    Agents whose status.specHash matches are skipped without any API call, so
+    a restart costs the same however many agents there are. Agents that never
+    finished provisioning are left to their create handler, which resumes.
+    """
+    if (status or {}).get("specHash") == spec_hash(body):
+        logger.debug(f"{name} is unchanged since generation {status.get('observedGeneration')}, skipping")
+        return
+    pvc_names = (status or {}).get("pvcs")
+    if not pvc_names or not provisioning_finished(status):
+        return
+
+    logger.info(f"{name} or the operator changed since it was last applied, re-applying it")
+    body = await run_blocking(with_image_digests, body, patch, logger)
+    await reconcile_agent(body, agent_stack(body), pvc_names, logger, cached_objects(name, kwargs))
+    record_observed(body, patch)
+
+
+# Drift repair: a daemon per agent compares the rendered objects with the live
+# ones every DRIFT_INTERVAL and patches only the fields that differ, so hand
+# edits and deleted objects are undone without waiting for the next CR change.
+def quantities_equal(desired, live):
+    try:
+        return kubernetes.utils.parse_quantity(desired) == kubernetes.utils.parse_quantity(live)
+    except (ValueError, TypeError):
+        return False
+
+
+def drift_patch(desired, live):
+    """Smallest merge patch turning `live` into `desired`, or None when nothing drifted
+
+    Only fields set in `desired` are compared, so defaults filled in by the
+    apiserver and fields of other managers are not drift. Lists are atomic in
+    a merge patch, so a list with any differing item is sent whole.
+    """
+    if isinstance(desired, dict):
+        if not isinstance(live, dict):
+            return desired or None
+        patch = {}
+        for key, value in desired.items():
+            field_patch = drift_patch(value, live.get(key))
+            if field_patch is not None:
+                patch[key] = field_patch
+        return patch or None
+    if isinstance(desired, list):
+        if not isinstance(live, list) or len(desired) != len(live):
+            return desired
+        if any(drift_patch(item, live_item) is not None for item, live_item in zip(desired, live)):
+            return desired
+        return None
+    if desired == live or (isinstance(desired, str) and isinstance(live, str) and quantities_equal(desired, live)):
+        return None
+    return desired
+
+
+def patch_fields(patch, prefix=""):
+    """Dotted paths of the fields a drift patch sets, for the log"""
+    for key, value in patch.items():
+        if isinstance(value, dict) and value:
+            yield from patch_fields(value, f"{prefix}{key}.")
         else:
-            logger.info("No update needed for system prompt in deployment.")
-
-    # Handle data field updates
-    if data_changed:
-        data_field = body.get("data", {})
-        logger.info(f"Updating data field: {data_field}")
-        
-        # Update API secrets if API keys are in the data field
-        if "ANTHROPIC_API_KEY" in data_field or "OPENAI_API_KEY" in data_field:
-            logger.info("API keys found in data field, updating secrets")
-            try:
-                core_v1_api = kubernetes.client.CoreV1Api()
-                
-                # Update Anthropic API key if present
-                if "ANTHROPIC_API_KEY" in data_field:
-                    anthropic_key = data_field["ANTHROPIC_API_KEY"]
-                    secret_data = {"ANTHROPIC_API_KEY": base64.b64encode(anthropic_key.encode()).decode()}
-                    secret = kubernetes.client.V1Secret(
-                        metadata=kubernetes.client.V1ObjectMeta(name="anthropic-api-key"),
-                        data=secret_data,
-                        type="Opaque"
-                    )
-                    try:
-                        core_v1_api.replace_namespaced_secret(
-                            name="anthropic-api-key", namespace=agent_namespace, body=secret
-                        )
-                        logger.info("Updated anthropic-api-key secret")
-                    except ApiException as e:
-                        if e.status == 404:
-                            core_v1_api.create_namespaced_secret(namespace=agent_namespace, body=secret)
-                            logger.info("Created anthropic-api-key secret")
-                        else:
-                            raise
-                
-                # Update OpenAI API key if present
-                if "OPENAI_API_KEY" in data_field:
-                    openai_key = data_field["OPENAI_API_KEY"]
-                    secret_data = {"OPENAI_API_KEY": base64.b64encode(openai_key.encode()).decode()}
-                    secret = kubernetes.client.V1Secret(
-                        metadata=kubernetes.client.V1ObjectMeta(name="openai-api-key"),
-                        data=secret_data,
-                        type="Opaque"
-                    )
-                    try:
-                        core_v1_api.replace_namespaced_secret(
-                            name="openai-api-key", namespace=agent_namespace, body=secret
-                        )
-                        logger.info("Updated openai-api-key secret")
-                    except ApiException as e:
-                        if e.status == 404:
-                            core_v1_api.create_namespaced_secret(namespace=agent_namespace, body=secret)
-                            logger.info("Created openai-api-key secret")
-                        else:
-                            raise
-                    
-            except Exception as e:
-                logger.error(f"Failed to update API secrets: {e}")
-                raise
-        
-        # Handle other data field updates
-        logger.info(f"Data field updated with: {list(data_field.keys())}")
-
-    # Handle mcp_config updates
-    if mcp_config_changed:
-        mcp_config = body.get("mcp_config", {})
-        logger.info(f"Updating MCP config for {metadata_name}")
-        
-        # Update the MCP config ConfigMap
-        import json
-        mcp_config_name = f"{metadata_name}-mcp-config"
-        mcp_config_json = json.dumps(mcp_config, indent=2)
-        mcp_configmap = kubernetes.client.V1ConfigMap(
-            metadata=kubernetes.client.V1ObjectMeta(name=mcp_config_name),
-            data={"mcp.json": mcp_config_json},
+            yield f"{prefix}{key}"
+
+
+def read_object(kind, obj_namespace, name):
+    """An object as a dict, or None when it does not exist"""
+    from kubernetes.client.exceptions import ApiException
+
+    try:
+        return api_client().call_api(
+            object_path(kind, obj_namespace, name),
+            "GET",
+            header_params={"Accept": "application/json"},
+            auth_settings=["BearerToken"],
+            response_type="object",
+            _return_http_data_only=True,
         )
-        
-        try:
-            core_v1_api = kubernetes.client.CoreV1Api()
-            core_v1_api.replace_namespaced_config_map(
-                name=mcp_config_name, namespace=agent_namespace, body=mcp_configmap
-            )
-            logger.info(f"Successfully updated MCP config ConfigMap {mcp_config_name}")
-        except ApiException as e:
-            logger.error(f"Failed to update MCP config ConfigMap: {e}")
+    except ApiException as e:
+        if e.status != 404:
             raise
+        return None
 
-    # Handle version updates
-    if version_changed:
-        new_version = body.get("version")
-        logger.info(f"Updating version for deployment {metadata_name} to {new_version}")
-        # Get the current deployment
-        apps_v1_api = kubernetes.client.AppsV1Api()
-        try:
-            deployment = apps_v1_api.read_namespaced_deployment(
-                name=metadata_name, namespace=agent_namespace
-            )
-        except ApiException as e:
-            if e.status == 404:
-                logger.error(f"Deployment {metadata_name} not found in namespace {agent_namespace}")
-                return
-            else:
-                raise
-        
-        # update the image tag with the new version
-        updated = False
-        for container in deployment.spec.template.spec.containers:
-            if container.name == metadata_name:
-                container.image = f"wholelottahoopla/webagent:{new_version}"
-                updated = True
-        
-        if updated:
-            # Patch the deployment with the new image tag
-            try:
-                patch_body = {
-                    "spec": {
-                        "template": {
-                            "spec": {
-                                "containers": [
-                                    {
-                                        "name": metadata_name,
-                                        "image": container.image,
-                                        "args": container.args
-                                    }
-                                ]
-                            }
-                        }
-                    }
-                }
-                apps_v1_api.patch_namespaced_deployment(
-                    name=metadata_name, namespace=agent_namespace, body=patch_body
-                )
-                logger.info(f"Successfully updated image tag for deployment {metadata_name}")
-            except ApiException as e:
-                logger.error(f"Failed to patch deployment: {e}")
-                raise
+
+def drift_desired(obj):
+    """The fields of a rendered object that drift_patch compares with the live one"""
+    desired = {key: value for key, value in obj.items() if key not in ("apiVersion", "kind", "metadata")}
+    desired["metadata"] = {key: obj["metadata"][key] for key in ("labels", "annotations") if key in obj["metadata"]}
+    return desired
+
+
+def repair_drift(manifests, logger, cache=None, full=False):
+    """Recreate missing objects and merge patch the drifted fields of the others
+
+    Kinds in the informer indices are compared with `cache` at no API cost;
+    the other kinds are only read when `full` is set. Returns the number of
+    objects repaired.
+    """
+    repaired = 0
+    for manifest in manifests:
+        obj = api_client().sanitize_for_serialization(manifest)
+        metadata = obj["metadata"]
+        kind, name, obj_namespace = obj["kind"], metadata["name"], metadata.get("namespace")
+        if cache is not None and kind in OWNED_INDICES:
+            live = cache.get((kind, name))
+        elif full:
+            live = read_object(kind, obj_namespace, name)
         else:
-            logger.info("No update needed for image tag in deployment.")
-
-    # Trigger deployment rollout if any changes were made
-    if system_prompt_changed or data_changed or mcp_config_changed or version_changed:
-        logger.info(f"Triggering deployment rollout for {metadata_name}")
-        
-        # Get the deployment and add/update restart annotation
-        apps_v1_api = kubernetes.client.AppsV1Api()
-        try:
-            deployment = apps_v1_api.read_namespaced_deployment(
-                name=metadata_name, namespace=agent_namespace
-            )
-            
-            # Add or update restart annotation to trigger pod restart
-            import datetime
-            if deployment.spec.template.metadata.annotations is None:
-                deployment.spec.template.metadata.annotations = {}
-            deployment.spec.template.metadata.annotations["kubectl.kubernetes.io/restartedAt"] = datetime.datetime.now(datetime.timezone.utc).isoformat()
-            
-            # Patch only the annotation to trigger rollout
-            patch_body = {
-                "spec": {
-                    "template": {
-                        "metadata": {
-                            "annotations": {
-                                "kubectl.kubernetes.io/restartedAt": deployment.spec.template.metadata.annotations["kubectl.kubernetes.io/restartedAt"]
-                            }
-                        }
-                    }
-                }
-            }
-            apps_v1_api.patch_namespaced_deployment(
-                name=metadata_name, namespace=agent_namespace, body=patch_body
+            continue
+
+        if live is None:
+            _applied_hashes.pop((kind, obj_namespace, name), None)
+            apply_manifest(manifest, logger, cache)
+            logger.warning(f"{kind} {name} was missing, recreated it")
+        else:
+            patch = drift_patch(drift_desired(obj), live)
+            if patch is None:
+                continue
+            api_client().call_api(
+                object_path(kind, obj_namespace, name),
+                "PATCH",
+                query_params=[("fieldManager", FIELD_MANAGER)],
+                header_params={
+                    "Accept": "application/json",
+                    "Content-Type": "application/merge-patch+json",
+                },
+                body=patch,
+                auth_settings=["BearerToken"],
+                response_type="object",
+                _return_http_data_only=True,
             )
-            logger.info(f"Successfully triggered rollout restart for deployment {metadata_name}")
-        except ApiException as e:
-            logger.error(f"Failed to trigger deployment rollout: {e}")
+            logger.warning(f"{kind} {name} drifted, patched {', '.join(patch_fields(patch))}")
+        DRIFT_REPAIRS.inc(kind=kind)
+        repaired += 1
+    return repaired
+
+
+def drift_offset(namespace, metadata_name):
+    """Where in the interval an agent is checked, so the checks of all agents are spread evenly"""
+    digest = hashlib.sha256(f"{namespace}/{metadata_name}".encode()).digest()
+    return int.from_bytes(digest[:8], "big") / 2**64 * DRIFT_INTERVAL
+
+
+@kopf.daemon(
+    "kopf.dev.claud-code", "v1", "claud-code",
+    cancellation_timeout=1.0, when=lambda **_: DRIFT_INTERVAL > 0,
+)
+async def drift_claud_code_fn(body, name, namespace, logger, stopped, **kwargs):
+    await stopped.wait(drift_offset(namespace, name))
+    # The first full check comes DRIFT_FULL_EVERY checks in, so operator
+    # restarts do not read every agent's secrets and RBAC at once.
+    checks = 0
+    while not stopped:
+        # Agents still provisioning are left to their create handler, and
+        # agents without recorded image digests to the next reconcile.
+        status = body.get("status") or {}
+        pvc_names = status.get("pvcs")
+        pinned = not PIN_IMAGES or "images" in status
+        if pvc_names and provisioning_finished(status) and pinned:
+            try:
+                cache = cached_objects(name, kwargs)
+                manifests = [
+                    manifest
+                    for _, step_manifests in render_agent(body, agent_stack(body), pvc_names, logger).values()
+                    for manifest in step_manifests
+                ]
+                checks += 1
+                full = checks % max(DRIFT_FULL_EVERY, 1) == 0
+                repaired = await run_blocking(repair_drift, manifests, logger, cache, full)
+                if repaired:
+                    logger.info(f"repaired {repaired} drifted objects of {name}")
+            except Exception as e:
+                logger.error(f"Failed to check {name} for drift: {e}")
+        await stopped.wait(DRIFT_INTERVAL)
+
+
+# ClaudCodeFleet: `replicas` ClaudCode children named {fleet}-{index}, applied
+# from one template. Each child provisions itself through the handlers above;
+# the fleet only decides which children to create, update or delete, and how
+# many at a time.
+FLEET_LABEL = "kopf-agent.dev/fleet"
+FLEET_INDEX_LABEL = "kopf-agent.dev/fleet-index"
+TEMPLATE_HASH_ANNOTATION = "kopf-agent.dev/template-hash"
+
+
+@kopf.index("kopf.dev.claud-code", "v1", "claud-code", labels={FLEET_LABEL: kopf.PRESENT})
+def fleet_children(name, namespace, labels, annotations, meta, status, **kwargs):
+    status = status or {}
+    conditions = {condition["type"]: condition["status"] for condition in status.get("conditions") or []}
+    return {(namespace, labels[FLEET_LABEL]): {
+        "name": name,
+        "index": int(labels[FLEET_INDEX_LABEL]),
+        "template_hash": annotations.get(TEMPLATE_HASH_ANNOTATION),
+        "phase": status.get("phase"),
+        # The last applied spec is handled and the deployments run it
+        "rolled_out": status.get("observedGeneration") == meta.get("generation")
+        and conditions.get("RolledOut") != "False",
+    }}
+
+
+def build_fleet_child(fleet_body, index, template, template_hash):
+    fleet_name = fleet_body["metadata"]["name"]
+    child = {
+        "apiVersion": "kopf.dev.claud-code/v1",
+        "kind": "ClaudCode",
+        "metadata": {
+            "name": f"{fleet_name}-{index}",
+            "namespace": fleet_body["metadata"]["namespace"],
+            "labels": {
+                "app.kubernetes.io/managed-by": FIELD_MANAGER,
+                FLEET_LABEL: fleet_name,
+                FLEET_INDEX_LABEL: str(index),
+            },
+            "annotations": {TEMPLATE_HASH_ANNOTATION: template_hash},
+        },
+        **copy.deepcopy(template),
+    }
+    kopf.append_owner_reference(child, owner=fleet_body)
+    return child
+
+
+def apply_fleet_child(child, logger):
+    """Apply a child the fleet found missing or stale, whatever this process applied before"""
+    metadata = child["metadata"]
+    _applied_hashes.pop(("ClaudCode", metadata["namespace"], metadata["name"]), None)
+    apply_manifest(child, logger)
+
+
+def delete_fleet_child(namespace, child_name, logger):
+    from kubernetes.client.exceptions import ApiException
+
+    try:
+        custom_objects().delete_namespaced_custom_object(
+            "kopf.dev.claud-code", "v1", namespace, "claud-code", child_name,
+        )
+    except ApiException as e:
+        if e.status != 404:
             raise
+    logger.info(f"deleted fleet agent {child_name}")
 
-    logger.info(f"Update handler completed for {metadata_name}")
+
+def plan_fleet(children, replicas, template_hash, max_parallel, max_surge, max_unavailable):
+    """Indices to create, and children to update and delete, in this pass
+
+    Scaling up keeps at most `max_parallel` children provisioning. A template
+    change is rolled out by re-applying children in place: each one rolls its
+    deployment surge-first, so `max_surge` children may be updating while all
+    stay available, and `max_unavailable` more on top of that. Children that
+    are neither Running nor Idle count against that budget, so the rollout
+    waits for them, and so do Running children still rolling out an update.
+    Idle children have no pod to roll and are updated at once.
+    """
+    wanted = {index: child for index, child in children.items() if index < replicas}
+    deletes = [child for index, child in sorted(children.items(), reverse=True) if index >= replicas]
+    missing = [index for index in range(replicas) if index not in children]
+    provisioning = sum(1 for child in wanted.values() if child["phase"] in (None, "Provisioning"))
+    creates = missing[:max(0, max_parallel - provisioning)]
+    busy = sum(
+        1 for child in wanted.values()
+        if child["phase"] not in ("Running", "Idle") or (child["phase"] == "Running" and not child["rolled_out"])
+    )
+    stale = [child for index, child in sorted(wanted.items()) if child["template_hash"] != template_hash]
+    idle = [child for child in stale if child["phase"] == "Idle"]
+    stale = [child for child in stale if child["phase"] != "Idle"]
+    # Updating a child that is already down does not take anything further down
+    stale.sort(key=lambda child: child["phase"] == "Running")
+    updates = idle + stale[:max(0, max_surge + max_unavailable - busy)] if not creates else []
+    return creates, updates, deletes[:max_parallel]
+
+
+@kopf.on.create("kopf.dev.claud-code", "v1", "claud-code-fleets")
+@kopf.on.update("kopf.dev.claud-code", "v1", "claud-code-fleets")
+@kopf.timer("kopf.dev.claud-code", "v1", "claud-code-fleets", interval=FLEET_INTERVAL)
+async def reconcile_fleet_fn(body, name, namespace, patch, logger, fleet_children, **kwargs):
+    replicas = int(body.get("replicas", 1))
+    template = copy.deepcopy(dict(body.get("template") or {}))
+    rollout = body.get("rollout") or {}
+    max_parallel = int(body.get("max_parallel") or FLEET_MAX_PARALLEL)
+    template_hash = manifest_hash({"metadata": {}, "template": template})[:16]
+
+    children = {child["index"]: child for child in fleet_children.get((namespace, name), [])}
+    creates, updates, deletes = plan_fleet(
+        children, replicas, template_hash, max_parallel,
+        int(rollout.get("max_surge", 1)), int(rollout.get("max_unavailable", 0)),
+    )
+    steps = {}
+    for index in creates:
+        child = build_fleet_child(body, index, template, template_hash)
+        steps[f"create {index}"] = ((), functools.partial(apply_fleet_child, child, logger))
+    for child in updates:
+        manifest = build_fleet_child(body, child["index"], template, template_hash)
+        steps[f"update {child['index']}"] = ((), functools.partial(apply_fleet_child, manifest, logger))
+    for child in deletes:
+        steps[f"delete {child['index']}"] = ((), functools.partial(delete_fleet_child, namespace, child["name"], logger))
+    if steps:
+        logger.info(f"fleet {name}: creating {len(creates)}, updating {len(updates)}, deleting {len(deletes)} agents")
+        await run_provisioning_graph(steps, logger, concurrency=max_parallel)
+
+    wanted = [child for index, child in children.items() if index < replicas]
+    fleet_status = {
+        "replicas": len(wanted) + len(creates),
+        "ready_replicas": sum(1 for child in wanted if child["phase"] == "Running"),
+        "updated_replicas": sum(1 for child in wanted if child["template_hash"] == template_hash),
+        "template_hash": template_hash,
+    }
+    # The timer runs this every FLEET_INTERVAL; only write what changed
+    current = body.get("status") or {}
+    for key, value in fleet_status.items():
+        if current.get(key) != value:
+            patch.status[key] = value
+
+
+# Data templates: ConfigMaps in SHARED_NAMESPACE labelled DATA_TEMPLATE_LABEL
+# declare a golden data volume. Its `setup.sh` runs in the agent image
+# (`version`, latest by default) with the agent's home on the template PVC,
+# once when the template changes and then on `schedule`. A small server
+# streams the volume to the seed containers of new agents (see
+# build_seed_container). Everything is owned by the ConfigMap.
+DATA_TEMPLATE_LABEL = "kopf-agent.dev/data-template"
+# Hash of the setup the template volume was last refreshed with, on its PVC
+SETUP_HASH_ANNOTATION = "kopf-agent.dev/setup-hash"
+
+# Runs setup.sh against the template volume. Seeds are refused meanwhile, and
+# the .template marker tells seeded volumes apart from empty ones.
+REFRESH_SCRIPT = """set -e
+trap 'rm -f /data/output/.template-refreshing' EXIT
+touch /data/output/.template-refreshing
+sh /setup/setup.sh
+date -u > /data/output/.template
+"""
+
+# busybox httpd CGI streaming the template volume as a gzipped tarball
+SERVE_SCRIPT = """#!/bin/sh
+if [ ! -e /data/output/.template ] || [ -e /data/output/.template-refreshing ]; then
+  printf 'Status: 503 Service Unavailable\\r\\n\\r\\n'
+  exit 0
+fi
+printf 'Content-Type: application/gzip\\r\\n\\r\\n'
+exec tar -cz -C /data/output .
+"""
+
+
+def data_template_labels(data_template, component):
+    return dict(shared_labels(), app=f"{data_template_name(data_template)}-{component}")
+
+
+def build_data_template_pvc(data_template, shared_namespace, size="1Gi", setup_hash=None):
+    # Clones of it are created at least this large (see render_agent)
+    return kubernetes.client.V1PersistentVolumeClaim(
+        api_version="v1",
+        kind="PersistentVolumeClaim",
+        metadata=kubernetes.client.V1ObjectMeta(
+            name=data_template_name(data_template), namespace=shared_namespace, labels=shared_labels(),
+            annotations={SETUP_HASH_ANNOTATION: setup_hash} if setup_hash else None,
+        ),
+        spec=kubernetes.client.V1PersistentVolumeClaimSpec(
+            access_modes=["ReadWriteOnce"],
+            resources=kubernetes.client.V1ResourceRequirements(
+                requests={"storage": size}
+            ),
+        ),
+    )
+
+
+def build_data_template_job_spec(data_template, version):
+    """Pod running setup.sh on the template volume, next to the server that mounts it too"""
+    image, image_pull_policy = pinned_image(f"{AGENT_IMAGE}:{version}")
+    return kubernetes.client.V1JobSpec(
+        backoff_limit=2,
+        template=kubernetes.client.V1PodTemplateSpec(
+            metadata=kubernetes.client.V1ObjectMeta(labels=data_template_labels(data_template, "refresh")),
+            spec=kubernetes.client.V1PodSpec(
+                restart_policy="Never",
+                # The template PVC is ReadWriteOnce, so share the server's node
+                affinity=kubernetes.client.V1Affinity(
+                    pod_affinity=kubernetes.client.V1PodAffinity(
+                        required_during_scheduling_ignored_during_execution=[
+                            kubernetes.client.V1PodAffinityTerm(
+                                label_selector=kubernetes.client.V1LabelSelector(
+                                    match_labels=data_template_labels(data_template, "server"),
+                                ),
+                                topology_key="kubernetes.io/hostname",
+                            ),
+                        ],
+                    ),
+                ),
+                containers=[
+                    kubernetes.client.V1Container(
+                        name="refresh",
+                        image=image,
+                        image_pull_policy=image_pull_policy,
+                        command=["sh", "-c", REFRESH_SCRIPT],
+                        env=agent_home_env() + package_cache_env(),
+                        volume_mounts=[
+                            kubernetes.client.V1VolumeMount(name="data-volume", mount_path="/data/output"),
+                            kubernetes.client.V1VolumeMount(name="setup", mount_path="/setup"),
+                        ],
+                    ),
+                ],
+                volumes=[
+                    kubernetes.client.V1Volume(
+                        name="data-volume",
+                        persistent_volume_claim=kubernetes.client.V1PersistentVolumeClaimVolumeSource(
+                            claim_name=data_template_name(data_template),
+                        ),
+                    ),
+                    kubernetes.client.V1Volume(
+                        name="setup",
+                        config_map=kubernetes.client.V1ConfigMapVolumeSource(
+                            name=data_template,
+                            items=[kubernetes.client.V1KeyToPath(key="setup.sh", path="setup.sh")],
+                        ),
+                    ),
+                ],
+            ),
+        ),
+    )
+
+
+def build_data_template_cronjob(data_template, shared_namespace, version, schedule):
+    return kubernetes.client.V1CronJob(
+        api_version="batch/v1",
+        kind="CronJob",
+        metadata=kubernetes.client.V1ObjectMeta(
+            name=f"{data_template_name(data_template)}-refresh", namespace=shared_namespace, labels=shared_labels(),
+        ),
+        spec=kubernetes.client.V1CronJobSpec(
+            schedule=schedule,
+            concurrency_policy="Forbid",
+            job_template=kubernetes.client.V1JobTemplateSpec(
+                spec=build_data_template_job_spec(data_template, version),
+            ),
+        ),
+    )
+
+
+def build_data_template_job(data_template, shared_namespace, version, setup_hash):
+    """One-off refresh, named after the setup it runs so every change runs once"""
+    return kubernetes.client.V1Job(
+        api_version="batch/v1",
+        kind="Job",
+        metadata=kubernetes.client.V1ObjectMeta(
+            name=f"{data_template_name(data_template)}-{setup_hash[:10]}",
+            namespace=shared_namespace,
+            labels=shared_labels(),
+        ),
+        spec=build_data_template_job_spec(data_template, version),
+    )
+
+
+def build_data_template_server(data_template, shared_namespace):
+    """ConfigMap, Deployment and Service streaming the template volume over HTTP"""
+    server_name = f"{data_template_name(data_template)}-server"
+    labels = data_template_labels(data_template, "server")
+    image, image_pull_policy = pinned_image(BUSYBOX_IMAGE)
+    return [
+        kubernetes.client.V1ConfigMap(
+            api_version="v1",
+            kind="ConfigMap",
+            metadata=kubernetes.client.V1ObjectMeta(
+                name=server_name, namespace=shared_namespace, labels=shared_labels(),
+            ),
+            data={"seed": SERVE_SCRIPT},
+        ),
+        kubernetes.client.V1Deployment(
+            api_version="apps/v1",
+            kind="Deployment",
+            metadata=kubernetes.client.V1ObjectMeta(
+                name=server_name, namespace=shared_namespace, labels=shared_labels(),
+            ),
+            spec=kubernetes.client.V1DeploymentSpec(
+                replicas=1,
+                # The template PVC is ReadWriteOnce: never two servers on different nodes
+                strategy=kubernetes.client.V1DeploymentStrategy(type="Recreate"),
+                selector=kubernetes.client.V1LabelSelector(match_labels=labels),
+                template=kubernetes.client.V1PodTemplateSpec(
+                    metadata=kubernetes.client.V1ObjectMeta(labels=labels),
+                    spec=kubernetes.client.V1PodSpec(
+                        containers=[
+                            kubernetes.client.V1Container(
+                                name="server",
+                                image=image,
+                                image_pull_policy=image_pull_policy,
+                                command=["httpd", "-f", "-p", "8080", "-h", "/www"],
+                                ports=[kubernetes.client.V1ContainerPort(name="http", container_port=8080)],
+                                volume_mounts=[
+                                    kubernetes.client.V1VolumeMount(name="cgi", mount_path="/www/cgi-bin"),
+                                    kubernetes.client.V1VolumeMount(
+                                        name="data-volume", mount_path="/data/output", read_only=True,
+                                    ),
+                                ],
+                                resources=kubernetes.client.V1ResourceRequirements(
+                                    requests={"cpu": "10m", "memory": "16Mi"},
+                                ),
+                            ),
+                        ],
+                        volumes=[
+                            kubernetes.client.V1Volume(
+                                name="cgi",
+                                config_map=kubernetes.client.V1ConfigMapVolumeSource(
+                                    name=server_name, default_mode=0o755,
+                                ),
+                            ),
+                            kubernetes.client.V1Volume(
+                                name="data-volume",
+                                persistent_volume_claim=kubernetes.client.V1PersistentVolumeClaimVolumeSource(
+                                    claim_name=data_template_name(data_template), read_only=True,
+                                ),
+                            ),
+                        ],
+                    ),
+                ),
+            ),
+        ),
+        kubernetes.client.V1Service(
+            api_version="v1",
+            kind="Service",
+            metadata=kubernetes.client.V1ObjectMeta(
+                name=data_template_name(data_template), namespace=shared_namespace, labels=shared_labels(),
+            ),
+            spec=kubernetes.client.V1ServiceSpec(
+                selector=labels,
+                ports=[kubernetes.client.V1ServicePort(name="http", port=8080, target_port=8080)],
+            ),
+        ),
+    ]
+
+
+def owned_by(manifests, owner):
+    """Serialized manifests with an owner reference to `owner`, so they go when it goes"""
+    owned = []
+    for manifest in manifests:
+        obj = api_client().sanitize_for_serialization(manifest)
+        kopf.append_owner_reference(obj, owner=owner)
+        owned.append(obj)
+    return owned
+
+
+@kopf.on.create("v1", "configmaps", labels={DATA_TEMPLATE_LABEL: kopf.PRESENT},
+                when=lambda namespace, **_: namespace == SHARED_NAMESPACE)
+@kopf.on.update("v1", "configmaps", labels={DATA_TEMPLATE_LABEL: kopf.PRESENT},
+                when=lambda namespace, **_: namespace == SHARED_NAMESPACE)
+@kopf.on.resume("v1", "configmaps", labels={DATA_TEMPLATE_LABEL: kopf.PRESENT},
+                when=lambda namespace, **_: namespace == SHARED_NAMESPACE)
+async def reconcile_data_template_fn(body, name, namespace, reason, logger, **kwargs):
+    data = body.get("data") or {}
+    setup = data.get("setup.sh")
+    if not setup:
+        raise kopf.PermanentError(f"data template {name} has no setup.sh")
+    version = data.get("version", "latest")
+    if PIN_IMAGES:
+        await run_blocking(resolve_images, [f"{AGENT_IMAGE}:{version}", BUSYBOX_IMAGE], logger)
+
+    setup_hash = hashlib.sha256(json.dumps([setup, version]).encode()).hexdigest()
+    pvc = build_data_template_pvc(name, namespace, data.get("size", "1Gi"), setup_hash)
+    manifests = [
+        pvc,
+        *build_data_template_server(name, namespace),
+        build_data_template_cronjob(name, namespace, version, data.get("schedule", DATA_TEMPLATE_SCHEDULE)),
+    ]
+    # A resumed operator finds the template as it left it; only changes refresh it now.
+    # The PVC records the setup it was refreshed with, so each setup runs once
+    # even after its finished Job is gone. A Job still there is left alone: its
+    # pod template cannot change, even if the pinned image moved since.
+    if reason != "resume":
+        live = await run_blocking(read_object, "PersistentVolumeClaim", namespace, pvc.metadata.name)
+        refreshed = ((live or {}).get("metadata", {}).get("annotations") or {}).get(SETUP_HASH_ANNOTATION)
+        job = build_data_template_job(name, namespace, version, setup_hash)
+        if refreshed != setup_hash and await run_blocking(read_object, "Job", namespace, job.metadata.name) is None:
+            manifests.append(job)
+    await run_blocking(apply_manifests, owned_by(manifests, body), logger)
+    logger.info(f"data template {name} is up to date")
@@ -0,0 +1,105 @@
+import logging
+
+import kubernetes
+import pytest
+
+import main
+
+logger = logging.getLogger(__name__)
+serialize = kubernetes.client.ApiClient().sanitize_for_serialization
+
+
+def agent(name="my-agent", **fields):
+    return {
+        "apiVersion": "kopf.dev.claud-code/v1",
+        "kind": "ClaudCode",
+        "metadata": {"name": name, "namespace": "default"},
+        "system_prompt": "You are a helpful agent.",
+        "mcp_config": {"mcpServers": {}},
+        "data": {"ANTHROPIC_API_KEY": "key", "OPENAI_API_KEY": "key"},
+        **fields,
+    }
+
+
+def rendered(body, stack, pvc_names):
+    return [
+        serialize(manifest)
+        for _, manifests in main.render_agent(body, stack, pvc_names, logger).values()
+        for manifest in manifests
+    ]
+
+
+def indexed(objects):
+    """The informer indices as kopf fills them from the applied objects"""
+    indices = {index_name: {} for index_name in main.OWNED_INDICES.values()}
+    for obj in objects:
+        index_name = main.OWNED_INDICES.get(obj["kind"])
+        labels = obj["metadata"].get("labels") or {}
+        if index_name is None or main.AGENT_LABEL not in labels:
+            continue
+        for key, value in getattr(main, index_name)(body=obj, labels=labels).items():
+            indices[index_name].setdefault(key, []).append(value)
+    return indices
+
+
+@pytest.mark.parametrize("stack", [
+    {"name": "my-agent", "namespace": "my-agent"},
+    {"name": "warm-1234", "namespace": "warm-1234", "warm": True},
+])
+def test_applied_objects_do_not_drift(stack):
+    body = agent()
+    pvc_names = {"metadata": "my-agent-metadata", "data": "my-agent-data"}
+    objects = rendered(body, stack, pvc_names)
+    cache = main.cached_objects("my-agent", indexed(objects))
+    for obj in objects:
+        if obj["kind"] in main.OWNED_INDICES:
+            live = cache.get((obj["kind"], obj["metadata"]["name"]))
+            assert live is not None, f"{obj['kind']} {obj['metadata']['name']} is not in the agent's cache"
+            assert main.drift_patch(main.drift_desired(obj), live) is None
+
+
+def test_mounted_prompt_does_not_drift(monkeypatch):
+    monkeypatch.setattr(main, "PROMPT_DELIVERY", "file")
+    stack = {"name": "my-agent", "namespace": "my-agent"}
+    objects = rendered(agent(), stack, {"metadata": "my-agent-metadata", "data": "my-agent-data"})
+    cache = main.cached_objects("my-agent", indexed(objects))
+    prompts = [obj for obj in objects if main.PROMPT_LABEL in obj["metadata"]["labels"]]
+    assert [prompt["immutable"] for prompt in prompts] == [True]
+    for prompt in prompts:
+        live = cache[("ConfigMap", prompt["metadata"]["name"])]
+        assert main.drift_patch(main.drift_desired(prompt), live) is None
+
+
+def test_drift_patch_only_sends_differing_fields():
+    desired = {"spec": {"replicas": 1, "template": {"metadata": {"labels": {"app": "a"}}}}}
+    live = {"spec": {"replicas": 0, "template": {"metadata": {"labels": {"app": "a"}}}, "paused": False}}
+    assert main.drift_patch(desired, live) == {"spec": {"replicas": 1}}
+
+
+def test_drift_patch_compares_quantities_and_sends_lists_whole():
+    assert main.drift_patch({"storage": "1Gi"}, {"storage": "1024Mi"}) is None
+    desired = {"ports": [{"port": 80}, {"port": 443}]}
+    assert main.drift_patch(desired, {"ports": [{"port": 80, "protocol": "TCP"}, {"port": 8443}]}) == desired
+
+
+@pytest.mark.parametrize("image, expected", [
+    ("busybox:1.36", ("registry-1.docker.io", "library/busybox", "1.36")),
+    ("bencdr/code-server-deploy-container", ("registry-1.docker.io", "bencdr/code-server-deploy-container", "latest")),
+    ("mcr.microsoft.com/playwright:v1.52.0-noble", ("mcr.microsoft.com", "playwright", "v1.52.0-noble")),
+    ("localhost:5000/agent", ("localhost:5000", "agent", "latest")),
+])
+def test_parse_image(image, expected):
+    assert main.parse_image(image) == expected
+
+
+@pytest.mark.parametrize("path, method, content_type, expected", [
+    ("/api/v1/namespaces/a/pods", "GET", None, ("list", "pods")),
+    ("/api/v1/namespaces/a/pods/p/log", "GET", None, ("get", "pods/log")),
+    ("/apis/apps/v1/namespaces/a/deployments/d", "PATCH", "application/apply-patch+yaml", ("apply", "deployments")),
+    ("/apis/apps/v1/namespaces/a/deployments/d", "PATCH", "application/merge-patch+json", ("patch", "deployments")),
+    ("/api/v1/namespaces/a/configmaps", "DELETE", None, ("deletecollection", "configmaps")),
+    ("/api/v1/namespaces/a", "DELETE", None, ("delete", "namespaces")),
+])
+def test_api_verb_and_resource(path, method, content_type, expected):
+    headers = {"Content-Type": content_type} if content_type else {}
+    assert main.api_verb_and_resource(path, method, headers) == expected
@@ -0,0 +1,50 @@
+import main
+
+
+def child(index, phase="Running", template_hash="old", rolled_out=True):
+    return {
+        "name": f"team-{index}", "index": index, "template_hash": template_hash, "phase": phase,
+        "rolled_out": rolled_out,
+    }
+
+
+def test_rollout_updates_max_surge_children_at_a_time():
+    children = {index: child(index) for index in range(5)}
+    creates, updates, deletes = main.plan_fleet(children, 5, "new", 5, 1, 0)
+    assert (creates, deletes) == ([], [])
+    assert [update["index"] for update in updates] == [0]
+
+
+def test_rollout_waits_for_children_that_are_down():
+    children = {index: child(index) for index in range(5)}
+    children[4] = child(4, "Degraded", "new")
+    assert main.plan_fleet(children, 5, "new", 5, 1, 0) == ([], [], [])
+
+
+def test_rollout_waits_for_running_children_still_rolling_out():
+    children = {index: child(index) for index in range(5)}
+    children[0] = child(0, template_hash="new", rolled_out=False)
+    assert main.plan_fleet(children, 5, "new", 5, 1, 0) == ([], [], [])
+    children[0] = child(0, template_hash="new")
+    _, updates, _ = main.plan_fleet(children, 5, "new", 5, 1, 0)
+    assert [update["index"] for update in updates] == [1]
+
+
+def test_idle_children_do_not_block_the_rollout():
+    children = {index: child(index) for index in range(5)}
+    children[2] = child(2, "Idle")
+    _, updates, _ = main.plan_fleet(children, 5, "new", 5, 1, 0)
+    assert sorted(update["index"] for update in updates) == [0, 2]
+
+
+def test_scaling_down_deletes_the_highest_indices():
+    children = {index: child(index, template_hash="new") for index in range(5)}
+    _, _, deletes = main.plan_fleet(children, 2, "new", 2, 1, 0)
+    assert [delete["index"] for delete in deletes] == [4, 3]
+
+
+def test_scaling_up_keeps_max_parallel_children_provisioning():
+    children = {0: child(0, "Provisioning", "new")}
+    creates, updates, _ = main.plan_fleet(children, 10, "new", 3, 1, 0)
+    assert creates == [1, 2]
+    assert updates == []